@@ -0,0 +1,127 @@
+import functools
+import tempfile
+
+import numpy as np
+
+from benchmarks.fixtures import MetadataReader, write_czi
+from benchmarks.harness import benchmark
+
+_WAVELENGTHS = np.random.default_rng(0).integers(380, 740, 1000).tolist()
+
+# Kept for the whole run, removed with the interpreter
+_czi_folder = tempfile.TemporaryDirectory(prefix="pitcount-benchmark-")
+
+
+@functools.lru_cache(maxsize=None)
+def _czi_path() -> str:
+    return write_czi(f"{_czi_folder.name}/benchmark.czi")
+
+
+@benchmark("truncate_filename")
+def truncate_filename_names():
+    from napari_pitcount_cfim.czi_reader_plugin.czi_reader_CFIM import truncate_filename
+
+    names = [f"P{index:02d} {index}-Tile-{index % 16}-Create Image Subset-{index:02d}_ORG.czi" for index in range(1000)]
+    return lambda: [truncate_filename(name, 20) for name in names]
+
+
+@benchmark("range_dict_lookup")
+def range_dict_wavelengths():
+    from napari_pitcount_cfim.czi_reader_plugin.czi_metadata_processor import wavelength_to_color
+
+    return lambda: [wavelength_to_color[wavelength] for wavelength in _WAVELENGTHS]
+
+
+@benchmark("extract_key_metadata")
+def extract_key_metadata_reader():
+    from napari_pitcount_cfim.czi_reader_plugin.czi_metadata_processor import extract_key_metadata
+
+    reader = MetadataReader()
+    return lambda: extract_key_metadata(reader, 2)
+
+
+@benchmark("metadata_dump")
+def metadata_dump_reader():
+    from napari_pitcount_cfim.czi_reader_plugin.metadata_dump import metadata_dump
+
+    reader = MetadataReader()
+    return lambda: metadata_dump(reader, 2)
+
+
+def _read_czi(backend: str, decode: bool, mode: str = "file", access=None):
+    from napari_pitcount_cfim.czi_reader_plugin.czi_reader_CFIM import read_czi
+    from napari_pitcount_cfim.czi_reader_plugin.metadata_index import set_metadata_index_folder
+
+    path = _czi_path()
+
+    def read():
+        # A fresh in-memory index each time, so every read parses the metadata like the first read of a file
+        set_metadata_index_folder(None)
+        layers = read_czi(path, backend=backend, decode=mode)()
+        if access is not None:
+            access(layers)
+        elif decode:
+            for data, _, _ in layers:
+                np.asarray(data)
+        return layers
+    return read
+
+
+@benchmark("read_czi[aicsimageio]")
+def read_czi_aicsimageio():
+    return _read_czi("aicsimageio", decode=False)
+
+
+@benchmark("read_czi[aicspylibczi]")
+def read_czi_aicspylibczi():
+    return _read_czi("aicspylibczi", decode=False)
+
+
+@benchmark("read_czi_decode[aicsimageio]", repeat=5)
+def read_czi_decode_aicsimageio():
+    return _read_czi("aicsimageio", decode=True)
+
+
+def _read_czi_analysis(backend: str, mode: str):
+    from benchmarks.decode_passes import analysis_access
+
+    return _read_czi(backend, decode=True, mode=mode, access=analysis_access)
+
+
+# Every channel decoded for segmentation and again for each mask, see decode_passes for the decode counts
+@benchmark("read_czi_analysis[aicsimageio,plane]", repeat=5)
+def read_czi_analysis_aicsimageio_plane():
+    return _read_czi_analysis("aicsimageio", "plane")
+
+
+@benchmark("read_czi_analysis[aicsimageio,file]", repeat=5)
+def read_czi_analysis_aicsimageio_file():
+    return _read_czi_analysis("aicsimageio", "file")
+
+
+@benchmark("read_czi_analysis[aicspylibczi,plane]", repeat=5)
+def read_czi_analysis_aicspylibczi_plane():
+    return _read_czi_analysis("aicspylibczi", "plane")
+
+
+@benchmark("read_czi_analysis[aicspylibczi,file]", repeat=5)
+def read_czi_analysis_aicspylibczi_file():
+    return _read_czi_analysis("aicspylibczi", "file")
+
+
+@benchmark("read_czi_analysis[aicsimageio,pixel_cache]", repeat=5)
+def read_czi_analysis_pixel_cache():
+    from napari_pitcount_cfim.czi_reader_plugin.pixel_cache import PixelCache, set_pixel_cache
+
+    cache = PixelCache(f"{_czi_folder.name}/pixels", storage="memmap")
+    read = _read_czi_analysis("aicsimageio", "file")
+
+    def read_cached():
+        # Only for this benchmark, the others decode every time
+        set_pixel_cache(cache)
+        try:
+            return read()
+        finally:
+            set_pixel_cache(None)
+    read_cached()  # Fills the cache
+    return read_cached
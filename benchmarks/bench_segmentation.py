@@ -0,0 +1,45 @@
+import functools
+
+import numpy as np
+
+from benchmarks.fixtures import blob_image, blob_labels, random_cellpose_model
+from benchmarks.harness import benchmark
+
+
+@functools.lru_cache(maxsize=None)
+def _cellpose_user():
+    from napari_pitcount_cfim.cellpose_analysis import model_pool
+    from napari_pitcount_cfim.cellpose_analysis.cellpose_user import CellposeUser
+    from napari_pitcount_cfim.cellpose_analysis.model_pool import ModelPool
+    from napari_pitcount_cfim.config.settings_structure import CellposeSettings
+
+    # Random weights, the timings are those of the real network without downloading it
+    model_pool._model_pool = ModelPool(model_factory=random_cellpose_model)
+    return CellposeUser(CellposeSettings(diameter=30).model_dump())
+
+
+@benchmark("process_image[256x256]", repeat=3)
+def process_image_256():
+    user = _cellpose_user()
+    image = blob_image((256, 256), cells=15)
+    return lambda: user.process_image(image)
+
+
+@benchmark("masks_from_flows[256x256]", repeat=5)
+def masks_from_flows_256():
+    from cellpose.dynamics import masks_to_flows
+
+    # Flows of known cells, the random network finds none and would leave nothing to follow
+    labels = blob_labels((256, 256), cells=15)
+    d_p = 5 * masks_to_flows(labels).astype(np.float32)
+    cell_probability = np.where(labels > 0, 4.0, -4.0).astype(np.float32)
+    user = _cellpose_user()
+    return lambda: user.masks_from_flows(d_p, cell_probability, 30.0)
+
+
+@benchmark("remove_edge_masks[1024x1024]")
+def remove_edge_masks_1024():
+    from napari_pitcount_cfim.cellpose_analysis.cellpose_user import _remove_edge_masks
+
+    labels = blob_labels((1024, 1024), cells=300)
+    return lambda: _remove_edge_masks(labels)
@@ -0,0 +1,113 @@
+"""
+Counts how often the pixels of a multi-channel CZI are decoded while the plugin works through it.
+
+    python -m benchmarks.decode_passes --channels 3 --planes 5 --size 512
+
+Reads a synthetic file with each backend and decode mode of the reader, and consumes it the way an analysis
+does: every channel is decoded for segmentation, then every channel again for measuring each mask. libCZI calls
+are counted under both backends, file opens (each reads the subblock directory) and decoded planes, shown as
+passes over the whole file. Run from the repository root.
+"""
+import argparse
+import contextlib
+import functools
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+BACKENDS = ("aicsimageio", "aicspylibczi")
+DECODE_MODES = ("plane", "file")
+
+
+@contextlib.contextmanager
+def count_decodes():
+    """
+        Counts CziFile opens, read calls and decoded YX planes within the block, for either backend.
+
+        Yields:
+            dict -> {"opens", "reads", "planes"}, filled in as the block runs.
+    """
+    from aicspylibczi import CziFile
+
+    counts = {"opens": 0, "reads": 0, "planes": 0}
+    originals = {name: getattr(CziFile, name) for name in ("__init__", "read_image", "read_mosaic")}
+
+    @functools.wraps(originals["__init__"])
+    def init(self, *args, **kwargs):
+        counts["opens"] += 1
+        return originals["__init__"](self, *args, **kwargs)
+
+    def counted(name):
+        @functools.wraps(originals[name])
+        def read(self, *args, **kwargs):
+            result = originals[name](self, *args, **kwargs)
+            data = result[0] if isinstance(result, tuple) else result
+            counts["reads"] += 1
+            # Planes are the product of everything in front of YX, RGB samples trail the plane
+            plane_dims = 3 if self.pixel_type.startswith("bgr") else 2
+            counts["planes"] += int(np.prod(data.shape[:-plane_dims]))
+            return result
+        return read
+
+    CziFile.__init__ = init
+    CziFile.read_image = counted("read_image")
+    CziFile.read_mosaic = counted("read_mosaic")
+    try:
+        yield counts
+    finally:
+        for name, original in originals.items():
+            setattr(CziFile, name, original)
+
+
+def analysis_access(layers: list):
+    """
+        Decodes the channels of a file like an analysis: all of them for one segmentation batch, then all of
+        them once per mask for measuring intensities, while the segmentation images are still held.
+    """
+    images = [np.asarray(data) for data, _, _ in layers]
+    for _ in images:
+        intensities = [np.asarray(data) for data, _, _ in layers]
+        del intensities
+    return images
+
+
+def count_passes(path: str, backend: str, decode: str, planes_in_file: int) -> dict:
+    from napari_pitcount_cfim.czi_reader_plugin.czi_reader_CFIM import read_czi
+    from napari_pitcount_cfim.czi_reader_plugin.metadata_index import set_metadata_index_folder
+
+    set_metadata_index_folder(None)
+    with count_decodes() as counts:
+        analysis_access(read_czi(path, backend=backend, decode=decode)())
+    return {**counts, "passes": counts["planes"] / planes_in_file}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Count decode passes over a multi-channel CZI.")
+    parser.add_argument("--channels", type=int, default=3, help="Channels of the file.")
+    parser.add_argument("--planes", type=int, default=5, help="Z planes per channel.")
+    parser.add_argument("--size", type=int, default=512, help="Edge length of the planes.")
+    args = parser.parse_args(argv)
+
+    from benchmarks.fixtures import write_czi
+
+    with tempfile.TemporaryDirectory(prefix="pitcount-decode-") as folder:
+        path = write_czi(os.path.join(folder, "decode.czi"), args.channels, args.planes, (args.size, args.size))
+        rows = []
+        for backend in BACKENDS:
+            for decode in DECODE_MODES:
+                # The reader and the analysis print progress, only the table is wanted
+                with contextlib.redirect_stdout(open(os.devnull, "w")):
+                    rows.append((backend, decode, count_passes(path, backend, decode, args.channels * args.planes)))
+
+    print(f"{args.channels} channels x {args.planes} planes of {args.size}x{args.size}")
+    print(f"{'backend':<14} {'decode':<6} {'opens':>6} {'reads':>6} {'planes':>7} {'passes':>7}")
+    for backend, decode, counts in rows:
+        print(f"{backend:<14} {decode:<6} {counts['opens']:>6} {counts['reads']:>6} {counts['planes']:>7} "
+              f"{counts['passes']:>7.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,101 @@
+import numpy as np
+
+# Metadata with every field read by extract_key_metadata and metadata_dump, in the layout of a ZEN export
+METADATA_XML = """<ImageDocument><Metadata>
+  <Experiment><ExperimentBlocks><AcquisitionBlock>
+    <AcquisitionModeSetup><ScalingX>1e-07</ScalingX><ScalingY>1e-07</ScalingY></AcquisitionModeSetup>
+    <MultiTrackSetup>
+      <TrackSetup Id="Track:1"><Attenuators><Attenuator><Wavelength>4.05E-07</Wavelength></Attenuator></Attenuators></TrackSetup>
+      <TrackSetup Id="Track:2"><Attenuators><Attenuator><Wavelength>5.61E-07</Wavelength></Attenuator></Attenuators></TrackSetup>
+    </MultiTrackSetup>
+  </AcquisitionBlock></ExperimentBlocks></Experiment>
+  <Information>
+    <Image>
+      <SizeX>512</SizeX><SizeY>512</SizeY><SizeZ>5</SizeZ>
+      <Dimensions><Channels>
+        <Channel Id="Channel:0" Name="DAPI"><EmissionWavelength>465</EmissionWavelength></Channel>
+        <Channel Id="Channel:1" Name="mCherry"><EmissionWavelength>610</EmissionWavelength></Channel>
+      </Channels></Dimensions>
+    </Image>
+    <Instrument><Objectives><Objective Id="Objective:1" Name="Plan-Apochromat 20x/0.8"/></Objectives></Instrument>
+  </Information>
+  <Scaling><Items>
+    <Distance Id="X"><Value>1e-07</Value><DefaultUnitFormat>µm</DefaultUnitFormat></Distance>
+    <Distance Id="Y"><Value>1e-07</Value></Distance>
+    <Distance Id="Z"><Value>5e-07</Value></Distance>
+  </Items></Scaling>
+  <DisplaySetting><DefaultScalingUnit>µm</DefaultScalingUnit></DisplaySetting>
+  %s
+</Metadata></ImageDocument>
+"""
+
+
+def metadata_xml(padding_elements: int = 2000) -> str:
+    """
+        METADATA_XML with padding_elements unrelated elements after the fields, real files carry megabytes of
+        hardware and display settings that every lookup has to get past.
+    """
+    padding = "".join(f'<Setting Id="{index}"><Value>{index}</Value></Setting>' for index in range(padding_elements))
+    return METADATA_XML % f"<AppliedHardwareSettings>{padding}</AppliedHardwareSettings>"
+
+
+class MetadataReader:
+    """
+        Stands in for CziReader where only the metadata is read. The XML is parsed once, as CziReader caches it.
+    """
+    def __init__(self, xml: str = None):
+        from xml.etree import ElementTree
+
+        self.metadata = ElementTree.fromstring(xml or metadata_xml())
+
+
+def blob_labels(shape=(512, 512), cells: int = 60, radius: int = 14, seed: int = 0) -> np.ndarray:
+    """
+        Round cells at random positions, some cut by the image border, later cells drawn over earlier ones.
+    """
+    rng = np.random.default_rng(seed)
+    labels = np.zeros(shape, dtype=np.int32)
+    y, x = np.ogrid[:shape[0], :shape[1]]
+    for label in range(1, cells + 1):
+        centre_y, centre_x = rng.integers(0, shape[0]), rng.integers(0, shape[1])
+        labels[(y - centre_y) ** 2 + (x - centre_x) ** 2 <= radius ** 2] = label
+    return labels
+
+
+def blob_image(shape=(512, 512), cells: int = 60, radius: int = 14, seed: int = 0) -> np.ndarray:
+    """
+        A noisy uint16 image of the cells of blob_labels.
+    """
+    rng = np.random.default_rng(seed)
+    labels = blob_labels(shape, cells, radius, seed)
+    image = 200 + 1500 * (labels > 0) + rng.normal(0, 60, shape)
+    return np.clip(image, 0, 65535).astype(np.uint16)
+
+
+def write_czi(path: str, channels: int = 2, planes: int = 3, shape=(512, 512), seed: int = 0) -> str:
+    """
+        Writes a CZI of blob images, see synthetic.write_czi.
+    """
+    from benchmarks.synthetic import write_czi
+
+    image = np.stack([np.stack([blob_image(shape, seed=seed + channel * planes + plane) for plane in range(planes)])
+                      for channel in range(channels)])
+    return write_czi(path, image)
+
+
+def random_cellpose_model(model_type, gpu, nchan):
+    """
+        Model factory for ModelPool giving a Cellpose model with randomly initialised weights and no size model,
+        so segmentation runs offline and without downloads. Its masks are meaningless, its cost is that of the
+        real network.
+    """
+    from cellpose import models
+
+    model = models.Cellpose.__new__(models.Cellpose)
+    model.cp = models.CellposeModel(gpu=False, pretrained_model="", nchan=nchan)
+    model.gpu = False
+    model.device = model.cp.device
+    model.diam_mean = 30.0
+    model.pretrained_size = None
+    model.sz = None
+    return model
@@ -0,0 +1,158 @@
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+import timeit
+from collections import namedtuple
+
+BENCHMARK_FOLDER = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(BENCHMARK_FOLDER, "baseline.json")
+HISTORY_FOLDER = os.path.join(BENCHMARK_FOLDER, "history")
+
+# A benchmark is slower than its baseline when its median grows by more than this fraction
+DEFAULT_TOLERANCE = 0.25
+
+# setup() prepares the inputs outside the timing and returns the function that is timed
+Benchmark = namedtuple("Benchmark", ["name", "setup", "repeat"])
+
+BENCHMARKS = {}  # name -> Benchmark, in registration order
+
+
+class SkipBenchmark(Exception):
+    """
+        Raised by a setup whose optional dependency is missing.
+    """
+
+
+def benchmark(name: str, repeat: int = 7):
+    """
+        Registers a setup function as the benchmark name.
+
+        Parameters:
+            name: str -> Unique name, also the history file name.
+            repeat: int -> Timed repeats, fewer for benchmarks taking seconds.
+    """
+    def register(setup):
+        if name in BENCHMARKS:
+            raise ValueError(f"Benchmark {name} is registered twice")
+        BENCHMARKS[name] = Benchmark(name, setup, repeat)
+        return setup
+    return register
+
+
+def time_function(function, repeat: int = 7) -> dict:
+    """
+        Times function like timeit: calls are looped until a repeat takes at least 0.2 s, and each of repeat
+        repeats gives one time per call. The first call runs untimed, so lazy imports and model loads stay out.
+
+        Returns:
+            dict -> min, median and max seconds per call, and the loop count per repeat.
+    """
+    function()
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    times = [total / number for total in timer.repeat(repeat, number)]
+    return {"min": min(times), "median": statistics.median(times), "max": max(times), "number": number}
+
+
+def machine_info() -> dict:
+    import numpy
+
+    return {
+        "node": platform.node(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+    }
+
+
+def git_commit() -> str:
+    try:
+        completed = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCHMARK_FOLDER,
+                                   capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return completed.stdout.strip() or None
+
+
+def append_history(results: dict, folder: str = HISTORY_FOLDER):
+    """
+        Appends every result to history/<name>.jsonl, one line per run, with the commit and machine it ran on.
+    """
+    os.makedirs(folder, exist_ok=True)
+    run = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": git_commit(), "machine": machine_info()}
+    for name, result in results.items():
+        with open(os.path.join(folder, f"{name}.jsonl"), "a", encoding="utf-8") as file:
+            file.write(json.dumps({**run, **result}) + "\n")
+
+
+def load_baseline(path: str = BASELINE_PATH) -> dict:
+    """
+        Returns:
+            dict -> {"machine": machine_info(), "benchmarks": {name: result}}, empty without a baseline.
+    """
+    if not os.path.exists(path):
+        return {"machine": {}, "benchmarks": {}}
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def save_baseline(results: dict, path: str = BASELINE_PATH, merge: bool = True):
+    """
+        Stores results as the baseline. With merge, benchmarks not in results keep their baseline.
+    """
+    baseline = load_baseline(path) if merge else {"benchmarks": {}}
+    baseline["machine"] = machine_info()
+    baseline["commit"] = git_commit()
+    baseline["benchmarks"] = {**baseline.get("benchmarks", {}), **results}
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(baseline, file, indent=2, sort_keys=True)
+        file.write("\n")
+
+
+def compare(results: dict, baseline: dict, tolerance: float = DEFAULT_TOLERANCE) -> list:
+    """
+        Compares the medians of results with the baseline.
+
+        Returns:
+            list -> (name, median, baseline median or None, ratio or None, status) per result, status is "new",
+                    "ok", "faster" or "slower".
+    """
+    rows = []
+    for name, result in results.items():
+        reference = baseline.get("benchmarks", {}).get(name)
+        if reference is None:
+            rows.append((name, result["median"], None, None, "new"))
+            continue
+        ratio = result["median"] / reference["median"]
+        if ratio > 1 + tolerance:
+            status = "slower"
+        elif ratio < 1 / (1 + tolerance):
+            status = "faster"
+        else:
+            status = "ok"
+        rows.append((name, result["median"], reference["median"], ratio, status))
+    return rows
+
+
+def format_seconds(seconds: float) -> str:
+    if seconds is None:
+        return "-"
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.3g} {unit}"
+    return f"{seconds / 1e-9:.3g} ns"
+
+
+def format_table(rows: list) -> str:
+    width = max([36] + [len(row[0]) for row in rows])
+    lines = [f"{'benchmark':<{width}} {'median':>10} {'baseline':>10} {'ratio':>7}  status"]
+    for name, median, reference, ratio, status in rows:
+        ratio_text = "-" if ratio is None else f"{ratio:.2f}"
+        lines.append(f"{name:<{width}} {format_seconds(median):>10} {format_seconds(reference):>10} "
+                     f"{ratio_text:>7}  {status}")
+    return "\n".join(lines)
@@ -0,0 +1,78 @@
+"""
+Runs the micro-benchmarks and compares them with the stored baseline.
+
+    python -m benchmarks.run_benchmarks                   # run all, append to the history, compare
+    python -m benchmarks.run_benchmarks -k read_czi       # only benchmarks whose name contains read_czi
+    python -m benchmarks.run_benchmarks --save-baseline   # store this run as the baseline
+
+Run from the repository root. Exits with 1 if a benchmark got slower than the baseline by more than the tolerance.
+"""
+import argparse
+import contextlib
+import io
+import sys
+
+from benchmarks import bench_reader, bench_segmentation  # noqa: F401, registers the benchmarks
+from benchmarks.harness import BENCHMARKS, DEFAULT_TOLERANCE, SkipBenchmark, append_history, compare, \
+    format_table, load_baseline, machine_info, save_baseline, time_function
+
+
+def run(names: list) -> dict:
+    results = {}
+    for name in names:
+        entry = BENCHMARKS[name]
+        print(f"[*] {name}", end=" ", flush=True)
+        try:
+            # The benchmarked code prints and logs progress, which would drown the report
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                function = entry.setup()
+                result = time_function(function, entry.repeat)
+        except SkipBenchmark as e:
+            print(f"skipped, {e}")
+            continue
+        results[name] = result
+        print(f"{result['median'] * 1000:.3f} ms")
+    return results
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Run the napari-pitcount-cfim micro-benchmarks.")
+    parser.add_argument("-k", "--filter", default="", help="Only run benchmarks whose name contains this text.")
+    parser.add_argument("--list", action="store_true", help="List the benchmarks and exit.")
+    parser.add_argument("--save-baseline", action="store_true", help="Store this run as the baseline.")
+    parser.add_argument("--no-history", action="store_true", help="Do not append this run to the history.")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Slowdown of the median, as a fraction, that counts as a regression.")
+    args = parser.parse_args(argv)
+
+    names = [name for name in BENCHMARKS if args.filter in name]
+    if args.list:
+        print("\n".join(names))
+        return 0
+    if not names:
+        print(f"[!] No benchmark matches {args.filter!r}")
+        return 1
+
+    results = run(names)
+    if not args.no_history:
+        append_history(results)
+
+    baseline = load_baseline()
+    if baseline.get("machine") and baseline["machine"] != machine_info():
+        print("[!] The baseline was recorded on another machine or environment, compare with care")
+    rows = compare(results, baseline, args.tolerance)
+    print(format_table(rows))
+
+    if args.save_baseline:
+        save_baseline(results)
+        print("[*] Saved the baseline")
+        return 0
+    slower = [row[0] for row in rows if row[4] == "slower"]
+    if slower:
+        print(f"[!] Slower than the baseline: {', '.join(slower)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
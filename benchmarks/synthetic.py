@@ -0,0 +1,142 @@
+"""
+Deterministic synthetic microscopy data: multi-channel ZYX stacks of blob-like cells with pits.
+
+Channel 0 holds the cell bodies, the other channels dim cell background with bright diffraction limited pits,
+like the membrane pits the plugin counts. The same seed always gives the same stack, with the ground truth
+labels and pit positions it was drawn from.
+"""
+import os
+from collections import namedtuple
+
+import numpy as np
+
+# image: (C, Z, Y, X) uint16, labels: (Y, X) int32 cells, pits: (pits, 3) ZYX pit centres
+SyntheticImage = namedtuple("SyntheticImage", ["image", "labels", "pits"])
+
+
+def synthetic_stack(shape=(1, 512, 512), channels: int = 2, cell_diameter: float = 30.0,
+                    cell_density: float = 0.3, pits_per_cell: float = 8.0, pit_diameter: float = 3.0,
+                    noise: float = 0.05, background: int = 200, brightness: int = 2000,
+                    seed: int = 0) -> SyntheticImage:
+    """
+        Draws cells as smooth discs at random, mostly separate positions, brightest in the middle plane of the
+        stack, and scatters pits within them.
+
+        Parameters:
+            shape: tuple -> (Z, Y, X) of each channel.
+            channels: int -> Channel count, at least 1. Channels after the first show pits.
+            cell_diameter: float -> Cell diameter in pixels, the Cellpose diameter of the image.
+            cell_density: float -> Fraction of the image area covered by cells.
+            pits_per_cell: float -> Mean number of pits per cell, Poisson distributed.
+            pit_diameter: float -> Pit diameter in pixels.
+            noise: float -> Standard deviation of the Gaussian read noise, as a fraction of brightness. Shot
+                           noise comes on top.
+            background: int -> Counts outside cells.
+            brightness: int -> Counts of a cell body centre.
+            seed: int -> Seed of every random choice.
+    """
+    from scipy import ndimage
+
+    if channels < 1:
+        raise ValueError(f"channels must be at least 1, got {channels}")
+    depth, height, width = shape
+    rng = np.random.default_rng(seed)
+    radius = cell_diameter / 2
+
+    centres = _cell_centres(rng, height, width, radius, cell_density)
+    labels = np.zeros((height, width), dtype=np.int32)
+    body = np.zeros((height, width), dtype=np.float32)
+    y, x = np.ogrid[:height, :width]
+    for label, (centre_y, centre_x) in enumerate(centres, start=1):
+        # Only the window around the cell is touched, drawing costs the cell area rather than the image area
+        top, bottom = max(0, int(centre_y - radius) - 2), min(height, int(centre_y + radius) + 3)
+        left, right = max(0, int(centre_x - radius) - 2), min(width, int(centre_x + radius) + 3)
+        distance = np.sqrt((y[top:bottom] - centre_y) ** 2 + (x[:, left:right] - centre_x) ** 2)
+        inside = distance <= radius
+        labels[top:bottom, left:right][inside] = label
+        # Bright body, soft edge over a couple of pixels
+        profile = np.clip((radius - distance) / 2, 0, 1) * (0.7 + 0.3 * np.clip(1 - distance / radius, 0, 1))
+        np.maximum(body[top:bottom, left:right], profile.astype(np.float32), out=body[top:bottom, left:right])
+
+    # Cells are brightest in focus, in the middle plane
+    planes = np.arange(depth) - (depth - 1) / 2
+    focus = np.exp(-0.5 * (planes / max(depth / 3, 1)) ** 2).astype(np.float32)
+
+    pits = _pit_positions(rng, labels, len(centres), pits_per_cell, depth)
+    pit_image = np.zeros(shape, dtype=np.float32)
+    if len(pits):
+        np.add.at(pit_image, tuple(pits.T), 1.0)
+        sigma = pit_diameter / (2 * np.sqrt(2))
+        pit_image = ndimage.gaussian_filter(pit_image, sigma=(0.7, sigma, sigma))
+        pit_image /= pit_image.max()
+
+    image = np.empty((channels, *shape), dtype=np.uint16)
+    for channel in range(channels):
+        if channel == 0:
+            signal = body[np.newaxis] * focus[:, np.newaxis, np.newaxis] * brightness
+        else:
+            signal = 0.15 * brightness * body[np.newaxis] * focus[:, np.newaxis, np.newaxis] + brightness * pit_image
+        expected = background + signal
+        counts = rng.poisson(expected) + rng.normal(0, noise * brightness, expected.shape)
+        image[channel] = np.clip(counts, 0, 65535).astype(np.uint16)
+    return SyntheticImage(image, labels, pits)
+
+
+def _cell_centres(rng, height: int, width: int, radius: float, cell_density: float) -> list:
+    count = int(round(cell_density * height * width / (np.pi * radius ** 2)))
+    centres = []
+    # Mostly touching but not overlapping cells, as in a confluent culture; crowded images give up on spacing
+    for _ in range(count * 20):
+        if len(centres) == count:
+            break
+        centre = rng.uniform(0, height), rng.uniform(0, width)
+        if all((centre[0] - y) ** 2 + (centre[1] - x) ** 2 >= (1.8 * radius) ** 2 for y, x in centres):
+            centres.append(centre)
+    return centres
+
+
+def _pit_positions(rng, labels: np.ndarray, cells: int, pits_per_cell: float, depth: int) -> np.ndarray:
+    inside = np.flatnonzero(labels)
+    count = rng.poisson(pits_per_cell * cells) if cells else 0
+    if count == 0 or len(inside) == 0:
+        return np.empty((0, 3), dtype=np.intp)
+    flat = rng.choice(inside, size=count)
+    y, x = np.unravel_index(flat, labels.shape)
+    z = rng.integers(0, depth, size=count)
+    return np.stack([z, y, x], axis=1)
+
+
+def write_czi(path: str, image: np.ndarray, pixel_size_nm: float = 100.0, z_step_nm: float = 500.0) -> str:
+    """
+        Writes a (C, Z, Y, X) stack as a CZI with pylibCZIrw, which the plugin itself does not depend on.
+    """
+    from benchmarks.harness import SkipBenchmark
+
+    try:
+        from pylibCZIrw import czi as pyczi
+    except ImportError:
+        raise SkipBenchmark("writing a CZI needs pylibCZIrw, pip install pylibCZIrw")
+
+    with pyczi.create_czi(path, exist_ok=True) as writer:
+        for channel, planes in enumerate(image):
+            for plane, data in enumerate(planes):
+                writer.write(data=np.ascontiguousarray(data), plane={"C": channel, "Z": plane, "T": 0})
+        writer.write_metadata(document_name="synthetic", channel_names={c: f"C{c}" for c in range(len(image))},
+                              scale_x=pixel_size_nm * 1e-9, scale_y=pixel_size_nm * 1e-9, scale_z=z_step_nm * 1e-9)
+    return path
+
+
+def write_dataset(folder: str, count: int, shape=(1, 512, 512), channels: int = 2, seed: int = 0,
+                  **stack_options) -> list:
+    """
+        Writes count CZIs named synthetic_<index>.czi, image index seeded with seed + index.
+
+        Returns:
+            list -> The written paths.
+    """
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for index in range(count):
+        stack = synthetic_stack(shape, channels, seed=seed + index, **stack_options)
+        paths.append(write_czi(os.path.join(folder, f"synthetic_{index:04d}.czi"), stack.image))
+    return paths
@@ -0,0 +1,210 @@
+"""
+End-to-end throughput of the read -> segment -> measure -> export pipeline on synthetic CZIs.
+
+    python -m benchmarks.throughput --images 8 --sizes 256 512 --workers 1 2 4
+
+Writes --images synthetic files per size, then runs every size and worker count in a fresh process, so peak RSS
+is that of the run alone, and prints a scaling table of files per second, per-stage latency percentiles and peak
+RSS. Files go through cli.process_file with tracing on, and the stage latencies of each file come from the spans
+it recorded. Segmentation uses a randomly initialised network unless --model names a real one, which must be
+available offline. Run from the repository root.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+# The spans recorded by cli.process_file that make up each stage. Spans nest, a stage is the time covered by any
+# of its spans. The table of a sink is written when the run ends, so export is the masks, and the results of
+# txt output.
+STAGES = {
+    "read": ("czi.open", "metadata", "pixel_cache.open", "decode", "decode_file", "pixel_cache.write"),
+    "segment": ("segment",),
+    "measure": ("detect_pits", "region_stats"),
+    "export": ("write_mask", "write_results"),
+}
+PERCENTILES = (50, 95)
+
+
+def peak_rss_mb() -> float:
+    """
+        Peak resident set size of this process in MiB, None where the resource module is missing (Windows).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def stage_seconds(events: list) -> dict:
+    """
+        Seconds spent in each of STAGES by the spans of one file, overlapping spans counted once.
+
+        Parameters:
+            events: list[SpanEvent] -> The spans recorded while the file was processed.
+    """
+    timings = {}
+    for stage, names in STAGES.items():
+        intervals = sorted((event.start_ns, event.start_ns + event.duration_ns) for event in events
+                           if event.name in names)
+        covered = 0
+        end = None
+        for start, stop in intervals:
+            if end is None or start > end:
+                covered += stop - start
+                end = stop
+            elif stop > end:
+                covered += stop - end
+                end = stop
+        timings[stage] = covered / 1e9
+    return timings
+
+
+def run_configuration(input_folder: str, workers: int, model: str, diameter: float, channels: int) -> dict:
+    """
+        Processes every file of input_folder with workers threads, after one untimed file that loads the model.
+
+        Returns:
+            dict -> files, seconds, files_per_second, peak_rss_mb, and per stage the list of seconds per file.
+    """
+    from napari_pitcount_cfim.cli import process_file
+    from napari_pitcount_cfim.cellpose_analysis import model_pool
+    from napari_pitcount_cfim.cellpose_analysis.model_pool import ModelPool
+    from napari_pitcount_cfim.config.settings_structure import CFIMSettings
+    from napari_pitcount_cfim.czi_reader_plugin.metadata_index import set_metadata_index_folder
+    from napari_pitcount_cfim.result_handling.result_table import ResultTableSink
+    from napari_pitcount_cfim.tracing import get_tracer
+
+    from benchmarks.fixtures import random_cellpose_model
+
+    if model == "random":
+        model_pool._model_pool = ModelPool(model_factory=random_cellpose_model)
+    set_metadata_index_folder(None)
+    settings = CFIMSettings()
+    settings.cellpose_settings.diameter = diameter
+    if model != "random":
+        settings.cellpose_settings.model_type = model
+    settings.processing_settings.max_concurrency = workers
+    settings.pit_settings.channel = channels - 1  # The synthetic pits are in the last channel
+    tracer = get_tracer()
+    tracer.enabled = True
+
+    files = sorted(Path(input_folder).glob("*.czi"))
+    with tempfile.TemporaryDirectory(prefix="pitcount-throughput-") as output_folder:
+        output_folder = Path(output_folder)
+        with ResultTableSink(output_folder / "warmup.csv") as sink:
+            process_file(files[0], output_folder, settings, sink=sink)
+        tracer.clear()
+
+        windows = []  # (thread id, start, end) of every file, in perf_counter_ns like the spans
+
+        def process(path):
+            file_start = time.perf_counter_ns()
+            process_file(path, output_folder, settings, sink=sink)
+            windows.append((threading.get_ident(), file_start, time.perf_counter_ns()))
+
+        start = time.perf_counter()
+        with ResultTableSink(output_folder / "results.csv") as sink:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(process, files))
+        seconds = time.perf_counter() - start
+
+    # The spans of a file are the ones its thread recorded while processing it. Their image names can not tell,
+    # spans of masks are named after the mask.
+    events = tracer.drain()
+    timings = [stage_seconds([event for event in events if event.tid == thread and file_start <= event.start_ns <= end])
+               for thread, file_start, end in windows]
+
+    return {
+        "files": len(files),
+        "seconds": seconds,
+        "files_per_second": len(files) / seconds,
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": {stage: [timing[stage] for timing in timings] for stage in STAGES},
+    }
+
+
+def _run_in_subprocess(input_folder: str, workers: int, model: str, diameter: float, channels: int) -> dict:
+    completed = subprocess.run(
+        [sys.executable, "-m", "benchmarks.throughput", "--run-one", input_folder, "--workers", str(workers),
+         "--model", model, "--diameter", str(diameter), "--channels", str(channels)],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    if completed.returncode != 0:
+        raise RuntimeError(f"Run with {workers} workers failed:\n{completed.stderr[-2000:]}")
+    # The result is the last line, everything before is progress printed by the pipeline
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def format_scaling_table(rows: list) -> str:
+    """
+        rows: (size, workers, run_configuration result) tuples.
+    """
+    stage_headers = " ".join(f"{f'{stage} p{PERCENTILES[0]}/p{PERCENTILES[1]}':>20}" for stage in STAGES)
+    lines = [f"{'size':>9} {'workers':>7} {'files':>5} {'files/s':>8} {stage_headers} {'peak RSS':>10}"]
+    for size, workers, result in rows:
+        stages = []
+        for stage in STAGES:
+            low, high = np.percentile(result["stages"][stage], PERCENTILES)
+            stages.append(f"{f'{low * 1000:.0f}/{high * 1000:.0f} ms':>20}")
+        rss = "-" if result["peak_rss_mb"] is None else f"{result['peak_rss_mb']:.0f} MiB"
+        lines.append(f"{size:>9} {workers:>7} {result['files']:>5} {result['files_per_second']:>8.2f} "
+                     f"{' '.join(stages)} {rss:>10}")
+    return "\n".join(lines)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Measure the end-to-end throughput of the pipeline.")
+    parser.add_argument("--images", type=int, default=8, help="Synthetic files per size.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[256, 512], help="Edge length of the images.")
+    parser.add_argument("--planes", type=int, default=1, help="Z planes per image.")
+    parser.add_argument("--channels", type=int, default=2, help="Channels per image, pits are in the last one.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2], help="Files processed at once.")
+    parser.add_argument("--cell-diameter", type=float, default=30.0, help="Cell diameter in pixels.")
+    parser.add_argument("--cell-density", type=float, default=0.3, help="Fraction of the image covered by cells.")
+    parser.add_argument("--noise", type=float, default=0.05, help="Read noise relative to the cell brightness.")
+    parser.add_argument("--model", default="random", help="random, or a Cellpose model type such as cyto3.")
+    parser.add_argument("--json", help="Also write the raw results to this file.")
+    parser.add_argument("--run-one", help=argparse.SUPPRESS)  # Input folder of a single run, used internally
+    parser.add_argument("--diameter", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_one:
+        result = run_configuration(args.run_one, args.workers[0], args.model, args.diameter, args.channels)
+        print(json.dumps(result))
+        return 0
+
+    from benchmarks.synthetic import write_dataset
+
+    rows = []
+    with tempfile.TemporaryDirectory(prefix="pitcount-synthetic-") as folder:
+        for size in args.sizes:
+            input_folder = os.path.join(folder, str(size))
+            print(f"[*] Writing {args.images} synthetic {args.channels}x{args.planes}x{size}x{size} files")
+            write_dataset(input_folder, args.images, (args.planes, size, size), args.channels,
+                          cell_diameter=args.cell_diameter, cell_density=args.cell_density, noise=args.noise)
+            for workers in args.workers:
+                print(f"[*] {size}x{size}, {workers} workers")
+                rows.append((f"{size}x{size}", workers,
+                             _run_in_subprocess(input_folder, workers, args.model, args.cell_diameter,
+                                                args.channels)))
+
+    print(format_scaling_table(rows))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump([{"size": size, "workers": workers, **result} for size, workers, result in rows], file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
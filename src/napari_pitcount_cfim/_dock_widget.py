@@ -1,5 +1,8 @@
+import contextlib
+import logging
+import os
 import pathlib
-from tkinter.messagebox import showinfo
+import time
 from typing import List
 
 import numpy as np
@@ -7,12 +10,19 @@ from qtpy.QtCore import qInstallMessageHandler
 from qtpy.QtWidgets import QPushButton, QProgressBar
 from qtpy.QtWidgets import QWidget, QVBoxLayout, QLayout, QLabel, QGroupBox
 
-from napari_pitcount_cfim.cellpose_analysis.cellpose_user import CellposeUser
+from napari_pitcount_cfim.cellpose_analysis.cellpose_user import CellposeUser, group_into_batches
+from napari_pitcount_cfim.cellpose_analysis.diameter_estimator import DiameterCache, acquisition_info
+from napari_pitcount_cfim.cellpose_analysis.segmentation_cache import SegmentationCache
+from napari_pitcount_cfim.config.settings_io import cache_folder
 from napari_pitcount_cfim.config.settings_handler import SettingsHandler
 from napari_pitcount_cfim.image_handling.image_handler import ImageHandler
+from napari_pitcount_cfim.image_handling.mask_store import MaskStore, downcast_labels
 from napari_pitcount_cfim.loggers import setup_python_logging, setup_thread_exception_hook, qt_message_logger
+from napari_pitcount_cfim.measurement.image_measurement import measure_image
 from napari_pitcount_cfim.result_handling.result_handler import ResultHandler
-from napari_pitcount_cfim.segmentation_worker import SegmentationWorker
+from napari_pitcount_cfim.result_ingestor import ResultIngestor
+from napari_pitcount_cfim.segmentation_scheduler import SegmentationScheduler
+from napari_pitcount_cfim.tracing import configure_tracing, get_tracer, span, traced_image
 
 
 class MainWidget(QWidget):
@@ -28,7 +38,32 @@ class MainWidget(QWidget):
         self.setting_handler = SettingsHandler(parent=self) #1
         self.image_handler = ImageHandler(parent=self, napari_viewer=self.viewer, settings_handler=self.setting_handler)
         self.result_handler = ResultHandler(parent=self)
-        self._workers = []
+        self.thread_scheduler = SegmentationScheduler(parent=self, user_factory=self._make_cellpose_user)
+        self.process_scheduler = None  # Started on the first run with processing_settings.executor "process"
+        self.scheduler = self.thread_scheduler
+        # Finished masks reach the viewer in throttled batches, not one layer per finished worker
+        self._ingestor = ResultIngestor(self._on_segmentation_result, suspend=self._redraws_suspended, parent=self)
+        self._ingestor.flushed.connect(self._on_results_flushed)
+        self._segmentation_cache = None
+        self._diameter_cache = None
+        self._flow_store = None
+        self._mask_store = None
+        self._retired_mask_stores = []  # stores replaced by a settings change, kept while layers show their masks
+        self._layer_mask_stores = {}  # labels layer name -> store of the mask the layer shows
+        self._connect_scheduler(self.thread_scheduler)
+        self._analysis_running = False
+        self._segmenting = False
+        self._completed = 0
+        self._total = 0
+        self._job_sizes = {}
+        self._scale = None
+        self._image_layers = {}  # name -> image layer of the running analysis
+        self._pit_settings = {}
+        self._defer_hidden_layers = False
+        # image name -> {layer name: (layer type, data, mask store, kwargs)} waiting for the image to be shown
+        self._deferred_layers = {}
+        self._watched_layers = set()  # names of image layers whose visibility is followed
+        self.viewer.layers.events.removed.connect(self._on_layer_removed)
 
         layout = QVBoxLayout()
         layout.setSizeConstraint(QLayout.SetFixedSize)
@@ -49,11 +84,21 @@ class MainWidget(QWidget):
         pane.setTitle("Analysis")
         pane.setLayout(QVBoxLayout())
         self.analysis_button = QPushButton("Cellpose all images")
-        self.analysis_button.clicked.connect(self._run_analysis)
+        self.analysis_button.clicked.connect(lambda: self._run_analysis())
+        self.recompute_button = QPushButton("Recompute masks")
+        self.recompute_button.setToolTip("Rebuild the masks with the current thresholds from the kept network "
+                                         "output, without running Cellpose again. The first use keeps the network "
+                                         "output from then on and runs Cellpose once.")
+        self.recompute_button.clicked.connect(lambda: self._run_analysis(recompute=True))
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.clicked.connect(lambda: self.scheduler.cancel_all())
+        self.cancel_button.setEnabled(False)
         self.progress_bar = QProgressBar(self)
         self.progress_bar.setMinimum(0)
 
         pane.layout().addWidget(self.analysis_button)
+        pane.layout().addWidget(self.recompute_button)
+        pane.layout().addWidget(self.cancel_button)
         pane.layout().addWidget(self.progress_bar)
 
         self.layout().addWidget(pane)
@@ -84,27 +129,151 @@ class MainWidget(QWidget):
         self.layout().addWidget(logo_label)
 
 
+    def _connect_scheduler(self, scheduler):
+        scheduler.result.connect(self._ingestor.add)
+        scheduler.job_finished.connect(self._on_job_finished)
+        scheduler.idle.connect(self._on_scheduler_idle)
+
+    def _select_scheduler(self, processing_settings):
+        """
+            Pick the thread or process scheduler as set in the processing settings.
+        """
+        if processing_settings.get("executor") == "process":
+            if self.process_scheduler is None:
+                # Imported on first use, like everything only needed once an analysis runs
+                from napari_pitcount_cfim.segmentation_process_scheduler import ProcessSegmentationScheduler
+
+                # Not a child of the widget, so it is still there to stop its processes when the widget is destroyed
+                self.process_scheduler = ProcessSegmentationScheduler()
+                self._connect_scheduler(self.process_scheduler)
+                self.destroyed.connect(lambda *_, scheduler=self.process_scheduler: scheduler.shutdown())
+            self.process_scheduler.threads_per_worker = processing_settings.get("threads_per_worker")
+            self.process_scheduler.cache = self._segmentation_cache
+            self.process_scheduler.flow_store = self._flow_store
+            self.scheduler = self.process_scheduler
+        else:
+            self.scheduler = self.thread_scheduler
+        self.scheduler.max_concurrency = processing_settings.get("max_concurrency")
+
+    def closeEvent(self, event):
+        self._shutdown_schedulers()
+        super().closeEvent(event)
+
+    def _shutdown_schedulers(self):
+        """
+            Cancel the segmentation threads and stop the worker processes, which would otherwise outlive the widget.
+        """
+        self.thread_scheduler.cancel_all()
+        if self.process_scheduler is not None:
+            self.process_scheduler.shutdown()
+
+    def _make_cellpose_user(self, cellpose_settings):
+        return CellposeUser(cellpose_settings=cellpose_settings, cache=self._segmentation_cache,
+                            diameter_cache=self._diameter_cache, flow_store=self._flow_store)
+
+    def _update_segmentation_cache(self, cache_settings):
+        """
+            Create, resize or drop the segmentation cache to match the settings.
+        """
+        if not cache_settings.get("segmentation_cache"):
+            self._segmentation_cache = None
+            return
+        max_bytes = cache_settings.get("segmentation_cache_max_mb") * 1024 * 1024
+        if self._segmentation_cache is None:
+            folder = cache_folder(self.setting_handler.settings_folder_path, "segmentation")
+            self._segmentation_cache = SegmentationCache(folder, max_bytes)
+        self._segmentation_cache.max_bytes = max_bytes
+
+    def _update_diameter_cache(self, cache_settings):
+        if not cache_settings.get("diameter_cache"):
+            if self._diameter_cache is not None:
+                self._diameter_cache.close()
+            self._diameter_cache = None
+        elif self._diameter_cache is None:
+            folder = cache_folder(self.setting_handler.settings_folder_path, "diameter")
+            self._diameter_cache = DiameterCache(os.path.join(folder, "diameters.json"))
+
+    def _update_flow_store(self, cache_settings):
+        """
+            Create, resize or drop the store of network outputs that masks are recomputed from.
+        """
+        if not cache_settings.get("keep_flows"):
+            self._flow_store = None
+            return
+        max_bytes = cache_settings.get("flow_store_max_mb") * 1024 * 1024
+        if self._flow_store is None:
+            folder = cache_folder(self.setting_handler.settings_folder_path, "flows")
+            self._flow_store = SegmentationCache(folder, max_bytes, store_flows=True)
+        self._flow_store.max_bytes = max_bytes
+
+    def _update_mask_store(self, mask_settings):
+        """
+            Keep the masks of the coming results as set in the mask settings. Masks already shown stay where they are.
+        """
+        storage, folder = mask_settings.get("storage"), mask_settings.get("folder")
+        store = self._mask_store
+        if store is None or store.storage != storage or store.parent_folder != folder:
+            if store is not None:
+                # The shown layers still read their masks from the old store
+                self._retired_mask_stores.append(store)
+                self._close_empty_mask_stores()
+            self._mask_store = MaskStore(storage, folder)
+
+    def _update_ingestor(self, display_settings):
+        """
+            Pace the viewer updates as set in the display settings.
+        """
+        self._ingestor.interval_ms = display_settings.get("update_interval_ms")
+        self._ingestor.max_batch = display_settings.get("max_layers_per_update")
+        self._defer_hidden_layers = display_settings.get("defer_hidden_layers")
+        if not self._defer_hidden_layers:
+            self._show_deferred_layers(list(self._deferred_layers))
+
     def _run_estimate(self, image: np.ndarray = None):
         """
             Mostly for testing, runs Cellpose SizeModel to estimate diameter.
         """
-        user = CellposeUser(cellpose_settings=self.setting_handler.get_settings().get("cellpose_settings"))
-
-        diam = user.estimate_size(image)
+        user = self._make_cellpose_user(self.setting_handler.get_settings().get("cellpose_settings"))
+        try:
+            diam = user.estimate_size(image)
+        finally:
+            user.release()
 
         return diam
 
+    def _acquisitions(self, layers) -> list:
+        """
+            The acquisition settings of each image layer, so the workers can reuse the diameter estimates of earlier
+            images with the same settings. Layers without a pixel size have none.
+        """
+        return [acquisition_info(layer.scale if np.any(layer.scale != 1) else None, layer.metadata)
+                for layer in layers]
 
-
-    def _run_analysis(self):
-        """Run Cellpose segmentation on all images using background threads."""
-        layers = self.image_handler.get_all_images()
+    def _run_analysis(self, recompute: bool = False):
+        """
+            Run Cellpose segmentation on all images, at most max_concurrency at a time.
+            With recompute, masks are only rebuilt from kept flows with the current thresholds, images without
+            kept flows are skipped.
+        """
+        image_layers = self.image_handler.get_all_image_layers()
+        layers = [layer.data for layer in image_layers]
         total = len(layers)
 
         if total == 0:
+            from tkinter.messagebox import showinfo
+
             showinfo("No images loaded")
             return  # No images loaded, nothing to do
 
+        settings = self.setting_handler.get_updated_settings()
+        if recompute and not settings.get("cache_settings").get("keep_flows"):
+            # Nothing kept to recompute from yet, keep the flows from now on and segment once to fill the store
+            print("[*] Recomputing masks needs the network output, cache_settings.keep_flows is now on. "
+                  "Running Cellpose once to keep it.")
+            self.setting_handler.update_setting("cache_settings.keep_flows", True)
+            settings = self.setting_handler.get_updated_settings()
+            recompute = False
+
         self.progress_bar.setMinimum(0)
         self.progress_bar.setMaximum(total)
         self.progress_bar.setValue(0)
@@ -112,50 +281,259 @@ class MainWidget(QWidget):
 
         # Turn off the analysis button
         self.analysis_button.setEnabled(False)
-        self.analysis_button.setText(f"Analyzing {total} images...")
-
-
+        self.recompute_button.setEnabled(False)
+        self.analysis_button.setText(f"{'Recomputing' if recompute else 'Analyzing'} {total} images...")
+        self.cancel_button.setEnabled(True)
 
         # Initialize counter for completed images
         self._completed = 0
+        self._total = total
         scale = self.image_handler.get_scale(0)
-        cellpose_settings = self.setting_handler.get_updated_settings().get("cellpose_settings")
-
-        if cellpose_settings.get("diameter") is None:
-            cellpose_settings["diameter"] = self._run_estimate(image=layers[0])
+        cellpose_settings = settings.get("cellpose_settings")
+        self._update_segmentation_cache(settings.get("cache_settings"))
+        self._update_diameter_cache(settings.get("cache_settings"))
+        self._update_flow_store(settings.get("cache_settings"))
+        self._update_mask_store(settings.get("mask_settings"))
+        self._update_ingestor(settings.get("display_settings"))
+        self._select_scheduler(settings.get("processing_settings"))
+        self.result_handler.result_format = settings.get("file_settings").get("result_format")
+        self._pit_settings = settings.get("pit_settings")
+        if configure_tracing(settings.get("debug_settings")):
+            get_tracer().clear()
+
+        # Without a set diameter the workers estimate one per image, a folder may mix magnifications
+        acquisitions = self._acquisitions(image_layers)
         if scale.shape == (3,):
             scale = scale[1:]
+        self._scale = scale
+
+        # Layer names identify the results, the data arrays have no name
+        image_names = [layer.name for layer in image_layers]
+        self._image_layers = {layer.name: layer for layer in image_layers}
+        self._analysis_running = True
+        self._segmenting = True
+
+        # Gathered here, as layers may only be read on the GUI thread, but decoded and measured by the workers
+        inputs = {name: self._measurement_inputs(name) for name in image_names}
+        pit_settings = dict(self._pit_settings)
+
+        def measure(mask, image_name):
+            return measure_image(mask, image_name, inputs[image_name], pit_settings)
+
+        # Queue same-shaped images in batches, the scheduler only runs max_concurrency batches at once
+        self._job_sizes = {}
+        batches = group_into_batches([data.shape for data in layers], cellpose_settings["image_batch_size"])
+        for batch in batches:
+            batch_settings = {**cellpose_settings, "flows_only": recompute,
+                              "acquisitions": [acquisitions[index] for index in batch]}
+            if len(batch) == 1:
+                job_id = self.scheduler.submit(layers[batch[0]], image_names[batch[0]], batch_settings,
+                                               measure=measure)
+            else:
+                job_id = self.scheduler.submit([layers[index] for index in batch],
+                                               [image_names[index] for index in batch], batch_settings,
+                                               measure=measure)
+            self._job_sizes[job_id] = len(batch)
+
+    def _on_segmentation_result(self, mask, measurement, image_name):
+        """Receive a segmentation result, measured by the worker, from the ingestor and update the viewer/UI."""
+        if mask is None:
+            logging.info(f"No kept flows for {image_name}, run the analysis to segment it")
+            return
+        # Add the segmentation mask as a labels layer (only mask is added, no flows), recomputed masks replace it.
+        # The layer reads the stored copy, the array in memory is dropped once the result is handled.
+        with traced_image(image_name):
+            mask = downcast_labels(mask)
+            name = f"{image_name}_mask"
+            with span("store_mask"):
+                data = self._mask_store.put(name, mask) if self._mask_store is not None else mask
+            self._show_layer("labels", data, name, image_name, mask_store=self._mask_store, scale=self._scale)
+            if measurement is None:
+                return
+            self.result_handler.results[image_name] = measurement.results
+            pits = measurement.pits
+            if pits is not None and self._pit_settings.get("show_points") and pits.shape[1] == np.ndim(mask):
+                self._show_layer("points", pits, f"{image_name}_pits", image_name, scale=self._scale, size=3,
+                                 face_color="yellow")
+
+    def _show_layer(self, layer_type: str, data, name: str, image_name: str = None, mask_store=None, **kwargs):
+        """
+            Adds a labels or points layer, or replaces the data of the layer with that name.
+            With defer_hidden_layers, layers of an image whose layer is hidden wait until it is shown.
 
-        # Define a slot to handle results coming from worker threads
-        def _on_segmentation_result(mask, image_name):
-            """Receive segmentation result from a worker and update the viewer/UI."""
-            # Add the segmentation mask as a labels layer (only mask is added, no flows)
-            self.viewer.add_labels(mask, name=f"{image_name}_mask", scale=scale)
-            # Update progress
-            self._completed += 1
-            self.progress_bar.setValue(self._completed)
-            # If all images are processed, ensure progress bar reaches 100%
-            if self._completed == total:
-                self.progress_bar.setValue(total)
-                self.analysis_button.setEnabled(True)
-                self.analysis_button.setText("Cellpose all images")
-
-        # Launch a worker thread for each image to run Cellpose in parallel
-        for data in layers:
-            # If layers are Napari layer objects, get the numpy data and name
-            image_name = getattr(data, "name", "Image")  # layer.name if available
-            cellpose_user = CellposeUser(cellpose_settings=cellpose_settings)
-
-            worker = SegmentationWorker(data, image_name, cellpose_user)
-            worker.result.connect(_on_segmentation_result)
-            worker.finished.connect(lambda w=worker: self._cleanup_worker(w))
-
-            self._workers.append(worker)
-            worker.start()
-
-
-
-    def _cleanup_worker(self, worker):
-        if worker in self._workers:
-            self._workers.remove(worker)
-        worker.deleteLater()
\ No newline at end of file
+            Parameters:
+                mask_store: MaskStore -> The store data was put in. The versions the layer showed before are
+                            deleted once it shows data.
+        """
+        image_layer = self._image_layers.get(image_name)
+        if self._defer_hidden_layers and image_layer is not None and not image_layer.visible:
+            self._deferred_layers.setdefault(image_name, {})[name] = (layer_type, data, mask_store, kwargs)
+            self._watch_visibility(image_layer)
+            return
+        with span("add_layer", layer_type=layer_type):
+            if name in self.viewer.layers:
+                self.viewer.layers[name].data = data
+            else:
+                getattr(self.viewer, f"add_{layer_type}")(data, name=name, **kwargs)
+        if mask_store is not None:
+            self._release_replaced_masks(name, mask_store)
+
+    def _release_replaced_masks(self, name: str, mask_store):
+        """
+            The layer name shows the latest mask of mask_store now, delete the versions it showed before.
+        """
+        mask_store.release_stale(name)
+        previous = self._layer_mask_stores.get(name)
+        self._layer_mask_stores[name] = mask_store
+        if previous is not None and previous is not mask_store:
+            previous.remove(name)
+            self._close_empty_mask_stores()
+
+    def _on_layer_removed(self, event):
+        name = event.value.name
+        mask_store = self._layer_mask_stores.pop(name, None)
+        if mask_store is None:
+            return
+        waiting = [entry[2] for layers in self._deferred_layers.values() for layer_name, entry in layers.items()
+                   if layer_name == name]
+        if mask_store in waiting:
+            mask_store.release_stale(name)  # The latest version still waits for its image to be shown
+        else:
+            mask_store.remove(name)
+        self._close_empty_mask_stores()
+
+    def _close_empty_mask_stores(self):
+        """
+            Deletes the folders of retired mask stores no layer shows a mask of anymore.
+        """
+        for store in [store for store in self._retired_mask_stores if not len(store)]:
+            self._retired_mask_stores.remove(store)
+            store.close()
+
+    def _watch_visibility(self, image_layer):
+        if image_layer.name in self._watched_layers:
+            return
+        self._watched_layers.add(image_layer.name)
+        image_layer.events.visible.connect(lambda event, name=image_layer.name: self._on_image_visibility(name))
+
+    def _on_image_visibility(self, image_name):
+        layer = self._image_layers.get(image_name)
+        if layer is None or layer.visible:
+            self._show_deferred_layers([image_name])
+
+    def _show_deferred_layers(self, image_names: list):
+        """
+            Adds the layers held back for the images image_names, in one redraw.
+        """
+        deferred = [(image_name, self._deferred_layers.pop(image_name)) for image_name in image_names
+                    if image_name in self._deferred_layers]
+        if not deferred:
+            return
+        with self._redraws_suspended():
+            for image_name, layers in deferred:
+                for name, (layer_type, data, mask_store, kwargs) in layers.items():
+                    self._show_layer(layer_type, data, name, None, mask_store, **kwargs)
+
+    @contextlib.contextmanager
+    def _redraws_suspended(self):
+        """
+            Hold back repaints of the canvas and the layer list while layers go in, they are drawn once afterwards.
+        """
+        qt_viewer = getattr(getattr(self.viewer, "window", None), "_qt_viewer", None)
+        if qt_viewer is None or not qt_viewer.updatesEnabled():
+            yield
+            return
+        qt_viewer.setUpdatesEnabled(False)
+        try:
+            yield
+        finally:
+            qt_viewer.setUpdatesEnabled(True)
+            qt_viewer.update()
+
+    def _channel_layers(self, image_name) -> list:
+        """
+            The image layers of every channel of the file image_name was read from, in channel order.
+            Layers not read by the CZI reader stand alone.
+        """
+        layer = self._image_layers.get(image_name)
+        if layer is None:
+            return []
+        source = layer.metadata.get("SourceFile")
+        if source is None:
+            return [layer]
+        siblings = [other for other in self._image_layers.values()
+                    if other.metadata.get("SourceFile") == source and other.data.shape == layer.data.shape]
+        return sorted(siblings, key=lambda other: other.metadata.get("Channel", 0))
+
+    def _measurement_inputs(self, image_name) -> dict:
+        """
+            What measure_image needs of the layers of image_name. The layer data is handed over undecoded, the
+            worker measuring the mask decodes it.
+        """
+        channel_layers = self._channel_layers(image_name)
+        layer = self._image_layers.get(image_name)
+        metadata = layer.metadata if layer is not None else {}
+        pit_layer = self._pit_layer(layer, channel_layers)
+        return {
+            "file": os.path.basename(metadata.get("SourceFile", "")) or None,
+            "channel": metadata.get("Channel"),
+            "scale": None if self._scale is None else list(self._scale),
+            "intensities": [other.data for other in channel_layers],
+            "pit_image": None if pit_layer is None else pit_layer.data,
+            "pit_scale": None if pit_layer is None else pit_layer.scale,
+            "pit_units": None if pit_layer is None else pit_layer.units,
+        }
+
+    def _pit_layer(self, layer, channel_layers):
+        """
+            The layer pits are counted in, the segmented one or the channel set in the pit settings.
+        """
+        if layer is None or not self._pit_settings.get("enabled"):
+            return None
+        channel = self._pit_settings.get("channel")
+        if channel is None:
+            return layer
+        for other in channel_layers:
+            if other.metadata.get("Channel") == channel:
+                return other
+        logging.warning(f"Pit channel {channel} not found for {layer.name}, pits are not counted")
+        return None
+
+    def _on_job_finished(self, job_id):
+        """Count images of finished jobs, failed and cancelled ones included, so the progress bar always completes."""
+        self._completed += self._job_sizes.pop(job_id, 1)
+        # Shown with the next batch of results, finishing workers don't repaint the bar one by one
+        self._ingestor.schedule()
+
+    def _on_results_flushed(self):
+        self.progress_bar.setValue(self._completed)
+        if self._analysis_running and not self._segmenting and not self._ingestor.pending():
+            self._on_analysis_done()
+
+    def _on_scheduler_idle(self):
+        """The analysis is done once the results still queued for the viewer are in."""
+        self._segmenting = False
+        self._ingestor.schedule()
+
+    def _export_trace(self):
+        """
+            Writes the spans of the finished run as a Chrome trace into the traces cache folder, when tracing is on.
+        """
+        tracer = get_tracer()
+        if not tracer.enabled or not tracer.events():
+            return
+        folder = cache_folder(self.setting_handler.settings_folder_path, "traces")
+        path = tracer.export_chrome_trace(os.path.join(folder, f"trace-{time.strftime('%Y%m%d-%H%M%S')}.json"))
+        tracer.clear()
+        print(f"[*] Trace written to {path}")
+
+    def _on_analysis_done(self):
+        self._analysis_running = False
+        if self._diameter_cache is not None:
+            self._diameter_cache.flush()
+        self._export_trace()
+        self.progress_bar.setValue(self._total)
+        self.analysis_button.setEnabled(True)
+        self.recompute_button.setEnabled(True)
+        self.analysis_button.setText("Cellpose all images")
+        self.cancel_button.setEnabled(False)
@@ -4,15 +4,15 @@ Test script to run Cellpose segmentation on a TIFF file and visualize results in
 
 Modify `TIFF_PATH` below to point to your .tiff file.
 """
-import cellpose.models
-import napari
 import numpy as np
-from cellpose import models
-from cellpose.utils import remove_edge_masks
-from cellpose.dynamics import remove_bad_flow_masks
-import tifffile
 import importlib.resources as pkg_resources
 
+from napari_pitcount_cfim.cellpose_analysis.diameter_estimator import DiameterEstimator
+from napari_pitcount_cfim.cellpose_analysis.model_pool import get_model_pool
+from napari_pitcount_cfim.cellpose_analysis.tiled_segmentation import segment_tiled
+from napari_pitcount_cfim.image_handling.mask_store import downcast_labels
+from napari_pitcount_cfim.tracing import current_image, span
+
 """
 /Lib/site-packages/cellpose/models.py:38
 normalize params = {
@@ -29,13 +29,22 @@ normalize params = {
 """
 
 class CellposeUser:
-    def __init__(self, cellpose_settings = None):
+    def __init__(self, cellpose_settings = None, cache = None, diameter_cache = None, flow_store = None):
         """
         Initialize the CellposeUser class.
 
         Parameters:
-            cellpose_settings: Optional settings for Cellpose.
+            cellpose_settings: Optional settings for Cellpose. With "flows_only" set, images are only segmented
+                               from kept flows and the network is never run. "acquisitions" holds the
+                               acquisition_info of the images of a job, for process_images calls without them.
+            cache: Optional SegmentationCache, hits skip the model entirely.
+            diameter_cache: Optional DiameterCache, for images whose diameter was estimated before.
+            flow_store: Optional SegmentationCache with store_flows set, keeps the network output of every image,
+                        so masks with other thresholds are rebuilt from it without running the network.
         """
+        self.cache = cache
+        self.diameter_cache = diameter_cache
+        self.flow_store = flow_store
         if cellpose_settings:
             self.cellpose_settings = cellpose_settings
         else:
@@ -45,6 +54,20 @@ class CellposeUser:
                 "model_type": "cyto3",
                 "gpu": False,
                 "sharpen_radius": 0,
+                "batch_size": 8,
+                "image_batch_size": 4,
+                "tiled": False,
+                "tile_size": 2048,
+                "tile_overlap": 128,
+                "tile_workers": 1,
+                "diameter_crop_size": 512,
+                "diameter_crops": 4,
+                "diameter_downscale": 2,
+                "diameter_workers": 2,
+                "reuse_similar_diameters": True,
+                "flow_threshold": 0.4,
+                "cellprob_threshold": 0.0,
+                "min_size": 30,
             }
         self.normalize_params = {
             "lowhigh": None,
@@ -59,69 +82,413 @@ class CellposeUser:
         }
 
         try:
-            self.model = models.Cellpose(
-                gpu=self.cellpose_settings["gpu"],
-                model_type=self.cellpose_settings["model_type"],
-                nchan=2
-            )
+            self._model_key = (self.cellpose_settings["model_type"], self.cellpose_settings["gpu"], 2)
         except KeyError as e:
             raise ValueError(f"Invalid cellpose settings: {e}")
+        # Borrowed from the shared pool, so the weights are only loaded once per configuration.
+        self.model = get_model_pool().acquire(*self._model_key)
+
+    def release(self):
+        """
+            Return the borrowed model to the shared pool. The user can not process images afterwards.
+        """
+        if self.model is not None:
+            get_model_pool().release(*self._model_key)
+            self.model = None
+
 
+    def _eval_kwargs(self) -> dict:
+        """
+            Keyword arguments shared by every model.eval call.
+        """
+        return {
+            "batch_size": self.cellpose_settings["batch_size"],
+            "channels": [0, 0],
+            "resample": True,
+            "normalize": self.normalize_params,
+            "invert": False,
+            "diameter": self.cellpose_settings["diameter"],
+            "flow_threshold": self.cellpose_settings["flow_threshold"],
+            "cellprob_threshold": self.cellpose_settings["cellprob_threshold"],
+            "augment": False,
+            "min_size": self.cellpose_settings["min_size"],
+        }
+
+    def _cache_key(self, img: np.ndarray):
+        """
+            Cache key for the image, from its pixels and everything that changes its masks. None without a cache.
+        """
+        if self.cache is None:
+            return None
+        params = {key: value for key, value in self._eval_kwargs().items() if key != "batch_size"}
+        for key in ["model_type", "border_filter", "tiled", "tile_size", "tile_overlap"]:
+            params[key] = self.cellpose_settings[key]
+        return self.cache.make_key(img, params)
+
+    def _flow_key(self, img: np.ndarray):
+        """
+            Flow store key for the image, from everything that changes the network output. The mask thresholds
+            and filters are left out, so masks for any of them are rebuilt from the same flows.
+        """
+        if self.flow_store is None:
+            return None
+        params = {key: value for key, value in self._eval_kwargs().items() if key not in _MASK_PARAMETERS}
+        for key in ["model_type", "tiled", "tile_size", "tile_overlap"]:
+            params[key] = self.cellpose_settings[key]
+        return self.flow_store.make_key(img, params)
+
+    def _result_from_flows(self, key):
+        """
+            Rebuilds (masks, flows, styles, diams) from kept flows with the current thresholds, None without flows.
+        """
+        if key is None:
+            return None
+        kept = self.flow_store.get(key)
+        if kept is None or kept["flows"] is None or kept["diameter"] is None:
+            return None
+        d_p, cell_probability = kept["flows"]
+        masks = self.masks_from_flows(d_p, cell_probability, kept["diameter"])
+        return masks, [None, d_p, cell_probability], None, kept["diameter"]
+
+    def _store_flows(self, key, result):
+        masks, flows, _, diams = result
+        # Tiled segmentation does not stitch flows, those images can not be rebuilt
+        if key is not None and flows is not None and flows[1] is not None and diams is not None:
+            self.flow_store.put(key, masks, flows[1:], float(np.mean(diams)))
+
+    def masks_from_flows(self, d_p: np.ndarray, cell_probability: np.ndarray, diameter: float) -> np.ndarray:
+        """
+            Runs only the mask reconstruction and post-filtering of Cellpose on its network output, with the
+            thresholds of the current settings. Takes a fraction of the time of running the network.
+
+            Parameters:
+                d_p: np.ndarray -> Flow field, (2, Y, X), or (2, Z, Y, X) for stacks segmented per plane.
+                cell_probability: np.ndarray -> Cell probability, (Y, X) or (Z, Y, X).
+                diameter: float -> The diameter the flows were computed with, sets the number of iterations.
+        """
+        from cellpose.dynamics import resize_and_compute_masks
+
+        # Cellpose.eval follows the flows for 200 iterations at the model's mean diameter, scaled to the image
+        niter = 200 * diameter / getattr(self.model, "diam_mean", 30.0)
+        kwargs = {"niter": niter,
+                  "flow_threshold": self.cellpose_settings["flow_threshold"],
+                  "cellprob_threshold": self.cellpose_settings["cellprob_threshold"],
+                  "min_size": self.cellpose_settings["min_size"]}
+        device = getattr(self.model, "device", None)
+        if device is not None:
+            kwargs["device"] = device
+
+        with span("masks_from_flows"):
+            if cell_probability.ndim == 3:
+                masks = np.stack([resize_and_compute_masks(d_p[:, plane], cell_probability[plane], **kwargs)
+                                  for plane in range(cell_probability.shape[0])])
+            else:
+                masks = resize_and_compute_masks(d_p, cell_probability, **kwargs)
+        if self.cellpose_settings["border_filter"]:
+            masks = _remove_edge_masks(masks)
+        return masks
+
+    def _cached_result(self, key):
+        """
+            Returns the cached (masks, flows, styles, diams) for a key, or None on a miss.
+        """
+        if key is None:
+            return None
+        cached = self.cache.get(key)
+        if cached is None:
+            return None
+        # Keep the Cellpose flow layout, [flow image, dP, cellprob], the flow image is not stored
+        flows = None if cached["flows"] is None else [None, *cached["flows"]]
+        diameter = cached["diameter"] if cached["diameter"] is not None else self.cellpose_settings["diameter"]
+        return cached["masks"], flows, None, diameter
+
+    def _store_result(self, key, masks, flows, styles=None, diams=None):
+        if key is not None:
+            self.cache.put(key, masks, flows[1:] if flows is not None else None,
+                           None if diams is None else float(np.mean(diams)))
+
+    def _use_tiles(self, plane: np.ndarray) -> bool:
+        return self.cellpose_settings["tiled"] and max(plane.shape) > self.cellpose_settings["tile_size"]
 
     def run_on_tiff(self, tiff_path: str, output_dir: str = 'cell_crops'):
         """
             Run processing on a TIFF file.
         """
+        import tifffile
+
         img = tifffile.imread(tiff_path)
-        return self.process_image(img, output_dir)
+        return self.process_image(img, return_flows=True)
 
-    def process_image(self, img: np.ndarray):
+    def process_image(self, img: np.ndarray, return_flows: bool = False):
         """
         Run Cellpose segmentation on a numpy array
 
         Parameters:
             img: np.ndarray
-            output_dir: directory to save individual cell crops
+            return_flows: bool -> Also return the flows, see process_images.
         """
         print(f"Dev | Got diameter: {self.cellpose_settings['diameter']}")
 
-        masks_list, flows, styles, diams = self.model.eval(
-            [img],
-            channels=[0, 0],
-            resample=True,
-            normalize=self.normalize_params,
-            invert=False,
-            diameter=self.cellpose_settings["diameter"],
-            flow_threshold=0.4,
-            cellprob_threshold=0.0,
-            augment=False,
-            min_size=30,
+        # The cache and flow store lookups live in process_images, a single image is a batch of one
+        masks_list, flows_list, styles_list, diams_list = self.process_images([img], return_flows=return_flows)
+        return masks_list[0], flows_list[0], styles_list[0], diams_list[0]
 
+    def _segment_image(self, img: np.ndarray, diameter: float = None):
+        plane = _as_plane(img)
+        if diameter is None:
+            diameter = self.estimate_size(img)
+        if plane is not None and self._use_tiles(plane):
+            return self.process_image_tiled(plane, diameter)
 
-        )
+        with span("model.eval", images=1):
+            masks_list, flows, styles, diams = self.model.eval([img], **{**self._eval_kwargs(),
+                                                                          "diameter": diameter})
         masks = np.array(masks_list[0])
 
         if self.cellpose_settings["border_filter"]:
-            masks = remove_edge_masks(masks)
+            masks = _remove_edge_masks(masks)
 
         # masks = remove_bad_flow_masks(masks, flows[0][1])
 
         return masks, flows[0], styles, diams
 
-    def estimate_size(self, img: np.ndarray):
+    def process_images(self, images: list[np.ndarray], acquisitions: list = None, return_flows: bool = False):
         """
-        Estimate the size of the objects in the image.
+        Run Cellpose segmentation on several images, batching same-shaped 2D images into a single model call.
+
+        Images sharing a shape (and diameter) are stacked, up to image_batch_size at a time, so the network runs
+        their tiles together in batches of batch_size. Images that are not single planes, or are large enough to
+        be segmented in tiles, are run one by one.
+
+        Masks come in the smallest label type that holds them. The flows are several times the size of the masks,
+        they are kept in the flow store if there is one and only returned when asked for.
 
         Parameters:
-            img: np.ndarray
+            images: list[np.ndarray]
+            acquisitions: Optional acquisition_info per image, used when the diameters are estimated. Defaults to
+                          the "acquisitions" of the settings.
+            return_flows: bool -> Return the flows, otherwise flows_list holds None for every image.
+
+        Returns:
+            masks_list, flows_list, styles_list, diams_list -> One entry per input image, in input order.
+        """
+        if not images:
+            return [], [], [], []
+        if acquisitions is None:
+            acquisitions = self.cellpose_settings.get("acquisitions")
+        # Layers from read_czi are lazy, this is where their pixels get decoded
+        with span("decode", images=len(images)):
+            images = [np.asarray(img) for img in images]
+        keys = [self._cache_key(img) for img in images]
+        results = [_with_small_labels(self._cached_result(key)) for key in keys]
+
+        # Masks with other thresholds are rebuilt from kept flows, without running the network
+        flow_keys = [self._flow_key(img) if result is None else None for img, result in zip(images, results)]
+        for index, flow_key in enumerate(flow_keys):
+            if results[index] is None:
+                results[index] = _with_small_labels(self._result_from_flows(flow_key))
+                if results[index] is not None:
+                    self._store_result(keys[index], *results[index])
+
+        misses = [index for index, result in enumerate(results) if result is None]
+        if misses and self.cellpose_settings.get("flows_only"):
+            print(f"[!] No kept flows for {len(misses)} images, they are skipped")
+            for index in misses:
+                results[index] = (None, None, None, None)
+        elif misses:
+            segmented = self._segment_images([images[index] for index in misses],
+                                             [acquisitions[index] for index in misses] if acquisitions else None)
+            for index, result in zip(misses, zip(*segmented)):
+                result = _with_small_labels(result)
+                results[index] = result
+                self._store_result(keys[index], *result)
+                self._store_flows(flow_keys[index], result)
+
+        masks_list, flows_list, styles_list, diams_list = (list(values) for values in zip(*results))
+        if not return_flows:
+            # Batched flows are views of one array for the whole batch, which a single kept flow holds on to
+            flows_list = [None] * len(flows_list)
+        return masks_list, flows_list, styles_list, diams_list
+
+    def _segment_images(self, images: list[np.ndarray], acquisitions: list = None):
+        planes = [_as_plane(img) for img in images]
+        diameters = self.estimate_sizes(images, acquisitions)
+
+        masks_list = [None] * len(images)
+        flows_list = [None] * len(images)
+        styles_list = [None] * len(images)
+        diams_list = [None] * len(images)
+
+        for index, plane in enumerate(planes):
+            if plane is None or self._use_tiles(plane):
+                masks_list[index], flows_list[index], styles_list[index], diams_list[index] = \
+                    self._segment_image(images[index], diameters[index])
+
+        plane_indices = [index for index, plane in enumerate(planes)
+                         if plane is not None and not self._use_tiles(plane)]
+        keys = [(planes[index].shape, diameters[index]) for index in plane_indices]
+        for batch in group_into_batches(keys, self.cellpose_settings["image_batch_size"]):
+            batch_indices = [plane_indices[position] for position in batch]
+            stack = np.stack([planes[index] for index in batch_indices])
+            diameter = diameters[batch_indices[0]]
+
+            # Normalization runs inside eval, it is part of this span
+            with span("model.eval", images=len(batch_indices)):
+                masks, flows, styles, diams = self.model.eval(
+                    stack,
+                    **{**self._eval_kwargs(),
+                       "z_axis": 0,
+                       # Each plane is its own image, normalize them separately
+                       "normalize": {**self.normalize_params, "norm3D": False},
+                       "diameter": diameter},
+                )
+
+            # Cellpose squeezes its output, so a batch of one loses the image axis
+            count = len(batch_indices)
+            height, width = stack.shape[1:]
+            masks = np.reshape(masks, (count, height, width))
+            flow_rgb = np.reshape(flows[0], (count, height, width, -1))
+            d_p = np.reshape(flows[1], (2, count, height, width))
+            cell_probability = np.reshape(flows[2], (count, height, width))
+            styles = np.reshape(styles, (count, -1))
+
+            for position, index in enumerate(batch_indices):
+                image_masks = masks[position]
+                if self.cellpose_settings["border_filter"]:
+                    image_masks = _remove_edge_masks(image_masks)
+                masks_list[index] = image_masks
+                flows_list[index] = [flow_rgb[position], d_p[:, position], cell_probability[position]]
+                styles_list[index] = styles[position]
+                diams_list[index] = diams
+
+        return masks_list, flows_list, styles_list, diams_list
+
+    def process_image_tiled(self, plane: np.ndarray, diameter: float = None):
+        """
+        Run Cellpose segmentation on a large YX plane in overlapping tiles, and stitch the labels.
+
+        Peak memory for flows follows the tile size instead of the plane size. Tiles are normalized with
+        percentiles of the whole plane, so intensities match across seams, and the border filter is only
+        applied to the border of the stitched plane. Flows are not stitched and returned as None.
+
+        Parameters:
+            plane: np.ndarray -> The YX image.
+            diameter: float -> Cell diameter in pixels. None uses the settings, or estimates it.
         """
+        tile_size = self.cellpose_settings["tile_size"]
+        if diameter is None:
+            # One estimate for the whole plane, tiles estimating on their own would disagree
+            diameter = self.estimate_size(plane)
 
+        # Cellpose normalizes to the 1st and 99th percentile by default, a subsample is plenty to find them
+        with span("normalize"):
+            stride = max(1, int(np.sqrt(plane.size / 1e6)))
+            low, high = np.percentile(plane[::stride, ::stride], [1, 99])
+        eval_kwargs = {**self._eval_kwargs(),
+                       "normalize": {**self.normalize_params, "lowhigh": (float(low), float(high))},
+                       "diameter": diameter}
+
+        image = current_image()
+
+        def _segment_tile(tile):
+            # Tiles run on their own threads, which do not know the image
+            with span("model.eval", image, images=1, tile=True):
+                masks_list, *_ = self.model.eval([tile], **eval_kwargs)
+            return masks_list[0]
+
+        masks = segment_tiled(plane, _segment_tile, tile_size=tile_size,
+                              overlap=self.cellpose_settings["tile_overlap"],
+                              max_workers=self.cellpose_settings["tile_workers"])
+
+        if self.cellpose_settings["border_filter"]:
+            masks = _remove_edge_masks(masks)
+
+        return masks, None, None, diameter
+
+    def estimate_size(self, img: np.ndarray, acquisition: dict = None):
+        """
+        Estimate the size of the objects in the image, from a few downscaled crops.
+
+        Parameters:
+            img: np.ndarray
+            acquisition: Optional acquisition_info of the image, lets similar images share estimates.
+        """
         if self.cellpose_settings["diameter"] is not None:
             return self.cellpose_settings["diameter"]
-        size_model = self.model.sz
-        diameter = size_model.eval(img, [0, 0], normalize=self.normalize_params)
-        print(f"[*] Estimated diameter: {diameter}")
-        return diameter[0]
+        return self.estimate_sizes([img], [acquisition])[0]
+
+    def estimate_sizes(self, images: list, acquisitions: list = None) -> list[float]:
+        """
+            estimate_size for several images, with the crops of all images measured in parallel.
+        """
+        if self.cellpose_settings["diameter"] is not None:
+            return [self.cellpose_settings["diameter"]] * len(images)
+        diameters = self.diameter_estimator().estimate_many(images, acquisitions)
+        print(f"[*] Estimated diameters: {diameters}")
+        return diameters
+
+    def diameter_estimator(self) -> DiameterEstimator:
+        return DiameterEstimator(self._measure_size,
+                                 crop_size=self.cellpose_settings["diameter_crop_size"],
+                                 crops_per_image=self.cellpose_settings["diameter_crops"],
+                                 downscale_factor=self.cellpose_settings["diameter_downscale"],
+                                 max_workers=self.cellpose_settings["diameter_workers"],
+                                 cache=self.diameter_cache,
+                                 reuse_similar=self.cellpose_settings["reuse_similar_diameters"],
+                                 model_type=self.cellpose_settings["model_type"])
+
+    def _measure_size(self, crop: np.ndarray) -> float:
+        diameter, _ = self.model.sz.eval(crop, [0, 0], normalize=self.normalize_params)
+        return diameter
+
+
+# Only change how masks are built from the network output, not the output itself
+_MASK_PARAMETERS = {"batch_size", "flow_threshold", "cellprob_threshold", "min_size"}
+
+
+def _remove_edge_masks(masks: np.ndarray) -> np.ndarray:
+    # cellpose, and torch with it, is only imported once there are masks, importing this module stays cheap
+    from cellpose.utils import remove_edge_masks
+    with span("edge_filter"):
+        return remove_edge_masks(masks)
+
+
+def _with_small_labels(result):
+    # Batched masks are views of the whole batch as well, downcasting copies each one out of it
+    if result is None or result[0] is None:
+        return result
+    return (downcast_labels(result[0]), *result[1:])
+
+
+def _as_plane(img: np.ndarray):
+    """
+        Returns the image as a single YX plane, or None if it has more than one plane.
+    """
+    squeezed = np.squeeze(img)
+    if squeezed.ndim != 2:
+        return None
+    return squeezed
+
+
+def group_into_batches(keys: list, batch_size: int) -> list[list[int]]:
+    """
+        Groups positions with equal keys, such as image shapes, into batches of at most batch_size.
+        Batches keep the input order within a key, and keys appear in order of first occurrence.
+
+        Returns:
+            list[list[int]] -> Batches of positions into keys.
+    """
+    if batch_size < 1:
+        raise ValueError(f"batch_size must be at least 1, got {batch_size}")
+    buckets = {}
+    for position, key in enumerate(keys):
+        buckets.setdefault(key, []).append(position)
+
+    batches = []
+    for positions in buckets.values():
+        for start in range(0, len(positions), batch_size):
+            batches.append(positions[start:start + batch_size])
+    return batches
 
 
 # if __name__ == '__main__':
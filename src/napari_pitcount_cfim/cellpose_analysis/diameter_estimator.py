@@ -0,0 +1,250 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from napari_pitcount_cfim.image_handling.image_hash import hash_array
+
+# The SizeModel never estimates below 5 pixels, downscaled crops must keep cells above that
+_MIN_ESTIMATE = 5.0
+
+
+def acquisition_info(pixel_size=None, metadata: dict = None) -> dict:
+    """
+        The acquisition settings that make images comparable for diameter estimation.
+
+        Parameters:
+            pixel_size: sequence -> Physical pixel size, the last two entries (Y, X) are used.
+            metadata: dict -> Per channel metadata from read_czi, for the objective and emission wavelength.
+
+        Returns:
+            dict | None -> None without a pixel size, as images can not be compared then.
+    """
+    if pixel_size is None:
+        return None
+    metadata = metadata or {}
+    return {
+        "pixel_size": [round(float(size), 6) for size in list(pixel_size)[-2:]],
+        "objective": metadata.get("Objective"),
+        "emission": metadata.get("EmissionWavelength"),
+    }
+
+
+def sample_crops(plane: np.ndarray, crop_size: int, count: int) -> list[np.ndarray]:
+    """
+        Picks the count crops of a regular grid over the plane with the most contrast, empty background
+        says nothing about the cell size.
+    """
+    height, width = plane.shape
+    if height <= crop_size and width <= crop_size:
+        return [plane]
+
+    ys = np.unique(np.linspace(0, max(0, height - crop_size), num=max(1, -(-height // crop_size))).astype(int))
+    xs = np.unique(np.linspace(0, max(0, width - crop_size), num=max(1, -(-width // crop_size))).astype(int))
+    crops = [plane[y:y + crop_size, x:x + crop_size] for y in ys for x in xs]
+    # Contrast of a strided subsample, ranking does not need every pixel
+    contrast = [float(np.std(crop[::4, ::4])) for crop in crops]
+    order = sorted(range(len(crops)), key=lambda index: -contrast[index])
+    return [crops[index] for index in order[:count]]
+
+
+def downscale(plane: np.ndarray, factor: int) -> np.ndarray:
+    """
+        Block mean downscaling by an integer factor, edges not filling a whole block are dropped.
+    """
+    if factor <= 1:
+        return plane
+    height = plane.shape[0] // factor * factor
+    width = plane.shape[1] // factor * factor
+    blocks = plane[:height, :width].reshape(height // factor, factor, width // factor, factor)
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+
+class DiameterCache:
+    """
+        Diameter estimates stored in a JSON file.
+
+        Estimates are kept per image, keyed by the pixel hash, and per acquisition, keyed by acquisition_info.
+        An image never seen before reuses the median of the last estimates with the same acquisition settings.
+        New estimates are kept in memory and written to the file by flush() or close(), so a batch of images
+        rewrites it once.
+    """
+    def __init__(self, path: str, max_images: int = 10000, history: int = 16):
+        self.path = path
+        self.max_images = max_images
+        self.history = history
+        self._lock = threading.Lock()
+        self._data = self._load()
+        self._dirty = False
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                data = json.load(file)
+            return {"images": dict(data.get("images", {})), "acquisitions": dict(data.get("acquisitions", {}))}
+        except (FileNotFoundError, ValueError, OSError):
+            return {"images": {}, "acquisitions": {}}
+
+    def get_image(self, image_key: str):
+        with self._lock:
+            return self._data["images"].get(image_key)
+
+    def get_similar(self, acquisition_key: str):
+        with self._lock:
+            diameters = self._data["acquisitions"].get(acquisition_key)
+        return float(np.median(diameters)) if diameters else None
+
+    def put(self, image_key: str, diameter: float, acquisition_key: str = None):
+        with self._lock:
+            images = self._data["images"]
+            images.pop(image_key, None)
+            images[image_key] = diameter
+            while len(images) > self.max_images:
+                del images[next(iter(images))]  # Oldest first, dicts keep insertion order
+            if acquisition_key is not None:
+                history = self._data["acquisitions"].setdefault(acquisition_key, [])
+                history.append(diameter)
+                del history[:-self.history]
+            self._dirty = True
+
+    def flush(self):
+        """
+            Write the estimates put since the last flush to the file.
+        """
+        with self._lock:
+            if self._dirty:
+                self._save()
+                self._dirty = False
+
+    def close(self):
+        self.flush()
+
+    def clear(self):
+        with self._lock:
+            self._data = {"images": {}, "acquisitions": {}}
+            self._save()
+            self._dirty = False
+
+    def _save(self):
+        folder = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(folder, exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "w", encoding="utf-8") as file:
+                json.dump(self._data, file)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+class DiameterEstimator:
+    """
+        Estimates cell diameters from a few downscaled crops per image instead of the whole plane.
+
+        Every image is cut into a grid of crops, the crops_per_image with the most contrast are downscaled and
+        measured with size_fn, and the median estimate, scaled back to full resolution, is the image diameter.
+        Crops of all images run in parallel. With a cache, images seen before and, if reuse_similar is set,
+        images with the same acquisition settings skip the estimate entirely.
+    """
+    def __init__(self, size_fn, crop_size: int = 512, crops_per_image: int = 4, downscale_factor: int = 2,
+                 max_workers: int = 2, cache: DiameterCache = None, reuse_similar: bool = True, model_type: str = ""):
+        """
+        Parameters:
+            size_fn: callable -> Takes a YX crop and returns its diameter in pixels. Called from max_workers threads.
+            crop_size: int -> Crop edge length in full resolution pixels.
+            crops_per_image: int -> Number of crops measured per image.
+            downscale_factor: int -> Crops are block averaged by this factor before measuring.
+            max_workers: int -> Number of crops measured in parallel.
+            cache: DiameterCache -> Optional.
+            reuse_similar: bool -> Reuse estimates of other images with the same acquisition settings.
+            model_type: str -> Part of the cache keys, models estimate sizes differently.
+        """
+        if crop_size < 1 or crops_per_image < 1 or downscale_factor < 1 or max_workers < 1:
+            raise ValueError("crop_size, crops_per_image, downscale_factor and max_workers must be at least 1")
+        self.size_fn = size_fn
+        self.crop_size = crop_size
+        self.crops_per_image = crops_per_image
+        self.downscale_factor = downscale_factor
+        self.max_workers = max_workers
+        self.cache = cache
+        self.reuse_similar = reuse_similar
+        self.model_type = model_type
+
+    def estimate(self, img, acquisition: dict = None) -> float:
+        return self.estimate_many([img], [acquisition])[0]
+
+    def estimate_many(self, images: list, acquisitions: list = None) -> list[float]:
+        """
+        Parameters:
+            images: list -> YX images. Z stacks are measured on their middle plane.
+            acquisitions: list -> acquisition_info for each image, or None.
+
+        Returns:
+            list[float] -> One diameter in full resolution pixels per image.
+        """
+        acquisitions = acquisitions or [None] * len(images)
+        planes = [_middle_plane(np.asarray(img)) for img in images]
+        diameters = [None] * len(images)
+        image_keys = [None] * len(images)
+        acquisition_keys = [self._acquisition_key(acquisition) for acquisition in acquisitions]
+
+        if self.cache is not None:
+            for index, plane in enumerate(planes):
+                image_keys[index] = self._image_key(plane)
+                diameters[index] = self.cache.get_image(image_keys[index])
+                if diameters[index] is None and self.reuse_similar and acquisition_keys[index] is not None:
+                    diameters[index] = self.cache.get_similar(acquisition_keys[index])
+
+        jobs = []  # (image index, crop)
+        for index, plane in enumerate(planes):
+            if diameters[index] is None:
+                jobs += [(index, crop) for crop in sample_crops(plane, self.crop_size, self.crops_per_image)]
+
+        if jobs:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                estimates = list(executor.map(self._measure, [crop for _, crop in jobs]))
+            per_image = {}
+            for (index, _), estimate in zip(jobs, estimates):
+                per_image.setdefault(index, []).append(estimate)
+            for index, crop_estimates in per_image.items():
+                diameters[index] = float(np.median(crop_estimates))
+                if self.cache is not None:
+                    self.cache.put(image_keys[index], diameters[index], acquisition_keys[index])
+
+        return diameters
+
+    def _measure(self, crop: np.ndarray) -> float:
+        factor = self.downscale_factor
+        small = downscale(crop, factor)
+        diameter = float(self.size_fn(small)) * factor
+        if diameter <= _MIN_ESTIMATE * factor and factor > 1:
+            # Cells too small to measure downscaled, measure the crop at full resolution
+            diameter = float(self.size_fn(crop))
+        return diameter
+
+    def _image_key(self, plane: np.ndarray) -> str:
+        params = f"{self.model_type}|{self.crop_size}|{self.crops_per_image}|{self.downscale_factor}"
+        return f"{hash_array(plane)}-{hashlib.blake2b(params.encode(), digest_size=8).hexdigest()}"
+
+    def _acquisition_key(self, acquisition: dict):
+        if acquisition is None:
+            return None
+        return json.dumps({"model_type": self.model_type, **acquisition}, sort_keys=True, default=str)
+
+
+def _middle_plane(img: np.ndarray) -> np.ndarray:
+    """
+        Returns a YX image as it is and the middle plane of a ZYX stack.
+    """
+    plane = np.squeeze(img)
+    if plane.ndim == 3:
+        plane = plane[plane.shape[0] // 2]
+    if plane.ndim != 2:
+        raise ValueError(f"Diameter estimation expects a YX plane or ZYX stack, got shape {img.shape}")
+    return plane
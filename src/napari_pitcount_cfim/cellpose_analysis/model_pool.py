@@ -0,0 +1,100 @@
+import threading
+from collections import OrderedDict
+
+
+def _load_cellpose_model(model_type: str, gpu: bool, nchan: int):
+    """
+        Default model factory. Loads the Cellpose weights for the given configuration.
+    """
+    from cellpose import models
+
+    return models.Cellpose(gpu=gpu, model_type=model_type, nchan=nchan)
+
+
+class ModelPool:
+    """
+        Process-wide registry of loaded Cellpose models.
+
+        Models are keyed by (model_type, gpu, nchan) and shared by every borrower asking for the same configuration,
+        so the weights are only loaded once. Borrowed models are reference counted; models nobody borrows stay warm
+        until more than max_models are loaded, at which point the least recently used idle ones are evicted.
+    """
+    def __init__(self, max_models: int = 2, model_factory=None):
+        if max_models < 1:
+            raise ValueError(f"max_models must be at least 1, got {max_models}")
+        self.max_models = max_models
+        self._model_factory = model_factory or _load_cellpose_model
+        self._models = OrderedDict()  # key -> model, least recently used first
+        self._ref_counts = {}
+        # A single lock also serializes loading, so two threads asking for the same model never load it twice.
+        self._lock = threading.Lock()
+
+    def acquire(self, model_type: str, gpu: bool, nchan: int = 2):
+        """
+            Borrow a model, loading it if it is not already in the pool.
+            Every acquire must be matched by a release with the same configuration.
+        """
+        key = (model_type, gpu, nchan)
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                model = self._model_factory(model_type, gpu, nchan)
+                self._models[key] = model
+                self._ref_counts[key] = 0
+            self._models.move_to_end(key)
+            self._ref_counts[key] += 1
+            self._evict_idle()
+            return model
+
+    def release(self, model_type: str, gpu: bool, nchan: int = 2):
+        """
+            Return a borrowed model to the pool. The model stays loaded until it is evicted.
+        """
+        key = (model_type, gpu, nchan)
+        with self._lock:
+            if self._ref_counts.get(key, 0) <= 0:
+                raise KeyError(f"Model {key} is not borrowed from the pool")
+            self._ref_counts[key] -= 1
+            self._evict_idle()
+
+    def clear(self):
+        """
+            Drop every idle model. Borrowed models are kept.
+        """
+        with self._lock:
+            for key in [key for key, count in self._ref_counts.items() if count == 0]:
+                del self._models[key]
+                del self._ref_counts[key]
+
+    def loaded_keys(self) -> list[tuple]:
+        """
+            Keys of the loaded models, least recently used first.
+        """
+        with self._lock:
+            return list(self._models)
+
+    def ref_count(self, model_type: str, gpu: bool, nchan: int = 2) -> int:
+        with self._lock:
+            return self._ref_counts.get((model_type, gpu, nchan), 0)
+
+    def _evict_idle(self):
+        """
+            Evict idle models, least recently used first, until the pool is within max_models.
+            Borrowed models are never evicted, so the pool can temporarily hold more than max_models.
+        """
+        for key in list(self._models):
+            if len(self._models) <= self.max_models:
+                break
+            if self._ref_counts[key] == 0:
+                del self._models[key]
+                del self._ref_counts[key]
+
+
+_model_pool = ModelPool()
+
+
+def get_model_pool() -> ModelPool:
+    """
+        Returns the process-wide model pool.
+    """
+    return _model_pool
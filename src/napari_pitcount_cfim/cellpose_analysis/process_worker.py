@@ -0,0 +1,112 @@
+import os
+import sys
+
+import numpy as np
+
+from napari_pitcount_cfim.image_handling.shared_arrays import SharedArrayHandle, attach_shared_array, \
+    create_shared_array
+
+# Read by torch when it is imported, which happens on the first job, after init_worker has run
+_THREAD_ENV_VARS = ["OMP_NUM_THREADS", "MKL_NUM_THREADS"]
+
+_user_factory = None
+_threads = None
+
+
+def default_user_factory(cellpose_settings, cache=None, flow_store=None):
+    from napari_pitcount_cfim.cellpose_analysis.cellpose_user import CellposeUser
+
+    return CellposeUser(cellpose_settings=cellpose_settings, cache=cache, flow_store=flow_store)
+
+
+def default_threads_per_worker(workers: int) -> int:
+    """
+        An even share of the cores for each of workers processes.
+    """
+    return max(1, (os.cpu_count() or 1) // max(1, workers))
+
+
+def init_worker(threads_per_worker: int, user_factory=None):
+    """
+        Initializer of every segmentation process, runs before its first job.
+
+        Parameters:
+            threads_per_worker: int -> CPU threads the process may use for inference.
+            user_factory: callable -> Takes (cellpose_settings, cache, flow_store) and returns a CellposeUser like
+                          object.
+                          Must be picklable, a module level function or a functools.partial of one.
+    """
+    global _user_factory, _threads
+    _threads = threads_per_worker
+    _user_factory = user_factory or default_user_factory
+    for var in _THREAD_ENV_VARS:
+        os.environ[var] = str(threads_per_worker)
+
+
+def _limit_torch_threads():
+    torch = sys.modules.get("torch")
+    if torch is not None and _threads is not None and torch.get_num_threads() != _threads:
+        torch.set_num_threads(_threads)
+
+
+def segment_images(images: list, cellpose_settings: dict, cache=None, flow_store=None) -> list:
+    """
+        Runs in a segmentation process. The model comes from the process' own model pool, so it is loaded on the
+        first job and reused by the following ones.
+
+        Returns:
+            list -> One mask per image, None for images skipped with flows_only.
+    """
+    user = (_user_factory or default_user_factory)(cellpose_settings, cache, flow_store)
+    try:
+        _limit_torch_threads()
+        if len(images) == 1:
+            masks, *_ = user.process_image(images[0])
+            return [masks]
+        masks_list, *_ = user.process_images(images)
+        return list(masks_list)
+    finally:
+        user.release()
+
+
+def segment_shared(handles: list, output_names: list, cellpose_settings: dict, cache=None, flow_store=None) -> list:
+    """
+        segment_images for images in shared memory. The images are mapped rather than unpickled, and each mask is
+        written to a new segment named after output_names, so only the small handles cross the process boundary.
+
+        Returns:
+            list[SharedArrayHandle] -> One mask per image, None for skipped images. The caller owns and removes
+                                       the segments.
+    """
+    attached = [attach_shared_array(handle) for handle in handles]
+    segments = [segment for segment, _ in attached]
+    images = [image for _, image in attached]
+    del attached
+    try:
+        masks_list = segment_images(images, cellpose_settings, cache, flow_store)
+    finally:
+        # The array views must be gone before the segments can be unmapped
+        del images
+        for segment in segments:
+            _close_quietly(segment)
+
+    output_handles = []
+    for masks, name in zip(masks_list, output_names):
+        if masks is None:
+            output_handles.append(None)
+            continue
+        masks = np.asarray(masks)
+        segment, view = create_shared_array(name, masks.shape, masks.dtype)
+        view[...] = masks
+        del view
+        segment.close()
+        output_handles.append(SharedArrayHandle(name, masks.shape, masks.dtype.str))
+    return output_handles
+
+
+def _close_quietly(segment):
+    try:
+        segment.close()
+    except BufferError:
+        # A traceback still references a view, the mapping goes when the process releases it
+        pass
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+from napari_pitcount_cfim.image_handling.image_hash import hash_array
+
+
+class SegmentationCache:
+    """
+        Content-addressed on-disk cache of segmentation results.
+
+        Entries are keyed by a hash of the image pixels plus every parameter that changes the result, so a hit is
+        only possible for identical input and settings. Masks, and optionally flows, are stored as compressed .npz
+        files. Reading an entry marks it as recently used, and the least recently used entries are deleted once
+        the folder grows past max_bytes.
+    """
+    def __init__(self, folder: str, max_bytes: int = 1024 * 1024 * 1024, store_flows: bool = False):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.store_flows = store_flows
+        os.makedirs(self.folder, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Sent to segmentation processes, the lock only guards this process' view of the folder
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(img: np.ndarray, params: dict) -> str:
+        """
+            Key for an image segmented with the given parameters. Parameters must be JSON serializable.
+        """
+        params_json = json.dumps(params, sort_keys=True, default=str)
+        params_hash = hashlib.blake2b(params_json.encode(), digest_size=8).hexdigest()
+        return f"{hash_array(img)}-{params_hash}"
+
+    def get(self, key: str):
+        """
+            Returns:
+                dict | None -> {"masks": np.ndarray, "flows": [dP, cellprob] or None, "diameter": float or None},
+                               None on a miss.
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                masks = data["masks"]
+                flows = [data["dP"], data["cellprob"]] if "dP" in data else None
+                diameter = float(data["diameter"]) if "diameter" in data else None
+        except (FileNotFoundError, OSError, ValueError, KeyError):
+            # Missing, or evicted or corrupted under our feet; a miss either way
+            return None
+
+        try:
+            os.utime(path)  # Mark as recently used
+        except OSError:
+            pass
+        return {"masks": masks, "flows": flows, "diameter": diameter}
+
+    def put(self, key: str, masks: np.ndarray, flows: list = None, diameter: float = None):
+        """
+            Stores masks, plus the flow field and cell probability from flows ([dP, cellprob]) if store_flows is set,
+            and the diameter the image was segmented with, which masks are rebuilt from the flows with.
+        """
+        arrays = {"masks": np.asarray(masks)}
+        if flows is not None and self.store_flows:
+            arrays["dP"] = np.asarray(flows[0], dtype=np.float32)
+            arrays["cellprob"] = np.asarray(flows[1], dtype=np.float32)
+        if diameter is not None:
+            arrays["diameter"] = np.float64(diameter)
+
+        # Write to a temporary file and rename it in place, so readers never see a half-written entry
+        handle, temp_path = tempfile.mkstemp(dir=self.folder, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as file:
+                np.savez_compressed(file, **arrays)
+            os.replace(temp_path, self._path(key))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self._evict()
+
+    def clear(self):
+        """
+            Deletes every cache entry.
+        """
+        with self._lock:
+            for entry in self._entries():
+                _remove_quietly(entry.path)
+
+    def size_bytes(self) -> int:
+        return sum(entry.stat().st_size for entry in self._entries())
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.folder, f"{key}.npz")
+
+    def _entries(self):
+        return [entry for entry in os.scandir(self.folder) if entry.is_file() and entry.name.endswith(".npz")]
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            for entry in self._entries():
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                _remove_quietly(path)
+                total -= size
+
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,116 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def _axis_tiles(length: int, tile_size: int, overlap: int) -> list[tuple[int, int, int, int]]:
+    """
+        Splits one axis into overlapping tiles.
+
+        Each tile owns a core range, split halfway through the overlap with its neighbours, so the cores cover
+        the axis exactly once.
+
+        Returns:
+            list[tuple] -> (start, stop, core_start, core_stop) for each tile.
+    """
+    if length <= tile_size:
+        return [(0, length, 0, length)]
+
+    step = tile_size - overlap
+    starts = list(range(0, length - tile_size, step)) + [length - tile_size]
+    stops = [start + tile_size for start in starts]
+    seams = [(stops[i] + starts[i + 1]) // 2 for i in range(len(starts) - 1)]
+    core_starts = [0] + seams
+    core_stops = seams + [length]
+    return list(zip(starts, stops, core_starts, core_stops))
+
+
+def iter_tiles(shape: tuple[int, int], tile_size: int, overlap: int):
+    """
+        Yields the tiles covering a YX plane, row by row.
+
+        Yields:
+            tuple -> (tile_slices, core_slices), where core_slices are relative to the tile.
+    """
+    if tile_size < 1:
+        raise ValueError(f"tile_size must be at least 1, got {tile_size}")
+    if not 0 <= overlap < tile_size:
+        raise ValueError(f"overlap must be in [0, tile_size), got {overlap}")
+
+    for y0, y1, core_y0, core_y1 in _axis_tiles(shape[0], tile_size, overlap):
+        for x0, x1, core_x0, core_x1 in _axis_tiles(shape[1], tile_size, overlap):
+            tile_slices = (slice(y0, y1), slice(x0, x1))
+            core_slices = (slice(core_y0 - y0, core_y1 - y0), slice(core_x0 - x0, core_x1 - x0))
+            yield tile_slices, core_slices
+
+
+def _owned_labels(tile_mask: np.ndarray, core_slices: tuple[slice, slice]) -> np.ndarray:
+    """
+        Keeps the objects whose centroid lies in the tile core, relabelled 1..n, and drops the rest.
+        Every object in the overlap is seen by two tiles, but only the tile owning its centroid keeps it.
+    """
+    flat = tile_mask.ravel()
+    max_label = int(flat.max(initial=0))
+    if max_label == 0:
+        return np.zeros(tile_mask.shape, dtype=np.int32)
+
+    rows, cols = np.indices(tile_mask.shape, sparse=True)
+    counts = np.bincount(flat, minlength=max_label + 1)
+    row_sums = np.bincount(flat, weights=np.broadcast_to(rows, tile_mask.shape).ravel(), minlength=max_label + 1)
+    col_sums = np.bincount(flat, weights=np.broadcast_to(cols, tile_mask.shape).ravel(), minlength=max_label + 1)
+
+    present = counts > 0
+    present[0] = False
+    row_centroids = np.divide(row_sums, counts, out=np.full(counts.shape, -1.0), where=present)
+    col_centroids = np.divide(col_sums, counts, out=np.full(counts.shape, -1.0), where=present)
+
+    row_core, col_core = core_slices
+    owned = (present
+             & (row_centroids >= row_core.start) & (row_centroids < row_core.stop)
+             & (col_centroids >= col_core.start) & (col_centroids < col_core.stop))
+
+    relabel = np.zeros(max_label + 1, dtype=np.int32)
+    relabel[owned] = np.arange(1, owned.sum() + 1, dtype=np.int32)
+    return relabel[tile_mask]
+
+
+def segment_tiled(plane: np.ndarray, segment_fn, tile_size: int = 2048, overlap: int = 128, max_workers: int = 1):
+    """
+    Segments a large YX plane tile by tile and stitches the labels into one image with unique global ids.
+
+    Objects are owned by the tile whose core (the tile minus half the overlap on every inner side) contains
+    their centroid, so objects on a seam are kept exactly once, whole. The overlap should be at least one
+    object diameter, otherwise objects on a seam are cut at the tile border.
+
+    Parameters:
+        plane: np.ndarray -> The YX image.
+        segment_fn: callable -> Takes a YX tile and returns its label image. Must not filter edge objects,
+                    the tile edges are not the image border. Called from max_workers threads.
+        tile_size: int -> Tile edge length in pixels.
+        overlap: int -> Overlap between neighbouring tiles in pixels.
+        max_workers: int -> Number of tiles segmented in parallel.
+
+    Returns:
+        np.ndarray -> int32 label image with the shape of plane.
+    """
+    if plane.ndim != 2:
+        raise ValueError(f"Tiled segmentation expects a YX plane, got shape {plane.shape}")
+
+    labels = np.zeros(plane.shape, dtype=np.int32)
+    tiles = list(iter_tiles(plane.shape, tile_size, overlap))
+
+    def _segment(tile):
+        tile_slices, core_slices = tile
+        return _owned_labels(np.asarray(segment_fn(plane[tile_slices])), core_slices)
+
+    next_label = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # map yields in tile order, so the global ids are deterministic however the tiles finish
+        for (tile_slices, _), owned in zip(tiles, executor.map(_segment, tiles)):
+            target = labels[tile_slices]
+            # Neighbouring objects owned by different tiles may overlap slightly, first come keeps the pixel
+            write = (owned > 0) & (target == 0)
+            target[write] = owned[write] + next_label
+            next_label += int(owned.max(initial=0))
+
+    return labels
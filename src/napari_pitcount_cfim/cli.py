@@ -0,0 +1,292 @@
+"""
+Command line entry point, for running the pipeline on whole folders without napari.
+
+    pitcount-cfim batch <input_folder> <output_folder> [--settings-folder FOLDER] [--workers N] [--format csv]
+                  [--trace trace.json]
+    pitcount-cfim purge-cache [--settings-folder FOLDER] [--all]
+
+Nothing here imports napari or Qt, so it runs on headless machines and clusters.
+"""
+import argparse
+import os
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+import tifffile
+
+from napari_pitcount_cfim.cellpose_analysis.diameter_estimator import DiameterCache, acquisition_info
+from napari_pitcount_cfim.cellpose_analysis.segmentation_cache import SegmentationCache
+from napari_pitcount_cfim.config.settings_io import load_settings, default_settings_folder, cache_folder
+from napari_pitcount_cfim.config.settings_structure import CFIMSettings
+from napari_pitcount_cfim.czi_reader_plugin.czi_reader_CFIM import read_czi
+from napari_pitcount_cfim.czi_reader_plugin.metadata_index import set_metadata_index_folder
+from napari_pitcount_cfim.czi_reader_plugin.pixel_cache import PixelCache, configure_pixel_cache, set_pixel_cache
+from napari_pitcount_cfim.measurement.pit_detection import find_cell_pits
+from napari_pitcount_cfim.result_handling.result_table import ResultTableSink, image_row, object_columns
+from napari_pitcount_cfim.result_handling.result_writer import write_results
+from napari_pitcount_cfim.tracing import configure_tracing, get_tracer, span, traced_image
+
+
+def _default_user_factory(cellpose_settings, cache=None, diameter_cache=None):
+    # cellpose imports qtpy when it is installed, so it is only loaded once there is work to do
+    from napari_pitcount_cfim.cellpose_analysis.cellpose_user import CellposeUser
+    return CellposeUser(cellpose_settings=cellpose_settings, cache=cache, diameter_cache=diameter_cache)
+
+
+def load_cli_settings(settings_folder: str = None) -> tuple[CFIMSettings, str]:
+    """
+        Loads the settings YAML from settings_folder, or from PITCOUNT_CFIM_SETTINGS_FOLDER.
+        With neither set the defaults are used, as finding napari's settings folder would import napari.
+
+        Returns:
+            tuple -> (settings, settings folder or None).
+    """
+    if settings_folder is None and not os.getenv("PITCOUNT_CFIM_SETTINGS_FOLDER"):
+        print("[*] No settings folder given, using default settings.")
+        return CFIMSettings(), None
+    settings_folder = settings_folder or default_settings_folder()
+    return load_settings(settings_folder), settings_folder
+
+
+def find_input_files(input_folder: str, pattern: str = "*.czi") -> list[Path]:
+    return sorted(path for path in Path(input_folder).glob(pattern) if path.is_file())
+
+
+def process_file(path: Path, output_folder: Path, settings: CFIMSettings, user_factory=None, cache=None,
+                 diameter_cache=None, sink: ResultTableSink = None) -> dict:
+    """
+    Segments every channel of one file, writing a mask per channel, counts the pits in every cell and returns
+    the results.
+
+    Parameters:
+        path: Path -> The input file.
+        output_folder: Path -> Masks are written here as <file>_C<channel>_mask.tif.
+        settings: CFIMSettings -> Reader and Cellpose settings.
+        user_factory: callable -> Takes (cellpose_settings, cache, diameter_cache) and returns a CellposeUser
+                      like object.
+        cache: SegmentationCache -> Optional, passed on to the user.
+        diameter_cache: DiameterCache -> Optional, passed on to the user.
+        sink: ResultTableSink -> Optional, gets an image row and the object rows of every channel, with the
+              intensities of all channels of the file measured within each mask.
+
+    Returns:
+        dict -> {<file>_C<channel>: result dictionary}.
+    """
+    user_factory = user_factory or _default_user_factory
+    # Every span recorded while the file is processed, in the model pool and the caches too, is for this file
+    with traced_image(path.name):
+        return _process_file(path, output_folder, settings, user_factory, cache, diameter_cache, sink)
+
+
+def _process_file(path: Path, output_folder: Path, settings: CFIMSettings, user_factory, cache, diameter_cache,
+                  sink: ResultTableSink) -> dict:
+    layers = read_czi(str(path), backend=settings.reader_settings.backend,
+                      decode=settings.reader_settings.decode)()
+    # Decoded once, for the segmentation and for measuring every channel within the masks
+    with span("decode", images=len(layers)):
+        images = [np.asarray(data) for data, _, _ in layers]
+
+    user = user_factory(settings.cellpose_settings.model_dump(), cache, diameter_cache)
+    acquisitions = [acquisition_info(metadata.get("scale"), metadata.get("metadata")) for _, metadata, _ in layers]
+    try:
+        with span("segment", images=len(images)):
+            masks_list, _, _, diams_list = user.process_images(images, acquisitions)
+    finally:
+        user.release()
+
+    pit_settings = settings.pit_settings.model_dump()
+    detected_pits = {}  # Pit channel -> pit coordinates, masks of all channels may share one pit channel
+    results = {}
+    objects = []
+    for channel, ((_, metadata, _), masks, diameter) in enumerate(zip(layers, masks_list, diams_list)):
+        name = f"{path.stem}_C{channel}"
+        masks = np.asarray(masks)
+        with span("write_mask", name):
+            tifffile.imwrite(output_folder / f"{name}_mask.tif", masks, compression="zlib")
+
+        pit_labels = None
+        if pit_settings["enabled"]:
+            pit_channel = channel if pit_settings["channel"] is None else pit_settings["channel"]
+            if pit_channel >= len(images):
+                raise ValueError(f"Pit channel {pit_channel} does not exist, the file has {len(images)} channels")
+            pit_metadata = layers[pit_channel][1]
+            pits, pit_labels = find_cell_pits(images[pit_channel], masks, pit_settings, pit_metadata.get("scale"),
+                                              detected_pits.get(pit_channel), units=pit_metadata.get("units"))
+            detected_pits[pit_channel] = pits
+
+        results[name] = {
+            "file": path.name,
+            "channel": channel,
+            "name": metadata.get("name"),
+            "scale": metadata.get("scale"),
+            "units": [str(unit) for unit in metadata.get("units", ())],
+            "cell_count": int(masks.max(initial=0)),
+            "diameter": None if diameter is None else float(np.mean(diameter)),
+            "pit_count": None if pit_labels is None else int(np.count_nonzero(pit_labels)),
+        }
+        if sink is not None:
+            objects.append(object_columns(name, masks, images, pit_labels))
+
+    if sink is not None:
+        # Added once the whole file succeeded, so a failing file leaves no rows behind
+        sink.add_rows([image_row(name, result) for name, result in results.items()])
+        for columns in objects:
+            sink.add_columns(columns, length=len(columns["object_id"]))
+    return results
+
+
+def run_batch(input_folder: str, output_folder: str, settings: CFIMSettings, settings_folder: str = None,
+              workers: int = None, pattern: str = "*.czi", use_cache: bool = True, user_factory=None,
+              result_format: str = None, trace_path: str = None) -> int:
+    """
+        Processes every matching file in input_folder, workers files at a time.
+        The workers share one model through the model pool. A failing file is reported and skipped.
+        Results of all files are streamed into one results.csv or results.parquet table in output_folder, or with
+        result_format "txt" written as one text file per channel. None uses file_settings.result_format.
+        With trace_path, or debug_settings.verbosity_level at TRACE_VERBOSITY, the timing of every stage is
+        written as a Chrome trace to trace_path, or to trace.json in output_folder.
+
+        Returns:
+            int -> Number of files that failed.
+    """
+    files = find_input_files(input_folder, pattern)
+    if not files:
+        print(f"[!] No files matching {pattern} in {input_folder}")
+        return 0
+
+    output_folder = Path(output_folder)
+    output_folder.mkdir(parents=True, exist_ok=True)
+    workers = workers or settings.processing_settings.max_concurrency
+
+    cache = None
+    diameter_cache = None
+    cache_settings = settings.cache_settings
+    if use_cache and settings_folder is not None:
+        if cache_settings.segmentation_cache:
+            cache = SegmentationCache(cache_folder(settings_folder, "segmentation"),
+                                      cache_settings.segmentation_cache_max_mb * 1024 * 1024)
+        if cache_settings.diameter_cache:
+            diameter_cache = DiameterCache(os.path.join(cache_folder(settings_folder, "diameter"), "diameters.json"))
+        set_metadata_index_folder(cache_folder(settings_folder, "metadata"))
+        configure_pixel_cache(cache_settings.model_dump(), settings_folder)
+    else:
+        set_pixel_cache(None)
+
+    result_format = result_format or settings.file_settings.result_format
+    sink = None
+    if result_format != "txt":
+        sink = ResultTableSink(output_folder / f"results.{result_format}", result_format)
+
+    if trace_path is not None:
+        get_tracer().enabled = True
+    else:
+        configure_tracing(settings.debug_settings.model_dump())
+    get_tracer().clear()
+
+    print(f"[*] Processing {len(files)} files with {workers} workers")
+    failed = 0
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(process_file, path, output_folder, settings, user_factory, cache,
+                                       diameter_cache, sink): path
+                       for path in files}
+            for done, future in enumerate(as_completed(futures), start=1):
+                path = futures[future]
+                try:
+                    results = future.result()
+                    if sink is None:
+                        write_results(results, output_folder)
+                    print(f"[*] {done}/{len(files)} {path.name}")
+                except Exception as e:
+                    failed += 1
+                    print(f"[!] {done}/{len(files)} {path.name} failed: {e}")
+    except BaseException:
+        if sink is not None:
+            sink.abort()
+        raise
+    finally:
+        if diameter_cache is not None:
+            diameter_cache.close()
+    if sink is not None:
+        sink.close()
+        print(f"[*] Results written to {sink.path}")
+    if get_tracer().enabled:
+        trace_path = get_tracer().export_chrome_trace(trace_path or output_folder / "trace.json")
+        print(f"[*] Trace written to {trace_path}")
+    return failed
+
+
+def _batch_command(args) -> int:
+    settings, settings_folder = load_cli_settings(args.settings_folder)
+    failed = run_batch(args.input_folder, args.output_folder, settings, settings_folder=settings_folder,
+                       workers=args.workers, pattern=args.pattern, use_cache=not args.no_cache,
+                       result_format=args.format, trace_path=args.trace)
+    return 1 if failed else 0
+
+
+def _purge_cache_command(args) -> int:
+    try:
+        # Without a folder given this is napari's settings folder, like the widget uses
+        settings_folder = args.settings_folder or default_settings_folder()
+    except ImportError:
+        print("[!] The caches are kept in the settings folder, give it with --settings-folder or "
+              "$PITCOUNT_CFIM_SETTINGS_FOLDER")
+        return 1
+    print(f"[*] Settings folder {settings_folder}")
+    if args.all:
+        folder = cache_folder(settings_folder)
+        freed = sum(os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(folder) for file in files)
+        shutil.rmtree(folder, ignore_errors=True)
+        print(f"[*] Removed every cache in {folder}, {freed / 1024 / 1024:.1f} MiB freed")
+        return 0
+    # Entries of both storages are removed, the storage only decides how new entries are written
+    folder = cache_folder(settings_folder, "pixels")
+    if not os.path.isdir(folder):
+        print(f"[*] No pixel cache in {folder}")
+        return 0
+    freed = PixelCache(folder, storage="memmap").clear()
+    print(f"[*] Purged the pixel cache in {folder}, {freed / 1024 / 1024:.1f} MiB freed")
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="pitcount-cfim", description="Headless napari-pitcount-cfim pipeline.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    batch = subparsers.add_parser("batch", help="Segment every file in a folder.")
+    batch.add_argument("input_folder")
+    batch.add_argument("output_folder")
+    batch.add_argument("--settings-folder", default=None,
+                       help="Folder holding the settings YAML. Defaults to $PITCOUNT_CFIM_SETTINGS_FOLDER.")
+    batch.add_argument("--workers", type=int, default=None,
+                       help="Files processed at once. Defaults to processing_settings.max_concurrency.")
+    batch.add_argument("--pattern", default="*.czi", help="Glob for the input files.")
+    batch.add_argument("--format", choices=["csv", "parquet", "txt"], default=None,
+                       help="Result table format. Defaults to file_settings.result_format.")
+    batch.add_argument("--no-cache", action="store_true",
+                       help="Do not use the segmentation, diameter and pixel caches.")
+    batch.add_argument("--trace", default=None, metavar="PATH",
+                       help="Write the timing of every stage as Chrome trace JSON to PATH.")
+    batch.set_defaults(func=_batch_command)
+
+    purge = subparsers.add_parser("purge-cache", help="Delete the cached decoded pixels of opened files.")
+    purge.add_argument("--settings-folder", default=None,
+                       help="Folder holding the settings YAML. Defaults to $PITCOUNT_CFIM_SETTINGS_FOLDER, "
+                            "then to napari's settings folder.")
+    purge.add_argument("--all", action="store_true",
+                       help="Also delete the segmentation, diameter and metadata caches.")
+    purge.set_defaults(func=_purge_cache_command)
+
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,12 +6,10 @@ import yaml
 from pydantic import BaseModel, ValidationError
 from qtpy.QtWidgets import QGroupBox, QWidget, QVBoxLayout, QPushButton
 
-from napari.settings import get_settings
-
+from napari_pitcount_cfim.config.settings_io import base_name, settings_file_name, default_settings_folder, \
+    _migrate_settings_if_needed
 from napari_pitcount_cfim.config.settings_structure import CFIMSettings
 
-base_name = "napari_pitcount_cfim"
-
 class SettingsHandler(QWidget):
     def __init__(self, path=None, parent=None, debug=True):
         super().__init__(parent=parent)
@@ -24,7 +22,7 @@ class SettingsHandler(QWidget):
 
         if debug: print(f"Debug | Settings folder path: {self.settings_folder_path}")
 
-        self.settings_name = f"{base_name}_settings.yaml"
+        self.settings_name = settings_file_name
 
         self.settings_file_path = os.path.join(self.settings_folder_path, self.settings_name)
 
@@ -33,9 +31,7 @@ class SettingsHandler(QWidget):
             self._make_settings_file()
 
     def _init_settings_file_path(self):
-        napari_settings_path = get_settings().config_path
-        if self.debug: print(f"Debug | Napari settings path: {napari_settings_path}")
-        self.settings_folder_path = os.path.dirname(os.path.abspath(napari_settings_path))
+        self.settings_folder_path = default_settings_folder()
 
 
     def init_ui(self):
@@ -141,31 +137,3 @@ class SettingsHandler(QWidget):
         os.makedirs(folder, exist_ok=True)
         with open(self.settings_file_path, "w") as file:
             yaml.dump(self.settings.model_dump(), file, sort_keys=False)
-
-
-def _deep_merge(defaults: dict, user_data: dict) -> dict:
-    """
-    Recursively merge user_data into defaults without overwriting existing keys.
-    """
-    result = defaults.copy()
-    for key, value in user_data.items():
-        if isinstance(value, dict) and isinstance(result.get(key), dict):
-            result[key] = _deep_merge(result[key], value)
-        else:
-            result[key] = value
-    return result
-
-def _migrate_settings_if_needed(data: dict) -> tuple[dict, bool]:
-    version = data.get("version", "0.0")
-    newest_version = CFIMSettings.__version__
-    if version == newest_version:
-        return data, False
-
-    print(f"[*] Detected settings version {version}, upgrading to {newest_version}")
-
-    defaults = CFIMSettings().model_dump()
-    merged = _deep_merge(defaults, data)
-    merged["version"] = newest_version
-
-    return merged, True
-
@@ -0,0 +1,89 @@
+import os
+
+import yaml
+from pydantic import ValidationError
+
+from napari_pitcount_cfim.config.settings_structure import CFIMSettings
+
+base_name = "napari_pitcount_cfim"
+settings_file_name = f"{base_name}_settings.yaml"
+
+
+def default_settings_folder() -> str:
+    """
+        The folder holding the settings file, next to napari's own settings.
+        PITCOUNT_CFIM_SETTINGS_FOLDER overrides it, which also avoids importing napari to find it.
+    """
+    folder = os.getenv("PITCOUNT_CFIM_SETTINGS_FOLDER")
+    if folder:
+        return os.path.expanduser(folder)
+
+    from napari.settings import get_settings
+
+    return os.path.dirname(os.path.abspath(get_settings().config_path))
+
+
+def cache_folder(settings_folder: str = None, name: str = "") -> str:
+    """
+        Folder for a named on-disk cache, kept under the settings folder.
+    """
+    settings_folder = settings_folder or default_settings_folder()
+    return os.path.join(settings_folder, f"{base_name}_cache", name)
+
+
+def load_settings(folder: str = None) -> CFIMSettings:
+    """
+        Reads and validates the settings file without Qt, for code running outside the widget.
+        Outdated files are migrated in memory only, writing the file is left to SettingsHandler.
+        Falls back to the defaults if the file is missing or invalid.
+    """
+    folder = folder or default_settings_folder()
+    path = os.path.join(folder, settings_file_name)
+    if os.path.exists(path):
+        with open(path, "r") as file:
+            try:
+                raw_data = yaml.safe_load(file)
+                data, _ = _migrate_settings_if_needed(raw_data)
+                settings = CFIMSettings(**data)
+                settings.model_post_init(None)
+                return settings
+            except (yaml.YAMLError, ValidationError) as e:
+                print(f"[!] Failed to load or validate settings: {e}")
+
+    print("[*] Using default settings.")
+    return CFIMSettings()
+
+
+def _deep_merge(defaults: dict, user_data: dict) -> dict:
+    """
+    Recursively merge user_data into defaults without overwriting existing keys.
+    """
+    result = defaults.copy()
+    for key, value in user_data.items():
+        if isinstance(value, dict) and isinstance(result.get(key), dict):
+            result[key] = _deep_merge(result[key], value)
+        else:
+            result[key] = value
+    return result
+
+def _migrate_settings_if_needed(data: dict) -> tuple[dict, bool]:
+    version = data.get("version", "0.0")
+    newest_version = CFIMSettings.__version__
+    if version == newest_version:
+        return data, False
+
+    print(f"[*] Detected settings version {version}, upgrading to {newest_version}")
+
+    cache_settings = data.get("cache_settings")
+    if isinstance(cache_settings, dict) and "cache_flows" in cache_settings:
+        # cache_flows was dropped, flows are only kept by the flow store of keep_flows
+        cache_settings = dict(cache_settings)
+        cache_flows = cache_settings.pop("cache_flows")
+        cache_settings["keep_flows"] = bool(cache_settings.get("keep_flows") or cache_flows)
+        data = {**data, "cache_settings": cache_settings}
+
+    defaults = CFIMSettings().model_dump()
+    merged = _deep_merge(defaults, data)
+    merged["version"] = newest_version
+
+    return merged, True
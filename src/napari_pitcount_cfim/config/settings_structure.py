@@ -1,5 +1,5 @@
 import os
-from typing import Optional
+from typing import Literal, Optional
 
 from pydantic import BaseModel, Field
 
@@ -30,6 +30,8 @@ class FileSettings(BaseModel):
     """
     input_folder: str = Field(default_factory=get_default_input_folder, description="Folder containing the input files.")
     output_folder: str = Field(default_factory=get_default_output_folder, description="Folder to save the output files.")
+    result_format: Literal["txt", "csv", "parquet"] = Field(default="csv",
+        description="csv or parquet write all results to one table, txt one text file per image. parquet needs pyarrow.")
 
     # Attempted virtual fields
     debug: Optional[bool] = Field(default=None, exclude=True)
@@ -46,23 +48,110 @@ class CellposeSettings(BaseModel):
     model_type: str = Field(default="cyto3")
     gpu: bool = Field(default=False)
     sharpen_radius: int = Field(default=0)
+    batch_size: int = Field(default=8, ge=1, description="Number of network tiles run in one forward pass.")
+    image_batch_size: int = Field(default=4, ge=1, description="Number of same-sized images segmented in one model call.")
+    tiled: bool = Field(default=False, description="Segment images larger than tile_size in overlapping tiles.")
+    tile_size: int = Field(default=2048, ge=64, description="Tile edge length in pixels.")
+    tile_overlap: int = Field(default=128, ge=0, description="Tile overlap in pixels, at least one cell diameter.")
+    tile_workers: int = Field(default=1, ge=1, description="Number of tiles segmented in parallel.")
+    diameter_crop_size: int = Field(default=512, ge=64, description="Edge length of the crops the diameter is estimated on.")
+    diameter_crops: int = Field(default=4, ge=1, description="Number of crops per image the diameter is estimated on.")
+    diameter_downscale: int = Field(default=2, ge=1, description="Downscaling factor of the crops before estimating.")
+    diameter_workers: int = Field(default=2, ge=1, description="Number of crops estimated in parallel.")
+    reuse_similar_diameters: bool = Field(default=True, description="Reuse estimates of images with the same pixel size, objective and emission.")
+    flow_threshold: float = Field(default=0.4, ge=0, description="Maximum flow error of a mask, higher keeps more masks. Changing it only rebuilds the masks from kept flows.")
+    cellprob_threshold: float = Field(default=0.0, ge=-6, le=6, description="Cell probability threshold, lower gives more and larger masks. Changing it only rebuilds the masks from kept flows.")
+    min_size: int = Field(default=30, ge=-1, description="Masks with fewer pixels are removed, -1 keeps all.")
 
     # Attempted virtual fields
     debug: Optional[bool] = Field(default=None, exclude=True)
 
 
+class PitSettings(BaseModel):
+    """
+        Settings for detecting and counting pits in the segmented cells.
+    """
+    enabled: bool = Field(default=True, description="Count pits per cell after segmentation.")
+    channel: Optional[int] = Field(default=None, ge=0, description="Channel of the file pits are detected in. None uses the segmented channel.")
+    pit_diameter_nm: float = Field(default=400.0, gt=0, description="Pit diameter, sets the filter size for images with a pixel size.")
+    pit_diameter_px: float = Field(default=3.0, gt=0, description="Pit diameter in pixels, for images without a pixel size.")
+    threshold: float = Field(default=5.0, gt=0, description="Detection threshold in noise standard deviations of the filtered image.")
+    min_distance: int = Field(default=2, ge=1, description="Minimum distance in pixels between two pits.")
+    show_points: bool = Field(default=True, description="Add the detected pits to the viewer as a points layer.")
+
+
+class ReaderSettings(BaseModel):
+    """
+        Settings for reading CZI files.
+    """
+    backend: Literal["aicsimageio", "aicspylibczi"] = Field(default="aicsimageio",
+        description="aicsimageio, or aicspylibczi to read subblocks directly, which supports scene, tile and region reads.")
+    decode: Literal["file", "plane"] = Field(default="plane",
+        description="plane decodes plane by plane as needed, so opening a file only decodes what napari shows. file decodes all channels and planes of a file in one pass when one of them is first needed, the channel layers are views into that buffer, which makes opening large files slow.")
+
+
+class CacheSettings(BaseModel):
+    """
+        Settings for the on-disk caches kept in the settings folder.
+    """
+    segmentation_cache: bool = Field(default=True, description="Reuse masks of images segmented before with the same settings.")
+    segmentation_cache_max_mb: int = Field(default=1024, ge=0, description="Size cap of the segmentation cache.")
+    diameter_cache: bool = Field(default=True, description="Remember estimated diameters per image and acquisition settings.")
+    keep_flows: bool = Field(default=False, description="Keep the network output, so masks for new thresholds are recomputed without running the network. Turned on by the first use of Recompute masks.")
+    flow_store_max_mb: int = Field(default=2048, ge=0, description="Size cap of the kept flows.")
+    pixel_cache: bool = Field(default=False, description="Keep the decoded pixels of opened CZI files, so reopening a file skips decompressing it. Filled when a file is decoded in one pass, with reader_settings.decode file.")
+    pixel_cache_max_mb: int = Field(default=4096, ge=0, description="Size cap of the pixel cache, least recently opened files are dropped first.")
+    pixel_cache_storage: Literal["memmap", "zarr"] = Field(default="memmap",
+        description="Uncompressed memory-mapped files, or compressed chunked zarr arrays, which need the zarr extra.")
+
+
+class MaskSettings(BaseModel):
+    """
+        Settings for keeping the finished masks of the viewer.
+    """
+    storage: Literal["memory", "memmap", "zarr"] = Field(default="memmap",
+        description="Keep the masks in memory, or on disk as memory-mapped files or compressed zarr arrays, which napari reads as needed.")
+    folder: Optional[str] = Field(default=None, description="Folder for the masks kept on disk. None uses the system temp folder.")
+
+
+class DisplaySettings(BaseModel):
+    """
+        Settings for adding results to the viewer.
+    """
+    update_interval_ms: int = Field(default=100, ge=0, description="Finished masks are collected and added to the viewer at most this often.")
+    max_layers_per_update: int = Field(default=8, ge=1, description="Masks added to the viewer per update at most, the rest wait for the next one.")
+    defer_hidden_layers: bool = Field(default=False, description="Add the layers of hidden images only once the image is shown. Cells are still measured right away.")
+
+
+class ProcessingSettings(BaseModel):
+    """
+        Settings for scheduling the segmentation work.
+    """
+    max_concurrency: int = Field(default=2, ge=1, description="Maximum number of images segmented at the same time.")
+    executor: Literal["thread", "process"] = Field(default="thread",
+                                                   description="Segment in threads of the napari process, or in worker processes.")
+    threads_per_worker: Optional[int] = Field(default=None, ge=1,
+                                              description="CPU threads per worker process. None splits the cores evenly.")
+
+
 class CFIMSettings(BaseModel):
     """
         Settings for the napari pitcount CFIM plugin.
 
         Update the version number here after a change.
     """
-    __version__: str = "0.7.6"
+    __version__: str = "0.8.14"
 
     version: str = Field(default=__version__)
     automation_settings: AutomationSettings = AutomationSettings()
     file_settings: FileSettings = FileSettings()
+    reader_settings: ReaderSettings = ReaderSettings()
     cellpose_settings: CellposeSettings = CellposeSettings()
+    pit_settings: PitSettings = PitSettings()
+    processing_settings: ProcessingSettings = ProcessingSettings()
+    cache_settings: CacheSettings = CacheSettings()
+    mask_settings: MaskSettings = MaskSettings()
+    display_settings: DisplaySettings = DisplaySettings()
     debug_settings: DebugSettings = DebugSettings()
 
     def model_post_init(self, _context):
@@ -1,9 +1,9 @@
 import warnings
 
 import numpy as np
-import pint
-from scipy.interpolate import interp1d
 
+from napari_pitcount_cfim.czi_reader_plugin.metadata_index import get_metadata_index, get_unit_registry, \
+    index_metadata
 from napari_pitcount_cfim.library_workarounds.RangeDict import RangeDict
 
 
@@ -21,14 +21,6 @@ def recursive_find(element, tag, num):
             return result
     return None
 
-def find_in_xml_tree(xml_tree, tag):
-    """
-        Finds all occurrences of a tag in an XML tree.
-        Returns a list of elements.
-    """
-    elements = xml_tree.findall(f".//{tag}")
-    return elements
-
 # region Wavelength and color
 wavelength_to_color = RangeDict(
             [(380, 450, "Violet"),
@@ -40,6 +32,8 @@ wavelength_to_color = RangeDict(
              (625, 740, "Red")])
 
 def generate_gamma_dict():
+    from scipy.interpolate import interp1d  # Only needed here, scipy.interpolate is slow to import
+
     # Tabulated wavelengths (nm) and corresponding V(λ) values
     wavelengths = np.array([380, 400, 420, 440, 460, 480, 500, 520, 540, 555, 580, 600, 620, 640, 660, 680, 700, 780])
     V_values = np.array(
@@ -106,7 +100,7 @@ def compute_napari_gamma(color_name_list, gamma_default=1.0, correction_weight=0
 
 # endregion
 
-def extract_key_metadata(reader, channels):
+def extract_key_metadata(reader, channels, path=None):
     """
     Extracts specified metadata from reader.metadata and returns it as a list of dictionaries.
     With index being a dictionary for each channel.
@@ -114,51 +108,45 @@ def extract_key_metadata(reader, channels):
     Parameters:
         reader: A CziReader instance that already has its metadata loaded.
         channels: int -> The number of channels in the image.
+        path: str -> The file the reader was opened on. With a path the metadata index is used, so the XML of
+                     files read before is not parsed again.
 
     Returns:
         dict_list -> A list of dictionaries with the metadata for each channel.
     """
-    # Defining the keys to extract from the metadata; TODO: Add to settings, to allow user to select which keys for UI.
-    keys = ["EmissionWavelength", "DefaultScalingUnit"]
-
-    # Get the xml metadata from the reader
-    xml_metadata = reader.metadata
-    key_dict = {}
-    for key in keys:
-        data = find_in_xml_tree(xml_metadata, key)
-        if data:
-            key_dict[key] = data
-        else:
+    # All fields come from one walk over the XML; TODO: Add to settings, to allow user to select which keys for UI.
+    if path is not None:
+        record = get_metadata_index().get(path, lambda: reader.metadata)
+    else:
+        record = index_metadata(reader.metadata)
+
+    key_dict = {"EmissionWavelength": list(record.emission_wavelengths),
+                "DefaultScalingUnit": [record.default_scaling_unit] if record.default_scaling_unit else []}
+    for key, data in key_dict.items():
+        if not data:
             print(f"No metadata found for {key}")
-            key_dict[key] = None
 
     # region scaling
-    try:
-        default_scaling_unit = key_dict["DefaultScalingUnit"]
-        if not default_scaling_unit:
-            raise KeyError(f"Default scaling unit is {default_scaling_unit}")
-        original_units = default_scaling_unit[0].text
-    except KeyError:
+    original_units = record.default_scaling_unit
+    if not original_units:
         warnings.warn("No OriginalUnits found. Assuming micrometre(µm)")
         original_units = "micrometre"
 
-    pint_unit_register = pint.UnitRegistry()
+    unit_registry = get_unit_registry()
+    z_size, y_size, x_size = record.physical_pixel_sizes
     if original_units == "micrometre" or original_units == "µm":
-        z_scale = reader.physical_pixel_sizes.Z
-        if z_scale == 0:
-            nm_scale = (reader.physical_pixel_sizes.Y, reader.physical_pixel_sizes.X)
+        if not z_size:
+            nm_scale = (y_size, x_size)
         else:
-            nm_scale = (reader.physical_pixel_sizes.Z, reader.physical_pixel_sizes.Y, reader.physical_pixel_sizes.X)
+            nm_scale = (z_size, y_size, x_size)
         scale = [s * 1000 for s in nm_scale]
-        pint_units = pint_unit_register("nm")
+        pint_units = unit_registry("nm")
         units = (pint_units, pint_units, pint_units)
     else:
-        scale = reader.physical_pixel_sizes
-        pint_units = pint_unit_register(original_units)
+        scale = record.physical_pixel_sizes
+        pint_units = unit_registry(original_units)
         units = (pint_units, pint_units, pint_units)
 
-
-
     # endregion
 
     # Here reformat the metadata into a dictionary with a list size of channels.
@@ -166,13 +154,13 @@ def extract_key_metadata(reader, channels):
     for key, data in key_dict.items():
         if data:
             if len(data) == 1:
-                channel_metadata[key] = [data[0].text for _ in range(channels)]
+                channel_metadata[key] = [data[0] for _ in range(channels)]
                 continue
             elif len(data) < channels:
                 raise ValueError(f"Expected {channels} values for {key}, got {len(data)}")
                 # This is mostly to filter out the weird Airy scans.
 
-            channel_metadata[key] = [data[i].text for i in range(channels)]
+            channel_metadata[key] = [data[i] for i in range(channels)]
 
     # Fun side project. # TODO: Add to settings. And take max channel from the max wavelength.
     try:
@@ -187,6 +175,8 @@ def extract_key_metadata(reader, channels):
         metadata_metadata = {}
         for key in channel_metadata:
             metadata_metadata[key] = channel_metadata[key][channel]
+        if record.objective:
+            metadata_metadata["Objective"] = record.objective
 
         if napari_gamma_dict:
             colormap = wavelength_colors[channel]
@@ -1,9 +1,108 @@
 import os
+import threading
+import weakref
 
+import dask.array as da
+import numpy as np
 from aicsimageio.readers import CziReader
 
+from napari_pitcount_cfim.config.settings_io import load_settings
 from napari_pitcount_cfim.czi_reader_plugin.czi_metadata_processor import extract_key_metadata
+from napari_pitcount_cfim.czi_reader_plugin.libczi_reader import LibCziReader
 from napari_pitcount_cfim.czi_reader_plugin.metadata_dump import metadata_dump
+from napari_pitcount_cfim.czi_reader_plugin.pixel_cache import configure_pixel_cache, get_pixel_cache
+from napari_pitcount_cfim.tracing import span
+
+# One dask chunk per YX plane (samples kept together for RGB files), so a plane is decoded only when it is shown
+# or segmented, instead of every plane of every channel when the file is opened.
+LAZY_CHUNK_DIMS = ["Y", "X", "S"]
+# One chunk per scene, read with a single open of the file, for decoding all channels in one pass
+WHOLE_FILE_CHUNK_DIMS = ["C", "Z", "Y", "X", "S"]
+
+
+class SharedStack:
+    """
+        The CZYX pixels of a file, decoded in one pass when any channel is first needed. Every channel is a view
+        into that one buffer, so the other channels of the file come without decoding or copying. The buffer is
+        freed once no view of it is left, and decoded again when needed after that.
+    """
+    def __init__(self, decode, shape: tuple, dtype):
+        """
+        Parameters:
+            decode: callable -> Returns the decoded CZYX array.
+            shape: tuple -> Shape decode returns.
+            dtype: np.dtype -> Type decode returns.
+        """
+        self._decode = decode
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self._owner = None  # weak reference to the array owning the decoded pixels
+        self._lock = threading.Lock()
+
+    def array(self) -> np.ndarray:
+        """
+            The decoded CZYX array, decoding the file unless a view of the last decode is still alive.
+        """
+        with self._lock:
+            owner = self._owner() if self._owner is not None else None
+            if owner is None:
+                with span("decode_file", channels=self.shape[0]):
+                    owner = _owning_array(self._decode())
+                self._owner = weakref.ref(owner)
+        return owner.reshape(self.shape)
+
+    def channel(self, channel: int) -> "ChannelView":
+        return ChannelView(self, channel)
+
+
+class ChannelView:
+    """
+        A lazy ZYX channel of a SharedStack. Indexing it or converting it with np.asarray gives views into the
+        shared buffer. Dask would copy the buffer on every compute, so napari gets this array-like instead.
+    """
+    def __init__(self, stack: SharedStack, channel: int):
+        self._stack = stack
+        self._channel = channel
+        self.shape = stack.shape[1:]
+        self.dtype = stack.dtype
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    @property
+    def size(self) -> int:
+        return int(np.prod(self.shape))
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return self._stack.array()[self._channel][key]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self._stack.array()[self._channel]
+        if copy:
+            return np.array(data, dtype=dtype)
+        return data if dtype is None else data.astype(dtype, copy=False)
+
+    def __repr__(self) -> str:
+        return f"ChannelView(channel={self._channel}, shape={self.shape}, dtype={self.dtype})"
+
+
+def _owning_array(array: np.ndarray) -> np.ndarray:
+    """
+        The array owning the memory of array when array is a plain reshape of it, readers return views of arrays
+        with extra singleton dimensions. Memory maps own their file's pages. Other views are copied, so the owner
+        is what a weak reference can follow.
+    """
+    owner = array
+    while isinstance(owner.base, np.ndarray):
+        owner = owner.base
+    owns = owner.flags.owndata or isinstance(owner, np.memmap)
+    if owns and owner.flags.c_contiguous and array.flags.c_contiguous and owner.size == array.size:
+        return owner
+    return array.copy()
 
 
 def truncate_filename(filename, max_chars, split_before_max=True):
@@ -36,36 +135,74 @@ def truncate_filename(filename, max_chars, split_before_max=True):
 
 
 # TODO: Add to settings, Trunked filename length, split_before_max
-# TODO: Change reader to use aicspylibczi
-def read_czi(path):
+def read_czi(path, backend=None, decode=None):
     """
         Loads a .czi file and return the data in a proper callable format.
         Made because I could not get a direct reader to work with napari.
 
         Parameters:
             path: str -> Path to the .czi file.
+            backend: str -> "aicsimageio" or "aicspylibczi". None uses reader_settings.backend.
+            decode: str -> "file" to decode all channels in one pass into a buffer the channels are views of,
+                           "plane" to decode each plane on demand. None uses reader_settings.decode.
 
         Returns:
             callable -> A callable that returns a list of tuples with the data, metadata and layer type.
-                        Required format for napari readers.
+                        Required format for napari readers. The data are lazy, ChannelViews with decode "file",
+                        dask arrays with one chunk per plane with "plane". Files in the pixel cache are mapped
+                        from there instead, and files decoded in one pass are added to it.
     """
 
-    reader = CziReader(path)
+    if backend is None or decode is None:
+        settings = load_settings()
+        reader_settings = settings.reader_settings
+        backend = backend or reader_settings.backend
+        decode = decode or reader_settings.decode
+        configure_pixel_cache(settings.cache_settings.model_dump())
+
     file_name = os.path.basename(path)
-    channels = reader.dims.C
+    with span("czi.open", file_name, backend=backend):
+        if backend == "aicspylibczi":
+            reader = LibCziReader(path)
+            channels = reader.channels
+        else:
+            reader = CziReader(path, chunk_dims=WHOLE_FILE_CHUNK_DIMS if decode == "file" else LAZY_CHUNK_DIMS)
+            channels = reader.dims.C
 
     try:
-        metadata_list = extract_key_metadata(reader, channels)
+        with span("metadata", file_name):
+            metadata_list = extract_key_metadata(reader, channels, path=path)
         # metadata_list = metadata_dump(reader, channels)
     except ValueError as e:
         metadata_list = [{} for _ in range(channels)]
 
     file_name_trunked = truncate_filename(file_name, 20)
 
+    pixel_cache = get_pixel_cache()
+    cache_key = pixel_cache.make_key(path, backend) if pixel_cache is not None else None
+    cached = None
+    if pixel_cache is not None:
+        with span("pixel_cache.open", file_name):
+            cached = pixel_cache.get(cache_key)
+        if cached is not None and cached.shape[0] != channels:
+            cached = None
+    stack = None
+    if cached is None and decode == "file":
+        stack = _shared_stack(reader, backend, channels, pixel_cache, cache_key)
+
     layer_data_list = []
     for channel in range(channels):
 
-        data = reader.get_image_data("ZYX", T=0, C=channel)
+        if cached is not None:
+            # Memory-mapped planes are read as they are used, zarr ones chunk by chunk through dask
+            data = cached[channel] if isinstance(cached, np.ndarray) else \
+                da.from_array(cached, chunks=cached.chunks)[channel]
+        elif stack is not None:
+            data = stack.channel(channel)
+        elif backend == "aicspylibczi":
+            data = reader.get_dask_data(channel)
+        else:
+            data = reader.get_image_dask_data("ZYX", T=0, C=channel)
 
         metadata = metadata_list[channel]
 
@@ -78,6 +215,8 @@ def read_czi(path):
 
         if not isinstance(metadata, dict):  # Holy shit, I'm making errors
             raise ValueError(f"Metadata for channel {channel} is not a dictionary. Got {type(metadata)}")
+        # Lets the widget find the other channels of the file, for measuring intensities within masks
+        metadata.setdefault("metadata", {}).update({"SourceFile": str(path), "Channel": channel})
 
         layer_data_list.append((data, metadata, "image"))
 
@@ -86,4 +225,39 @@ def read_czi(path):
         # For multiple layers, napari can also take list[tuple] -> [(data, metadata, layer_type)]
         return layer_data_list
 
-    return _reader_callable
\ No newline at end of file
+    return _reader_callable
+
+
+def _shared_stack(reader, backend: str, channels: int, pixel_cache=None, cache_key: str = None) -> SharedStack:
+    """
+        A SharedStack decoding every channel of the file of reader in one pass, storing the pixels in
+        pixel_cache under cache_key when given.
+    """
+    if backend == "aicspylibczi":
+        # Shape and type from the lazy array, nothing is decoded yet
+        plane = reader.get_dask_data(0)
+        decode, shape, dtype = reader.read_stack, (channels,) + plane.shape, plane.dtype
+    else:
+        # A single chunk, one read of the whole scene instead of an open and subblock lookup for every plane.
+        # get_image_data would read the same way but keep the pixels in the reader for as long as the layers live.
+        lazy = reader.get_image_dask_data("CZYX", T=0)
+        decode, shape, dtype = lazy.compute, lazy.shape, lazy.dtype
+    if pixel_cache is not None:
+        decode = _cache_after_decode(decode, pixel_cache, cache_key)
+    return SharedStack(decode, shape, dtype)
+
+
+def _cache_after_decode(decode, pixel_cache, key: str):
+    """
+        decode, storing the decoded pixels in pixel_cache under key before returning them.
+    """
+    def decode_and_store():
+        # Decoded and stored before, and since freed: mapping the entry beats decoding again
+        cached = pixel_cache.get(key)
+        if cached is not None:
+            return cached if isinstance(cached, np.ndarray) else cached[...]
+        pixels = decode()
+        with span("pixel_cache.write"):
+            pixel_cache.put(key, pixels)
+        return pixels
+    return decode_and_store
@@ -0,0 +1,177 @@
+import threading
+from collections import namedtuple
+
+import dask.array as da
+import numpy as np
+from aicspylibczi import CziFile
+from dask import delayed
+
+PhysicalPixelSizes = namedtuple("PhysicalPixelSizes", ["Z", "Y", "X"])
+
+# libCZI pixel types, RGB types carry their samples in a trailing axis
+_pixel_type_to_dtype = {
+    "gray8": np.uint8,
+    "gray16": np.uint16,
+    "gray32": np.uint32,
+    "gray32float": np.float32,
+    "bgr24": np.uint8,
+    "bgr48": np.uint16,
+    "bgra32": np.uint8,
+}
+
+
+class LibCziReader:
+    """
+        Reads CZI files straight from their subblocks through aicspylibczi, skipping aicsimageio's xarray layer.
+
+        Reads can be limited to a scene, a mosaic tile (M index), a Z range and a YX bounding box, and only the
+        subblocks intersecting the request are decoded. Exposes metadata and physical_pixel_sizes like
+        aicsimageio's CziReader, so extract_key_metadata works with either.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._czi = CziFile(path)
+        self._dims_shape = self._czi.get_dims_shape()
+        self._is_mosaic = self._czi.is_mosaic()
+        self._is_rgb = self._czi.pixel_type.startswith("bgr")
+        # napari and the segmentation workers may decode planes from several threads at once
+        self._lock = threading.Lock()
+
+    @property
+    def metadata(self):
+        return self._czi.meta
+
+    @property
+    def physical_pixel_sizes(self) -> PhysicalPixelSizes:
+        """
+            Pixel sizes in micrometre, None for axes without scaling.
+        """
+        sizes = {}
+        for distance in self.metadata.findall("Metadata/Scaling/Items/Distance"):
+            value = distance.findtext("Value")
+            if value is not None:
+                # Stored in metre, rounded so 1e-7 m reads as 0.1 µm rather than 0.09999999999999999
+                sizes[distance.get("Id")] = round(float(value) * 1e6, 9)
+        return PhysicalPixelSizes(sizes.get("Z"), sizes.get("Y"), sizes.get("X"))
+
+    @property
+    def channels(self) -> int:
+        return self.dim_size("C")
+
+    @property
+    def is_mosaic(self) -> bool:
+        return self._is_mosaic
+
+    def dim_size(self, dim: str, scene: int = 0) -> int:
+        """
+            Size of a dimension in a scene, 1 if the file does not have it.
+        """
+        dims = self._dims_shape[min(scene, len(self._dims_shape) - 1)]
+        start, stop = dims.get(dim, (0, 1))
+        return stop - start
+
+    def plane_shape(self, scene: int = 0, tile: int = None) -> tuple[int, int]:
+        """
+            The (Y, X) shape of one plane, the stitched scene for mosaics unless a tile is given.
+        """
+        if self._is_mosaic and tile is None:
+            box = self._czi.get_mosaic_scene_bounding_box(scene)
+            return box.h, box.w
+        dims = self._dims_shape[min(scene, len(self._dims_shape) - 1)]
+        return dims["Y"][1] - dims["Y"][0], dims["X"][1] - dims["X"][0]
+
+    def read_plane(self, channel: int = 0, z: int = 0, scene: int = 0, tile: int = None, bbox: tuple = None):
+        """
+        Decodes one YX plane.
+
+        Parameters:
+            channel: int -> C index.
+            z: int -> Z index.
+            scene: int -> S index.
+            tile: int -> M index of a single mosaic tile. None stitches the scene for mosaic files.
+            bbox: tuple -> (y_start, y_stop, x_start, x_stop) in plane pixels. None reads the whole plane.
+
+        Returns:
+            np.ndarray -> The YX plane, YXA for RGB files.
+        """
+        plane = {"C": channel, "Z": z, "T": 0}
+        if self._is_mosaic and tile is None:
+            # Stitched read, only the tiles intersecting the region are decoded
+            box = self._czi.get_mosaic_scene_bounding_box(scene)
+            y0, y1, x0, x1 = bbox if bbox is not None else (0, box.h, 0, box.w)
+            region = (box.x + x0, box.y + y0, x1 - x0, y1 - y0)
+            with self._lock:
+                data = self._czi.read_mosaic(region=region, scale_factor=1.0, **plane)
+            return _squeeze_plane(data, self._is_rgb)
+
+        if "S" in self._dims_shape[0]:
+            plane["S"] = scene
+        if tile is not None:
+            plane["M"] = tile
+        with self._lock:
+            data, _ = self._czi.read_image(**plane)
+        data = _squeeze_plane(data, self._is_rgb)
+        if bbox is not None:
+            y0, y1, x0, x1 = bbox
+            # Subblocks of non-mosaic files are whole planes, crop after decoding
+            data = data[y0:y1, x0:x1]
+        return data
+
+    def read(self, channel: int = 0, scene: int = 0, tile: int = None, z_range: tuple = None, bbox: tuple = None):
+        """
+        Decodes a ZYX stack for one channel. See read_plane for the parameters.
+
+        Parameters:
+            z_range: tuple -> (z_start, z_stop). None reads every Z plane.
+        """
+        z_start, z_stop = z_range if z_range is not None else (0, self.dim_size("Z", scene))
+        return np.stack([self.read_plane(channel, z, scene, tile, bbox) for z in range(z_start, z_stop)])
+
+    def read_stack(self, scene: int = 0, tile: int = None, z_range: tuple = None, bbox: tuple = None):
+        """
+            Decodes every channel as one CZYX array, CZYXA for RGB files. Planes are decoded one at a time into
+            the array, through the open file, so the subblock directory is only read once. See read for the
+            parameters.
+        """
+        z_start, z_stop = z_range if z_range is not None else (0, self.dim_size("Z", scene))
+        first = self.read_plane(0, z_start, scene, tile, bbox)
+        stack = np.empty((self.channels, z_stop - z_start) + first.shape, dtype=first.dtype)
+        stack[0, 0] = first
+        for channel in range(self.channels):
+            for z in range(z_start, z_stop):
+                if channel or z != z_start:
+                    stack[channel, z - z_start] = self.read_plane(channel, z, scene, tile, bbox)
+        return stack
+
+    def get_dask_data(self, channel: int = 0, scene: int = 0, tile: int = None, z_range: tuple = None,
+                      bbox: tuple = None):
+        """
+            Lazy version of read, with one chunk per Z plane decoded on demand.
+        """
+        z_start, z_stop = z_range if z_range is not None else (0, self.dim_size("Z", scene))
+        if bbox is not None:
+            y0, y1, x0, x1 = bbox
+            shape = (y1 - y0, x1 - x0)
+        else:
+            shape = self.plane_shape(scene, tile)
+        dtype = _pixel_type_to_dtype.get(self._czi.pixel_type)
+        if dtype is None:
+            # Unknown pixel type, decode the first plane to find out
+            first = self.read_plane(channel, z_start, scene, tile, bbox)
+            dtype, shape = first.dtype, first.shape
+        elif self._is_rgb:
+            shape = shape + (4 if self._czi.pixel_type == "bgra32" else 3,)
+
+        planes = [
+            da.from_delayed(delayed(self.read_plane)(channel, z, scene, tile, bbox), shape=shape, dtype=dtype)
+            for z in range(z_start, z_stop)
+        ]
+        return da.stack(planes)
+
+
+def _squeeze_plane(data: np.ndarray, rgb: bool = False) -> np.ndarray:
+    """
+        Drops the singleton dimensions libCZI keeps in front of the plane, keeping YX, or YXA for RGB data.
+    """
+    plane_dims = 3 if rgb else 2
+    return data.reshape(data.shape[-plane_dims:])
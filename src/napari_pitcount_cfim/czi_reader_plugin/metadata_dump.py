@@ -1,34 +1,117 @@
+import io
 import json
 from xml.etree import ElementTree as ET
 
 from aicsimageio.readers import CziReader
-import xmltodict
 
 from napari_pitcount_cfim.library_workarounds.RangeDict import RangeDict
 
 debug = False
 
+# The only parts of the metadata metadata_dump reads, relative to the ImageDocument root
+IMAGE_PATH = "Metadata/Information/Image"
+ACQUISITION_MODE_SETUP_PATH = "Metadata/Experiment/ExperimentBlocks/AcquisitionBlock/AcquisitionModeSetup"
+TRACK_SETUP_PATH = "Metadata/Experiment/ExperimentBlocks/AcquisitionBlock/MultiTrackSetup/TrackSetup"
+
+
+def element_to_dict(element):
+    """
+        Converts an element the way xmltodict.parse does: attributes as "@name", text as "#text" next to attributes
+        or children, repeated children as lists and empty elements as None.
+    """
+    text = "".join(piece for piece in [element.text, *(child.tail for child in element)] if piece).strip() or None
+    if not element.attrib and len(element) == 0:
+        return text
+
+    result = {f"@{name}": value for name, value in element.attrib.items()}
+    for child in element:
+        value = element_to_dict(child)
+        if child.tag in result:
+            if not isinstance(result[child.tag], list):
+                result[child.tag] = [result[child.tag]]
+            result[child.tag].append(value)
+        else:
+            result[child.tag] = value
+    if text is not None:
+        result["#text"] = text
+    return result
+
+
+def _matches_to_value(matches: list):
+    # Like xmltodict, a single match is the value itself and repeated matches are a list
+    return matches[0] if len(matches) == 1 else matches
+
+
+def extract_paths(source, paths: list[str]) -> dict:
+    """
+    Converts only the elements at the given paths, instead of the whole metadata document.
+
+    Parameters:
+        source: Element | bytes | str | file -> A parsed metadata tree, or the raw XML. Parsed trees are searched
+                along the paths only. Raw XML is streamed, keeping only the requested subtrees, and parsing stops
+                once they are all complete.
+        paths: list[str] -> Slash separated tag paths below the root element.
+
+    Returns:
+        dict -> {path: xmltodict style value}, paths without a match are left out.
+    """
+    if isinstance(source, ET.Element):
+        found = {path: source.findall(path) for path in paths}
+        return {path: _matches_to_value([element_to_dict(match) for match in matches])
+                for path, matches in found.items() if matches}
+
+    if isinstance(source, (bytes, str)):
+        source = io.BytesIO(source.encode("utf-8") if isinstance(source, str) else source)
+
+    targets = {tuple(path.split("/")): path for path in paths}
+    # Every ancestor of a target, the rest of the document is dropped as soon as it is parsed
+    prefixes = {target[:depth] for target in targets for depth in range(len(target))}
+    found = {}
+    done = set()
+    stack = []
+    capture_depth = None  # Length of stack at the target element being kept
+
+    for event, element in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            stack.append(element.tag)
+            if capture_depth is None and tuple(stack[1:]) in targets:
+                capture_depth = len(stack)
+            continue
+
+        path = tuple(stack[1:])
+        stack.pop()
+        if capture_depth is not None:
+            if len(stack) + 1 == capture_depth:
+                found.setdefault(targets[path], []).append(element_to_dict(element))
+                capture_depth = None
+                element.clear()
+            continue
+        if path not in prefixes:
+            element.clear()
+            continue
+        # Once the parent of a target closes, no more matches for it can follow
+        done.update(target for target in targets if target[:-1] == path and targets[target] in found)
+        if len(done) == len(targets):
+            break
+
+    return {path: _matches_to_value(matches) for path, matches in found.items()}
+
 
 def metadata_dump(czi_read_file, channels) -> list[dict]:
     """
     Dumps the metadata of a .czi file to a json file.
+    Only the image, acquisition mode and track setup parts of the metadata are converted.
     """
-
-    raw_xml = ET.tostring(czi_read_file.metadata, encoding="utf-8")
-    ome_dict = xmltodict.parse(raw_xml)
+    extracted = extract_paths(czi_read_file.metadata, [IMAGE_PATH, ACQUISITION_MODE_SETUP_PATH, TRACK_SETUP_PATH])
 
     if debug:
         print("[*] Metadata dump:")
-        print(json.dumps(ome_dict, indent=2))
+        print(json.dumps(extracted, indent=2))
 
     metadata = {}
-    image_dict = ome_dict["ImageDocument"]["Metadata"]["Information"]["Image"]
-    aq_mode_setup_dict = ome_dict["ImageDocument"]["Metadata"]["Experiment"]["ExperimentBlocks"]["AcquisitionBlock"][
-        "AcquisitionModeSetup"]
-    # print(json.dumps(ome_dict["ImageDocument"]["Metadata"]["Experiment"]["ExperimentBlocks"]["AcquisitionBlock"], indent=2))
-    track_setup_list = \
-    ome_dict["ImageDocument"]["Metadata"]["Experiment"]["ExperimentBlocks"]["AcquisitionBlock"]["MultiTrackSetup"][
-        "TrackSetup"]
+    image_dict = extracted[IMAGE_PATH]
+    aq_mode_setup_dict = extracted[ACQUISITION_MODE_SETUP_PATH]
+    track_setup_list = extracted[TRACK_SETUP_PATH]
 
     pixcount = [image_dict["SizeY"], image_dict["SizeX"]]
 
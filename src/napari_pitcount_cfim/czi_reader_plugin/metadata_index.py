@@ -0,0 +1,192 @@
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+from typing import NamedTuple, Optional
+
+# Distances in the CZI scaling metadata are stored in metre
+_METRE_TO_MICROMETRE = 1e6
+
+_unit_registry = None
+_unit_registry_lock = threading.Lock()
+
+
+def get_unit_registry():
+    """
+        The pint UnitRegistry shared by all files. Building one parses pint's unit definitions, which takes longer
+        than reading the metadata of a file, so it is only done once and only when units are needed.
+    """
+    global _unit_registry
+    with _unit_registry_lock:
+        if _unit_registry is None:
+            import pint
+
+            _unit_registry = pint.UnitRegistry()
+        return _unit_registry
+
+
+class CziMetadataRecord(NamedTuple):
+    """
+        Every field the plugin reads from the CZI XML metadata, in a form that can be stored as JSON.
+    """
+    emission_wavelengths: tuple  # EmissionWavelength texts, in document order
+    default_scaling_unit: Optional[str]
+    physical_pixel_sizes: tuple  # (Z, Y, X) in micrometre, None for axes without scaling
+    objective: Optional[str]
+
+    def to_json(self) -> dict:
+        return self._asdict()
+
+    @classmethod
+    def from_json(cls, data: dict) -> "CziMetadataRecord":
+        return cls(emission_wavelengths=tuple(data["emission_wavelengths"]),
+                   default_scaling_unit=data["default_scaling_unit"],
+                   physical_pixel_sizes=tuple(data["physical_pixel_sizes"]),
+                   objective=data["objective"])
+
+
+def index_metadata(xml_metadata) -> CziMetadataRecord:
+    """
+        Builds the record in a single walk over the metadata tree, instead of one search per field.
+    """
+    emission_wavelengths = []
+    default_scaling_unit = None
+    objective = None
+    sizes = {}
+
+    for element, parent_tag in _walk(xml_metadata):
+        tag = element.tag
+        if tag == "EmissionWavelength":
+            emission_wavelengths.append(element.text)
+        elif tag == "DefaultScalingUnit":
+            if default_scaling_unit is None:
+                default_scaling_unit = element.text
+        elif tag == "Distance" and parent_tag == "Items":  # Metadata/Scaling/Items/Distance
+            axis = element.get("Id")
+            value = element.findtext("Value")
+            if axis in ("Z", "Y", "X") and value is not None and axis not in sizes:
+                # Rounded so 1e-7 m reads as 0.1 µm rather than 0.09999999999999999
+                sizes[axis] = round(float(value) * _METRE_TO_MICROMETRE, 9)
+        elif tag == "Objective" and parent_tag == "Objectives":  # Information/Instrument/Objectives/Objective
+            if objective is None and element.get("Name"):
+                objective = element.get("Name")
+
+    return CziMetadataRecord(emission_wavelengths=tuple(emission_wavelengths),
+                             default_scaling_unit=default_scaling_unit,
+                             physical_pixel_sizes=(sizes.get("Z"), sizes.get("Y"), sizes.get("X")),
+                             objective=objective)
+
+
+def _walk(root):
+    """
+        Yields (element, parent tag) for every element in document order, like Element.iter() plus the parent.
+    """
+    stack = [(root, None)]
+    while stack:
+        element, parent_tag = stack.pop()
+        yield element, parent_tag
+        stack.extend((child, element.tag) for child in reversed(element))
+
+
+class MetadataIndex:
+    """
+        Memoizes metadata records per (path, mtime, size), in memory and, with a folder, in one small JSON file
+        per CZI file, so files opened before are never parsed again, also across sessions.
+        A changed file gets a new key, so stale records are never returned.
+    """
+    def __init__(self, folder: str = None):
+        self.folder = folder
+        self._records = {}
+        self._lock = threading.Lock()
+        if folder is not None:
+            os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def file_key(path: str) -> tuple:
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+    def get(self, path: str, load_xml) -> CziMetadataRecord:
+        """
+        Parameters:
+            path: str -> The CZI file.
+            load_xml: callable -> Returns the metadata Element of the file, only called on a miss.
+        """
+        key = self.file_key(path)
+        with self._lock:
+            record = self._records.get(key)
+        if record is None:
+            record = self._read_sidecar(key)
+        if record is None:
+            record = index_metadata(load_xml())
+            self._write_sidecar(key, record)
+        with self._lock:
+            self._records[key] = record
+        return record
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+        if self.folder is not None:
+            for entry in os.scandir(self.folder):
+                if entry.name.endswith(".json"):
+                    os.remove(entry.path)
+
+    def _sidecar_path(self, key: tuple) -> str:
+        name = hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+        return os.path.join(self.folder, f"{name}.json")
+
+    def _read_sidecar(self, key: tuple):
+        if self.folder is None:
+            return None
+        try:
+            with open(self._sidecar_path(key), "r", encoding="utf-8") as file:
+                data = json.load(file)
+            if tuple(data["key"]) != key:
+                return None
+            return CziMetadataRecord.from_json(data["record"])
+        except (FileNotFoundError, OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _write_sidecar(self, key: tuple, record: CziMetadataRecord):
+        if self.folder is None:
+            return
+        handle, temp_path = tempfile.mkstemp(dir=self.folder, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "w", encoding="utf-8") as file:
+                json.dump({"key": list(key), "record": record.to_json()}, file)
+            os.replace(temp_path, self._sidecar_path(key))
+        except OSError:
+            # Only a cache, the record is still returned
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+
+_metadata_index = None
+
+
+def get_metadata_index() -> MetadataIndex:
+    """
+        The process-wide metadata index. Records are persisted in the settings cache folder when it can be found
+        without importing napari, that is inside napari or with PITCOUNT_CFIM_SETTINGS_FOLDER set. Otherwise they
+        are only kept in memory, unless set_metadata_index_folder was called.
+    """
+    global _metadata_index
+    if _metadata_index is None:
+        folder = None
+        if "napari" in sys.modules or os.getenv("PITCOUNT_CFIM_SETTINGS_FOLDER"):
+            from napari_pitcount_cfim.config.settings_io import cache_folder
+
+            folder = cache_folder(name="metadata")
+        _metadata_index = MetadataIndex(folder)
+    return _metadata_index
+
+
+def set_metadata_index_folder(folder: str = None):
+    """
+        Replace the process-wide index with one persisting to folder, None keeps records in memory only.
+    """
+    global _metadata_index
+    _metadata_index = MetadataIndex(folder)
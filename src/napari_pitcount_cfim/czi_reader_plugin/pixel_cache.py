@@ -0,0 +1,216 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+
+PIXEL_CACHE_STORAGES = ("zarr", "memmap")
+
+# Largest chunk edge of cached planes, every chunk holds part of one plane of one channel
+_ZARR_CHUNK = 1024
+
+
+def _import_zarr():
+    try:
+        import zarr
+    except ImportError as e:
+        raise ImportError("The zarr pixel cache needs zarr, install it with pip install zarr, "
+                          "or set cache_settings.pixel_cache_storage to memmap.") from e
+    return zarr
+
+
+class PixelCache:
+    """
+        On-disk cache of decoded CZI pixels, so reopening a file skips decompressing it.
+
+        Entries hold the CZYX stack of a file, keyed by its path, modification time and size, so an edited file
+        is decoded again and its old entry ages out. They are stored as chunked, compressed zarr arrays, or as
+        uncompressed .npy files, and get() maps them read-only: only the planes that are shown or segmented are
+        read. Reading an entry marks it as recently used, and the least recently used entries are deleted once
+        the folder grows past max_bytes.
+    """
+    def __init__(self, folder: str, max_bytes: int = 4096 * 1024 * 1024, storage: str = "memmap"):
+        """
+        Parameters:
+            folder: str -> Folder of the entries.
+            max_bytes: int -> Size cap of the folder.
+            storage: str -> "memmap" for uncompressed .npy files, "zarr" for compressed chunked arrays.
+        """
+        if storage not in PIXEL_CACHE_STORAGES:
+            raise ValueError(f"Unknown pixel cache storage {storage!r}, expected one of {PIXEL_CACHE_STORAGES}")
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.storage = storage
+        self._zarr = _import_zarr() if storage == "zarr" else None
+        os.makedirs(self.folder, exist_ok=True)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(path: str, backend: str) -> str:
+        """
+            Key of the pixels of path as read by backend. Changes when the file is modified.
+        """
+        stat = os.stat(path)
+        key = repr((os.path.abspath(path), stat.st_mtime_ns, stat.st_size, backend))
+        return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+    def get(self, key: str):
+        """
+            Returns:
+                np.memmap | zarr.Array | None -> The cached CZYX stack, mapped read-only, None on a miss.
+        """
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            if self.storage == "zarr":
+                stack = self._zarr.open_array(path, mode="r")
+            else:
+                stack = np.load(path, mmap_mode="r")
+        except (FileNotFoundError, OSError, ValueError, KeyError):
+            # Missing, or evicted or corrupted under our feet; a miss either way
+            return None
+
+        try:
+            os.utime(path)  # Mark as recently used
+        except OSError:
+            pass
+        return stack
+
+    def put(self, key: str, stack: np.ndarray):
+        """
+            Stores a decoded CZYX stack. Entries of the same key written at the same time keep the first one.
+        """
+        suffix = ".zarr" if self.storage == "zarr" else ".npy"
+        # Write to a temporary name and rename it in place, so readers never see a half-written entry
+        handle, temp_path = tempfile.mkstemp(dir=self.folder, suffix=f"{suffix}.tmp")
+        try:
+            if self.storage == "zarr":
+                os.close(handle)
+                self._write_zarr(temp_path, stack)
+            else:
+                with os.fdopen(handle, "wb") as file:
+                    np.save(file, np.asarray(stack), allow_pickle=False)
+            os.replace(temp_path, self._path(key))
+        except OSError:
+            # Only a cache; a folder entry written by another reader meanwhile can not be replaced
+            _remove_path(temp_path)
+        except BaseException:
+            _remove_path(temp_path)
+            raise
+        self._evict()
+
+    def clear(self) -> int:
+        """
+            Deletes every cache entry, and temporary files left by interrupted writes.
+
+            Returns:
+                int -> Bytes freed.
+        """
+        with self._lock:
+            freed = 0
+            for path in self._entries() + self._temp_entries():
+                freed += _path_size(path)
+                _remove_path(path)
+            return freed
+
+    def size_bytes(self) -> int:
+        return sum(_path_size(path) for path in self._entries())
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.folder, f"{key}{'.zarr' if self.storage == 'zarr' else '.npy'}")
+
+    def _entries(self) -> list:
+        # Both storages, entries written with the other one still count towards the cap
+        return [entry.path for entry in os.scandir(self.folder) if entry.name.endswith((".zarr", ".npy"))]
+
+    def _temp_entries(self) -> list:
+        return [entry.path for entry in os.scandir(self.folder) if entry.name.endswith(".tmp")]
+
+    def _write_zarr(self, path: str, stack: np.ndarray):
+        os.remove(path)  # zarr arrays are folders
+        chunks = (1, 1) + tuple(min(size, _ZARR_CHUNK) for size in stack.shape[2:4]) + tuple(stack.shape[4:])
+        stored = self._zarr.open_array(path, mode="w", shape=stack.shape, chunks=chunks, dtype=stack.dtype)
+        stored[...] = stack
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            for path in self._entries():
+                try:
+                    entries.append((os.stat(path).st_mtime_ns, _path_size(path), path))
+                except FileNotFoundError:
+                    continue
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                _remove_path(path)
+                total -= size
+
+
+def _remove_path(path: str):
+    try:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except OSError:
+        # Already gone, or still mapped on Windows; evicted again with the next write
+        pass
+
+
+def _path_size(path: str) -> int:
+    try:
+        if not os.path.isdir(path):
+            return os.path.getsize(path)
+        return sum(os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(path) for file in files)
+    except OSError:
+        return 0
+
+
+_pixel_cache = None
+_pixel_cache_config = None
+
+
+def get_pixel_cache():
+    """
+        The process-wide pixel cache, None while it is off.
+    """
+    return _pixel_cache
+
+
+def set_pixel_cache(cache: PixelCache = None):
+    """
+        Replace the process-wide pixel cache, None turns it off.
+    """
+    global _pixel_cache, _pixel_cache_config
+    _pixel_cache = cache
+    _pixel_cache_config = None
+
+
+def configure_pixel_cache(cache_settings: dict, settings_folder: str = None):
+    """
+        Turns the process-wide pixel cache on or off as set by cache_settings, kept in the settings cache folder.
+        The cache is only replaced when its settings change.
+
+        Returns:
+            PixelCache | None -> The cache, None while it is off or its storage can not be used.
+    """
+    global _pixel_cache, _pixel_cache_config
+    config = (bool(cache_settings.get("pixel_cache")), cache_settings.get("pixel_cache_max_mb"),
+              cache_settings.get("pixel_cache_storage"), settings_folder)
+    if config == _pixel_cache_config:
+        return _pixel_cache
+    _pixel_cache_config = config
+    _pixel_cache = None
+    if config[0]:
+        from napari_pitcount_cfim.config.settings_io import cache_folder
+
+        try:
+            _pixel_cache = PixelCache(cache_folder(settings_folder, "pixels"), config[1] * 1024 * 1024, config[2])
+        except ImportError as e:
+            print(f"[!] Pixel cache off: {e}")
+    return _pixel_cache
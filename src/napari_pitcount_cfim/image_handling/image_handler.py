@@ -29,6 +29,14 @@ class ImageHandler(QWidget):
             raise ValueError("No layers in the viewer.")
         return [layer.data for layer in self.viewer.layers if isinstance(layer, napari.layers.Image)]
 
+    def get_all_image_layers(self):
+        """
+            Get all image layers from the napari viewer, for when their scale or metadata is needed too.
+        """
+        if not self.viewer.layers:
+            raise ValueError("No layers in the viewer.")
+        return [layer for layer in self.viewer.layers if isinstance(layer, napari.layers.Image)]
+
     def get_all_labels(self):
         """
             Get all labels from the napari viewer.
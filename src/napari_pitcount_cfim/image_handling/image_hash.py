@@ -0,0 +1,28 @@
+import hashlib
+
+import numpy as np
+
+# Hash in slices, so non-contiguous or lazy arrays never need a full contiguous copy
+_chunk_bytes = 64 * 1024 * 1024
+
+
+def hash_array(array, digest_size: int = 16) -> str:
+    """
+        Fast content hash of an array, covering its shape, dtype and pixel values.
+
+        Returns:
+            str -> Hex digest.
+    """
+    array = np.asarray(array)
+    digest = hashlib.blake2b(digest_size=digest_size)
+    digest.update(f"{array.shape}|{array.dtype.str}".encode())
+
+    if array.flags.c_contiguous:
+        view = memoryview(array.reshape(-1).view(np.uint8))
+        for start in range(0, len(view), _chunk_bytes):
+            digest.update(view[start:start + _chunk_bytes])
+    elif array.ndim:
+        rows_per_chunk = max(1, _chunk_bytes // max(1, array[0].nbytes))
+        for start in range(0, array.shape[0], rows_per_chunk):
+            digest.update(np.ascontiguousarray(array[start:start + rows_per_chunk]).view(np.uint8))
+    return digest.hexdigest()
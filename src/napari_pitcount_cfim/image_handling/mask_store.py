@@ -0,0 +1,202 @@
+import os
+import re
+import shutil
+import tempfile
+import threading
+import weakref
+
+import numpy as np
+
+MASK_STORAGES = ("memory", "memmap", "zarr")
+
+# Largest chunk edge of zarr masks, Z stacks are chunked plane by plane
+_ZARR_CHUNK = 1024
+
+
+def label_dtype(max_label: int) -> np.dtype:
+    """
+        The smallest unsigned integer type holding labels up to max_label.
+    """
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_label <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+
+def downcast_labels(labels: np.ndarray) -> np.ndarray:
+    """
+        Labels in the smallest sufficient unsigned type. Cellpose returns 32 bit labels or wider, most images need
+        8 or 16 bits. Arrays already in that type are returned as they are.
+    """
+    labels = np.asarray(labels)
+    if labels.dtype.kind not in "iu":
+        raise TypeError(f"Labels must be integers, got {labels.dtype}")
+    if labels.dtype.kind == "i" and labels.size and labels.min() < 0:
+        raise ValueError("Labels can not be negative")
+    dtype = label_dtype(int(labels.max(initial=0)))
+    if labels.dtype == dtype:
+        return labels
+    return labels.astype(dtype)
+
+
+def _import_zarr():
+    try:
+        import zarr
+    except ImportError as e:
+        raise ImportError("Zarr mask storage needs zarr, install it with pip install zarr, "
+                          "or keep the masks as memmap instead.") from e
+    return zarr
+
+
+class MaskStore:
+    """
+        Keeps finished masks on disk instead of in memory, so a session with hundreds of images does not run out
+        of RAM.
+
+        Masks are downcast to the smallest label type and written to a memory-mapped .npy file, or to a chunked,
+        compressed zarr array. put() returns an array backed by that file, which napari reads lazily: only the
+        pages or chunks on screen are loaded, and painting on a labels layer writes back into the file. With
+        "memory" the downcast masks are returned as they are.
+
+        Each mask gets a new file, so a layer still showing the previous version of a mask is never overwritten.
+        Older versions are kept until release_stale(), once no layer shows them. The folder is removed with the
+        store, or when the interpreter exits.
+    """
+    def __init__(self, storage: str = "memmap", folder: str = None):
+        """
+        Parameters:
+            storage: str -> "memory", "memmap" or "zarr".
+            folder: str -> Parent folder of the store's own temporary folder. None uses the system temp folder.
+        """
+        if storage not in MASK_STORAGES:
+            raise ValueError(f"Unknown mask storage {storage!r}, expected one of {MASK_STORAGES}")
+        self.storage = storage
+        self.parent_folder = folder
+        self._zarr = _import_zarr() if storage == "zarr" else None
+        self.folder = None
+        if storage != "memory":
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            self.folder = tempfile.mkdtemp(prefix="pitcount-masks-", dir=folder or None)
+            self._finalizer = weakref.finalize(self, shutil.rmtree, self.folder, ignore_errors=True)
+        self._paths = {}  # name -> file of the latest version of the mask
+        self._stale = {}  # name -> files of older versions of the mask, which a layer may still show
+        self._lock = threading.Lock()
+
+    def put(self, name: str, masks: np.ndarray):
+        """
+            Stores masks under name, replacing an earlier version. The file of the earlier version stays until
+            release_stale(name).
+
+            Returns:
+                np.memmap | zarr.Array | np.ndarray -> The stored masks, to hand to napari in place of the array.
+        """
+        masks = downcast_labels(masks)
+        if self.storage == "memory":
+            return masks
+
+        handle, path = tempfile.mkstemp(dir=self.folder, prefix=f"{_file_name(name)}.",
+                                        suffix=".npy" if self.storage == "memmap" else ".zarr")
+        os.close(handle)
+        try:
+            stored = self._write_memmap(path, masks) if self.storage == "memmap" else self._write_zarr(path, masks)
+        except BaseException:
+            _remove_path(path)
+            raise
+        with self._lock:
+            previous = self._paths.get(name)
+            self._paths[name] = path
+            if previous is not None:
+                self._stale.setdefault(name, []).append(previous)
+        return stored
+
+    def release_stale(self, name: str):
+        """
+            Deletes the older versions of name, once the layer of name shows the latest one.
+        """
+        with self._lock:
+            paths = self._stale.pop(name, [])
+        for path in paths:
+            _remove_path(path)
+
+    def get(self, name: str):
+        """
+            The stored masks of name, None if there are none. Always None for "memory".
+        """
+        with self._lock:
+            path = self._paths.get(name)
+        if path is None:
+            return None
+        if self.storage == "memmap":
+            return np.load(path, mmap_mode="r+")
+        return self._zarr.open_array(path, mode="r+")
+
+    def remove(self, name: str):
+        """
+            Deletes every version of name.
+        """
+        with self._lock:
+            paths = self._stale.pop(name, [])
+            latest = self._paths.pop(name, None)
+        if latest is not None:
+            paths.append(latest)
+        for path in paths:
+            _remove_path(path)
+
+    def close(self):
+        """
+            Deletes every stored mask and the store folder. Arrays returned by put() must no longer be used.
+        """
+        with self._lock:
+            self._paths = {}
+            self._stale = {}
+        if self.folder is not None:
+            self._finalizer()
+
+    def size_bytes(self) -> int:
+        with self._lock:
+            paths = list(self._paths.values()) + [path for stale in self._stale.values() for path in stale]
+        return sum(_path_size(path) for path in paths)
+
+    def __len__(self) -> int:
+        """
+            Number of masks with a version on disk.
+        """
+        with self._lock:
+            return len(self._paths.keys() | self._stale.keys())
+
+    @staticmethod
+    def _write_memmap(path: str, masks: np.ndarray) -> np.memmap:
+        stored = np.lib.format.open_memmap(path, mode="w+", dtype=masks.dtype, shape=masks.shape)
+        stored[...] = masks
+        stored.flush()
+        return stored
+
+    def _write_zarr(self, path: str, masks: np.ndarray):
+        os.remove(path)  # zarr arrays are folders
+        chunks = tuple(1 for _ in masks.shape[:-2]) + tuple(min(size, _ZARR_CHUNK) for size in masks.shape[-2:])
+        stored = self._zarr.open_array(path, mode="w", shape=masks.shape, chunks=chunks, dtype=masks.dtype)
+        stored[...] = masks
+        return stored
+
+
+def _file_name(name: str) -> str:
+    # Layer names may hold anything, file names may not
+    return re.sub(r"[^A-Za-z0-9_-]+", "_", name)[:64] or "mask"
+
+
+def _remove_path(path: str):
+    try:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except OSError:
+        # Already gone, or still mapped on Windows; the store folder is removed with the store
+        pass
+
+
+def _path_size(path: str) -> int:
+    if not os.path.isdir(path):
+        return os.path.getsize(path) if os.path.exists(path) else 0
+    return sum(os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(path) for file in files)
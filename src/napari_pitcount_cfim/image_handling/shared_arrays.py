@@ -0,0 +1,130 @@
+import itertools
+import os
+import threading
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+import dask.array as da
+import numpy as np
+
+# Picklable description of an array in a shared memory segment, sent to worker processes instead of the pixels
+SharedArrayHandle = namedtuple("SharedArrayHandle", ["name", "shape", "dtype"])
+
+
+def create_shared_array(name: str, shape: tuple, dtype) -> tuple[shared_memory.SharedMemory, np.ndarray]:
+    """
+        Creates a named segment and an array backed by it. Close the segment once the array is no longer used.
+    """
+    dtype = np.dtype(dtype)
+    size = max(1, int(np.prod(shape)) * dtype.itemsize)  # Segments can not be empty
+    segment = shared_memory.SharedMemory(name=name, create=True, size=size)
+    return segment, np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+
+
+def attach_shared_array(handle: SharedArrayHandle) -> tuple[shared_memory.SharedMemory, np.ndarray]:
+    """
+        Maps an existing segment without copying. Delete the array before closing the segment.
+    """
+    segment = shared_memory.SharedMemory(name=handle.name)
+    return segment, np.ndarray(handle.shape, dtype=np.dtype(handle.dtype), buffer=segment.buf)
+
+
+def share_array(array, name: str) -> tuple[shared_memory.SharedMemory, SharedArrayHandle]:
+    """
+        Copies an array into a new segment. Lazy dask arrays are decoded straight into it, without an
+        intermediate array.
+    """
+    if not isinstance(array, (np.ndarray, da.Array)):
+        array = np.asarray(array)
+    segment, view = create_shared_array(name, array.shape, array.dtype)
+    try:
+        if isinstance(array, da.Array):
+            da.store(array, view, lock=False)
+        else:
+            view[...] = array
+    except BaseException:
+        del view
+        segment.close()
+        segment.unlink()
+        raise
+    del view
+    return segment, SharedArrayHandle(name, tuple(array.shape), np.dtype(array.dtype).str)
+
+
+def unlink_quietly(name: str):
+    """
+        Removes a segment by name if it still exists.
+    """
+    try:
+        segment = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    segment.close()
+    segment.unlink()
+
+
+class SharedArrayRegistry:
+    """
+        Owns the shared memory segments of the napari process, grouped by a key such as a job id.
+
+        Input images are shared with share(), results written by the workers into segments named by output_name()
+        are read back with collect(). release() removes every segment of a key, including result segments a
+        crashed or cancelled worker left behind, so a job never leaks memory however it ends.
+    """
+    def __init__(self, prefix: str = None):
+        # Segment names are global to the machine, so they carry the process id
+        self.prefix = prefix or f"pcf{os.getpid()}"
+        self._segments = {}  # key -> list of SharedMemory created here
+        self._output_names = {}  # key -> list of segment names reserved for worker results
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def share(self, array, key) -> SharedArrayHandle:
+        name = f"{self.prefix}_{key}_{next(self._counter)}"
+        segment, handle = share_array(array, name)
+        with self._lock:
+            self._segments.setdefault(key, []).append(segment)
+        return handle
+
+    def output_name(self, key) -> str:
+        """
+            Reserves a segment name for a worker to write a result into.
+        """
+        name = f"{self.prefix}_{key}_{next(self._counter)}_out"
+        with self._lock:
+            self._output_names.setdefault(key, []).append(name)
+        return name
+
+    @staticmethod
+    def collect(handle: SharedArrayHandle) -> np.ndarray:
+        """
+            Reads a result segment written by a worker into a regular array and removes the segment.
+            The one copy hands the caller an array that does not depend on the segment staying mapped.
+        """
+        segment, view = attach_shared_array(handle)
+        try:
+            return np.array(view)
+        finally:
+            del view
+            segment.close()
+            segment.unlink()
+
+    def release(self, key):
+        with self._lock:
+            segments = self._segments.pop(key, [])
+            output_names = self._output_names.pop(key, [])
+        for segment in segments:
+            segment.close()
+            segment.unlink()
+        for name in output_names:
+            unlink_quietly(name)
+
+    def release_all(self):
+        with self._lock:
+            keys = set(self._segments) | set(self._output_names)
+        for key in keys:
+            self.release(key)
+
+    def keys(self) -> list:
+        with self._lock:
+            return list(set(self._segments) | set(self._output_names))
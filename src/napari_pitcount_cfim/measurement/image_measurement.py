@@ -0,0 +1,46 @@
+from collections import namedtuple
+
+import numpy as np
+
+from napari_pitcount_cfim.measurement.pit_detection import find_cell_pits
+from napari_pitcount_cfim.result_handling.result_table import object_columns
+from napari_pitcount_cfim.tracing import span
+
+# results: the result dictionary of the image. pits: the pit coordinates, None when pits are not counted.
+Measurement = namedtuple("Measurement", ["results", "pits"])
+
+
+def measure_image(mask: np.ndarray, image_name: str, inputs: dict, pit_settings: dict) -> Measurement:
+    """
+        Per-image and per-cell results of a mask, with the intensity of every channel of the file and the number
+        of pits in each cell. Runs on the segmentation workers, so the channels are decoded off the GUI thread.
+
+        Parameters:
+            mask: np.ndarray -> The cell mask.
+            image_name: str -> Name of the segmented image.
+            inputs: dict -> file, channel and scale of the image, intensities, the undecoded data of every channel
+                            of its file, and pit_image, pit_scale and pit_units, the channel pits are counted in,
+                            its pixel size and the units of that, None when pits are not counted.
+            pit_settings: dict -> PitSettings as a dictionary.
+    """
+    with span("decode", images=len(inputs["intensities"])):
+        intensities = [np.asarray(image) for image in inputs["intensities"]]
+    # Only channels covering the mask pixel for pixel can be measured within it
+    intensities = [image for image in intensities if np.squeeze(image).shape == np.squeeze(mask).shape]
+
+    pits, pit_labels = None, None
+    pit_image = inputs.get("pit_image")
+    if pit_image is not None and np.squeeze(pit_image).shape == np.squeeze(mask).shape:
+        pits, pit_labels = find_cell_pits(np.asarray(pit_image), mask, pit_settings, inputs.get("pit_scale"),
+                                          units=inputs.get("pit_units"))
+
+    results = {
+        "file": inputs.get("file"),
+        "channel": inputs.get("channel"),
+        "name": image_name,
+        "scale": inputs.get("scale"),
+        "cell_count": int(np.max(mask, initial=0)),
+        "pit_count": None if pit_labels is None else int(np.count_nonzero(pit_labels)),
+        "objects": object_columns(image_name, mask, intensities, pit_labels),
+    }
+    return Measurement(results, pits)
@@ -0,0 +1,133 @@
+import numpy as np
+
+from napari_pitcount_cfim.czi_reader_plugin.metadata_index import get_unit_registry
+from napari_pitcount_cfim.tracing import span
+
+# A blob of radius r gives the strongest Laplacian of Gaussian response at sigma = r / sqrt(2)
+_SIGMA_PER_DIAMETER = 1 / (2 * np.sqrt(2))
+
+# Scales the median absolute deviation to the standard deviation of normally distributed noise
+_MAD_TO_STD = 1.4826
+
+
+def pit_sigma(pit_settings: dict, pixel_size=None, units=None) -> float:
+    """
+        The filter sigma in pixels for pits of pit_settings["pit_diameter_nm"], or of pit_diameter_px when the
+        pixel size is not known.
+
+        Parameters:
+            pit_settings: dict -> PitSettings as a dictionary.
+            pixel_size: sequence -> Pixel size, the last entry (X) is used. None falls back to pixels.
+            units: sequence -> Unit of each axis of pixel_size, pint units or their names, as read_czi and napari
+                   layers give them. Pixel units, which napari gives images without a scale, fall back to pixels.
+                   None takes the size in nanometre, as read_czi gives it, unless it is all ones like the scale of
+                   napari images without one.
+    """
+    sizes = None if pixel_size is None else np.asarray(pixel_size, dtype=float)
+    if sizes is None or sizes.size == 0 or sizes[-1] <= 0:
+        return pit_settings["pit_diameter_px"] * _SIGMA_PER_DIAMETER
+    if units is None:
+        size_nm = None if np.all(sizes == 1) else sizes[-1]
+    else:
+        size_nm = _to_nanometre(sizes[-1], list(units)[-1])
+    if size_nm is None:
+        return pit_settings["pit_diameter_px"] * _SIGMA_PER_DIAMETER
+    return pit_settings["pit_diameter_nm"] / size_nm * _SIGMA_PER_DIAMETER
+
+
+def _to_nanometre(size: float, unit):
+    """
+        size in unit as nanometre, None if unit is not a length.
+    """
+    import pint
+
+    # Quantities, as read_czi gives, carry their unit; napari's units come from another registry, go by name
+    name = str(getattr(unit, "units", unit))
+    try:
+        return float(get_unit_registry().Quantity(size, name).to("nm").magnitude)
+    except (pint.errors.DimensionalityError, pint.errors.UndefinedUnitError):
+        return None
+
+
+def detect_pits(image: np.ndarray, sigma: float, threshold: float = 5.0, min_distance: int = 2) -> np.ndarray:
+    """
+        Finds pits, small bright spots, in one filter pass over the whole image instead of one per cell.
+
+        The image is filtered with a scale normalised Laplacian of Gaussian, Z stacks plane by plane. Local
+        maxima of the response at least min_distance pixels apart that stand threshold noise levels above the
+        median response are pits. The noise level is estimated from the median absolute deviation, so the
+        threshold does not depend on the brightness of the image.
+
+        Parameters:
+            image: np.ndarray -> YX or ZYX image. Singleton axes are dropped.
+            sigma: float -> Filter sigma in pixels, see pit_sigma.
+            threshold: float -> Detection threshold in noise standard deviations.
+            min_distance: int -> Minimum distance in pixels between two pits.
+
+        Returns:
+            np.ndarray -> (pits, image dimensions) integer coordinates, in the squeezed image.
+    """
+    from scipy import ndimage  # Slow to import, only needed once pits are counted
+
+    image = np.squeeze(np.asarray(image)).astype(np.float32, copy=False)
+    if image.ndim not in (2, 3):
+        raise ValueError(f"Expected a YX or ZYX image, got shape {image.shape}")
+    if sigma <= 0:
+        raise ValueError(f"sigma must be positive, got {sigma}")
+    planes = image if image.ndim == 3 else image[np.newaxis]
+    # Bright spots give positive values. The Laplacian must not act along Z, so planes are filtered separately.
+    response = np.stack([-ndimage.gaussian_laplace(plane, sigma) * sigma ** 2 for plane in planes])
+    response = response.reshape(image.shape)
+    plane_window = (2 * min_distance + 1,) * 2 if image.ndim == 2 else (1,) + (2 * min_distance + 1,) * 2
+
+    median = np.median(response)
+    noise = _MAD_TO_STD * np.median(np.abs(response - median))
+    if noise == 0:
+        return np.empty((0, image.ndim), dtype=np.intp)
+
+    peaks = (response == ndimage.maximum_filter(response, size=plane_window, mode="nearest")) & \
+            (response > median + threshold * noise)
+    return np.argwhere(peaks)
+
+
+def assign_pits(pits: np.ndarray, labels: np.ndarray) -> np.ndarray:
+    """
+        The label under each pit, 0 for pits outside cells, looked up for all pits at once.
+    """
+    labels = np.squeeze(np.asarray(labels))
+    if pits.shape[1] != labels.ndim:
+        raise ValueError(f"Pits with {pits.shape[1]} coordinates do not fit labels of shape {labels.shape}")
+    return labels[tuple(pits.T)]
+
+
+def count_pits(pit_labels: np.ndarray, labels: np.ndarray) -> np.ndarray:
+    """
+        Number of pits in each of the given labels, such as region_stats()["label"].
+    """
+    pit_labels = np.asarray(pit_labels, dtype=np.intp)
+    labels = np.asarray(labels, dtype=np.intp)
+    size = max(int(pit_labels.max(initial=0)), int(labels.max(initial=0))) + 1
+    return np.bincount(pit_labels, minlength=size)[labels]
+
+
+def find_cell_pits(image: np.ndarray, labels: np.ndarray, pit_settings: dict, pixel_size=None,
+                   pits: np.ndarray = None, units=None) -> tuple[np.ndarray, np.ndarray]:
+    """
+        Detects the pits of image and assigns them to the cells of labels.
+
+        Parameters:
+            image: np.ndarray -> The channel pits are detected in, with the shape of labels.
+            labels: np.ndarray -> The cell mask.
+            pit_settings: dict -> PitSettings as a dictionary.
+            pixel_size: sequence -> Pixel size, see pit_sigma.
+            pits: np.ndarray -> Pits detected before in the same image, reused when several masks share a channel.
+            units: sequence -> Units of pixel_size, see pit_sigma.
+
+        Returns:
+            tuple -> (pit coordinates, label under each pit).
+    """
+    if pits is None:
+        with span("detect_pits"):
+            pits = detect_pits(image, pit_sigma(pit_settings, pixel_size, units), pit_settings["threshold"],
+                               pit_settings["min_distance"])
+    return pits, assign_pits(pits, labels)
@@ -0,0 +1,76 @@
+import numpy as np
+
+_AXES = {2: ("y", "x"), 3: ("z", "y", "x")}
+
+
+def region_stats(labels: np.ndarray, intensities: list = None) -> dict:
+    """
+        Measures every labelled object of a mask at once.
+
+        All statistics come from reductions over the foreground pixels, bincount for counts and sums and
+        ufunc.at for minima and maxima, so the cost grows with the number of pixels, not with the number of
+        objects, and there is no loop over labels.
+
+        Parameters:
+            labels: np.ndarray -> YX or ZYX labels, 0 is background. Singleton axes are dropped.
+            intensities: list -> Images with the same shape as labels, typically every channel of the file.
+
+        Returns:
+            dict -> Arrays with one entry per object, ordered by label:
+                    label, area (pixels or voxels), centroid_<axis>, bbox_<axis>_min and bbox_<axis>_max
+                    (exclusive) for each axis, and mean_intensity, sum_intensity and max_intensity with shape
+                    (objects, len(intensities)).
+    """
+    labels = np.squeeze(np.asarray(labels))
+    if labels.ndim not in _AXES:
+        raise ValueError(f"Expected YX or ZYX labels, got shape {labels.shape}")
+    if labels.dtype.kind not in "iub":
+        raise TypeError(f"Labels must be integers, got {labels.dtype}")
+    axes = _AXES[labels.ndim]
+    intensities = [np.squeeze(np.asarray(image)) for image in (intensities or [])]
+    for image in intensities:
+        if image.shape != labels.shape:
+            raise ValueError(f"Intensity image of shape {image.shape} does not match labels of shape {labels.shape}")
+
+    flat = labels.ravel()
+    foreground = np.flatnonzero(flat)
+    object_labels = flat[foreground].astype(np.intp)
+    size = int(object_labels.max(initial=0)) + 1
+
+    area = np.bincount(object_labels, minlength=size)
+    present = np.flatnonzero(area)  # Label 0 never counts, as only foreground pixels are used
+    count = area[present]
+
+    stats = {"label": present, "area": count}
+    coordinates = np.unravel_index(foreground, labels.shape)
+    for axis, coordinate in zip(axes, coordinates):
+        stats[f"centroid_{axis}"] = np.bincount(object_labels, weights=coordinate, minlength=size)[present] / count
+    for axis, coordinate in zip(axes, coordinates):
+        low = np.full(size, labels.shape[axes.index(axis)], dtype=np.intp)
+        high = np.full(size, -1, dtype=np.intp)
+        np.minimum.at(low, object_labels, coordinate)
+        np.maximum.at(high, object_labels, coordinate)
+        stats[f"bbox_{axis}_min"] = low[present]
+        stats[f"bbox_{axis}_max"] = high[present] + 1
+
+    means, sums, maxima = [], [], []
+    for image in intensities:
+        values = image.ravel()[foreground]
+        total = np.bincount(object_labels, weights=values, minlength=size)[present]
+        peak = np.full(size, _lowest(values.dtype), dtype=values.dtype)
+        np.maximum.at(peak, object_labels, values)
+        sums.append(total)
+        means.append(total / count)
+        maxima.append(peak[present])
+    stats["mean_intensity"] = np.stack(means, axis=1) if intensities else np.empty((len(present), 0))
+    stats["sum_intensity"] = np.stack(sums, axis=1) if intensities else np.empty((len(present), 0))
+    stats["max_intensity"] = np.stack(maxima, axis=1) if intensities else np.empty((len(present), 0))
+    return stats
+
+
+def _lowest(dtype: np.dtype):
+    if dtype.kind == "f":
+        return -np.inf
+    if dtype.kind == "b":
+        return False
+    return np.iinfo(dtype).min
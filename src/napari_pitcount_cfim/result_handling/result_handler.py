@@ -1,16 +1,19 @@
 # Python
-from pathlib import Path
 from qtpy.QtWidgets import QWidget, QFileDialog, QPushButton
 
+from napari_pitcount_cfim.result_handling.result_table import write_result_table
+from napari_pitcount_cfim.result_handling.result_writer import write_results
+
 
 class ResultHandler(QWidget):
     """
-    A class to handle and output result dictionaries as plain text files.
+    A class to handle and output result dictionaries, as one CSV or Parquet table or as plain text files.
     """
-    def __init__(self, parent=None, output_path=None, prompt_for_folder=True):
+    def __init__(self, parent=None, output_path=None, prompt_for_folder=True, result_format="csv"):
         super().__init__(parent)
         self.output_path = output_path
         self.prompt_for_folder = prompt_for_folder
+        self.result_format = result_format  # "txt", "csv" or "parquet"
         self.skip_output_confirmation = False
         self.results = {}
 
@@ -26,7 +29,8 @@ class ResultHandler(QWidget):
 
     def init_output_button_ui(self):
         self.output_button = QPushButton("Get results")
-        self.output_button.clicked.connect(self._output_results)
+        # clicked passes checked, which must not end up as the results
+        self.output_button.clicked.connect(lambda: self._output_results())
 
         return self.output_button
 
@@ -51,7 +55,8 @@ class ResultHandler(QWidget):
     def _output_results(self, results: dict = None):
         """
                 Take results in the form of a dictionary where each key is a name and the value is a result dictionary.
-                Outputs each result as plain text to a separate file named after the key.
+                Outputs all results as rows of one results.csv or results.parquet table, or with result_format "txt"
+                each result as plain text to a separate file named after the key.
                 """
         if results is None:
             results = self.results
@@ -60,13 +65,7 @@ class ResultHandler(QWidget):
             if not self._select_folder():
                 return  # user cancelled folder selection
 
-        if not self.output_path:
-            raise ValueError("Output path is not set. Please set the output path before outputting results.")
-
-        output_dir = Path(self.output_path)
-        output_dir.mkdir(parents=True, exist_ok=True)
-
-        for name, result in results.items():
-            file_path = output_dir / f"{name}.txt"
-            with open(file_path, "w", encoding="utf-8") as f:
-                f.write(str(result))
+        if self.result_format == "txt":
+            write_results(results, self.output_path)
+        else:
+            write_result_table(results, self.output_path, self.result_format)
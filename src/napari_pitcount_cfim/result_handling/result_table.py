@@ -0,0 +1,295 @@
+import csv
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from napari_pitcount_cfim.measurement.pit_detection import count_pits
+from napari_pitcount_cfim.measurement.region_stats import region_stats
+from napari_pitcount_cfim.tracing import span
+
+# Column name -> type of every result table, image rows leave the object columns empty and object rows the
+# image columns. Kept fixed so tables of separate runs concatenate without reconciling columns.
+RESULT_SCHEMA = {
+    "level": "str",  # "image" or "object"
+    "name": "str",  # <file>_C<channel>, or the layer name
+    "file": "str",
+    "channel": "int",
+    "channel_name": "str",
+    "cell_count": "int",
+    "pit_count": "int",  # Pits inside cells for image rows, inside the cell for object rows
+    "diameter": "float",
+    "scale_y": "float",
+    "scale_x": "float",
+    "unit": "str",
+    "object_id": "int",
+    "area_px": "int",
+    "centroid_y": "float",
+    "centroid_x": "float",
+    "bbox_y_min": "int",
+    "bbox_x_min": "int",
+    "bbox_y_max": "int",  # Exclusive
+    "bbox_x_max": "int",
+    "intensity_channel": "int",  # Channel of the file the intensities below are measured in
+    "mean_intensity": "float",
+    "sum_intensity": "float",
+    "max_intensity": "float",
+}
+
+TABLE_FORMATS = ("csv", "parquet")
+
+_ARROW_TYPES = {"str": "string", "int": "int64", "float": "float64"}
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("Parquet output needs pyarrow, install it with pip install pyarrow, "
+                          "or write CSV instead.") from e
+    return pyarrow
+
+
+class ResultTableSink:
+    """
+        Streams result rows into a single CSV or Parquet file.
+
+        Rows are buffered and appended batch_rows at a time, as one row group per batch for Parquet. Everything
+        is written to a temporary file next to the target, which only replaces the target on close(), so a
+        crashed or aborted run never leaves a truncated table behind. Safe to use from several threads.
+    """
+    def __init__(self, path, file_format: str = None, schema: dict = None, batch_rows: int = 4096):
+        """
+        Parameters:
+            path: str | Path -> The table file.
+            file_format: str -> "csv" or "parquet", None takes it from the file suffix.
+            schema: dict -> Column name -> "str", "int" or "float". Defaults to RESULT_SCHEMA.
+            batch_rows: int -> Rows buffered before they are appended to the file.
+        """
+        self.path = Path(path)
+        self.file_format = file_format or self.path.suffix.lstrip(".").lower()
+        if self.file_format not in TABLE_FORMATS:
+            raise ValueError(f"Unknown table format {self.file_format!r}, expected one of {TABLE_FORMATS}")
+        if batch_rows < 1:
+            raise ValueError(f"batch_rows must be at least 1, got {batch_rows}")
+        self.schema = dict(schema or RESULT_SCHEMA)
+        self.batch_rows = batch_rows
+        self.rows_written = 0
+        self._pyarrow = _import_pyarrow() if self.file_format == "parquet" else None
+        self._chunks = []  # (column dictionary, row count) not yet written
+        self._buffered = 0
+        self._lock = threading.Lock()
+        self._temp_path = None
+        self._writer = None  # Open csv file, or pyarrow ParquetWriter
+        self._csv_writer = None
+        self._closed = False
+
+    def add_row(self, row: dict):
+        self.add_columns({key: [value] for key, value in row.items()})
+
+    def add_rows(self, rows: list):
+        if rows:
+            columns = set().union(*rows)
+            self.add_columns({column: [row.get(column) for row in rows] for column in columns}, length=len(rows))
+
+    def add_columns(self, columns: dict, length: int = None):
+        """
+            Adds rows given per column, such as arrays of per-object measurements, without building a dictionary
+            per row. Columns not given are left empty, single values are repeated over all rows.
+        """
+        unknown = set(columns) - set(self.schema)
+        if unknown:
+            raise ValueError(f"Unknown result columns {sorted(unknown)}")
+        if length is None:
+            lengths = {len(values) for values in columns.values() if np.ndim(values) > 0}
+            if len(lengths) != 1:
+                raise ValueError(f"Columns must have one common length, got {sorted(lengths)}")
+            length = lengths.pop()
+        chunk = {}
+        for column, values in columns.items():
+            if np.ndim(values) == 0:
+                values = [values] * length
+            elif len(values) != length:
+                raise ValueError(f"Column {column} has {len(values)} rows, expected {length}")
+            chunk[column] = values.tolist() if isinstance(values, np.ndarray) else list(values)
+
+        with self._lock:
+            if self._closed:
+                raise ValueError("The result table is already closed")
+            self._chunks.append((chunk, length))
+            self._buffered += length
+            if self._buffered >= self.batch_rows:
+                self._flush_locked()
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def close(self):
+        """
+            Writes the remaining rows and moves the finished table into place.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._flush_locked(force=True)
+            self._close_writer()
+            os.replace(self._temp_path, self.path)
+            self._closed = True
+
+    def abort(self):
+        """
+            Drops the table, the target file is left as it was.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._chunks = []
+            try:
+                self._close_writer()
+            finally:
+                if self._temp_path is not None and os.path.exists(self._temp_path):
+                    os.remove(self._temp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _flush_locked(self, force: bool = False):
+        if self._writer is None:
+            self._open_writer()
+        if not self._chunks:
+            if force and self.file_format == "parquet" and self.rows_written == 0:
+                self._writer.write_table(self._arrow_table({column: [] for column in self.schema}))
+            return
+
+        batch = {column: [] for column in self.schema}
+        for chunk, length in self._chunks:
+            for column in self.schema:
+                batch[column].extend(chunk.get(column, [None] * length))
+        count = self._buffered
+        self._chunks = []
+        self._buffered = 0
+
+        with span("write_results", self.path.name, format=self.file_format, rows=count):
+            if self.file_format == "csv":
+                self._csv_writer.writerows(zip(*(self._csv_values(batch[column], kind)
+                                                 for column, kind in self.schema.items())))
+            else:
+                self._writer.write_table(self._arrow_table(batch))
+        self.rows_written += count
+
+    def _open_writer(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        handle, self._temp_path = tempfile.mkstemp(dir=self.path.parent, prefix=f".{self.path.name}.",
+                                                   suffix=".tmp")
+        if self.file_format == "csv":
+            self._writer = os.fdopen(handle, "w", encoding="utf-8", newline="")
+            self._csv_writer = csv.writer(self._writer)
+            self._csv_writer.writerow(list(self.schema))
+        else:
+            os.close(handle)
+            self._writer = self._pyarrow.parquet.ParquetWriter(self._temp_path, self._arrow_schema())
+
+    def _close_writer(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            self._csv_writer = None
+
+    @staticmethod
+    def _csv_values(values: list, kind: str) -> list:
+        if kind == "float":
+            return ["" if value is None else repr(float(value)) for value in values]
+        return ["" if value is None else value for value in values]
+
+    def _arrow_schema(self):
+        pa = self._pyarrow
+        return pa.schema([(column, getattr(pa, _ARROW_TYPES[kind])()) for column, kind in self.schema.items()])
+
+    def _arrow_table(self, batch: dict):
+        return self._pyarrow.Table.from_pydict(batch, schema=self._arrow_schema())
+
+
+def image_row(name: str, result: dict) -> dict:
+    """
+        The image row of a result dictionary as made by the batch command or the widget.
+    """
+    scale = list(result.get("scale") or ())
+    units = list(result.get("units") or ())
+    return {
+        "level": "image",
+        "name": name,
+        "file": result.get("file"),
+        "channel": result.get("channel"),
+        "channel_name": result.get("name"),
+        "cell_count": result.get("cell_count"),
+        "pit_count": result.get("pit_count"),
+        "diameter": result.get("diameter"),
+        "scale_y": scale[-2] if len(scale) >= 2 else None,
+        "scale_x": scale[-1] if scale else None,
+        "unit": str(units[-1]) if units else None,
+    }
+
+
+def object_columns(name: str, masks: np.ndarray, intensities: list = None, pit_labels: np.ndarray = None) -> dict:
+    """
+        Per-object rows of a mask as columns for add_columns, see region_stats. With intensities there is one row
+        per object and channel, numbered by intensity_channel, so the schema does not depend on the channel count.
+        Z stacks get their YX centroid and bounding box. pit_labels, the label under each pit from
+        find_cell_pits, adds the pit count of every object.
+    """
+    with span("region_stats", name):
+        stats = region_stats(masks, intensities)
+    objects = len(stats["label"])
+    channels = stats["mean_intensity"].shape[1]
+    repeats = max(channels, 1)
+
+    columns = {
+        "level": ["object"] * (objects * repeats),
+        "name": [name] * (objects * repeats),
+        "object_id": stats["label"],
+        "area_px": stats["area"],
+    }
+    for axis in ("y", "x"):
+        columns[f"centroid_{axis}"] = stats[f"centroid_{axis}"]
+        columns[f"bbox_{axis}_min"] = stats[f"bbox_{axis}_min"]
+        columns[f"bbox_{axis}_max"] = stats[f"bbox_{axis}_max"]
+    if pit_labels is not None:
+        columns["pit_count"] = count_pits(pit_labels, stats["label"])
+    for column in list(columns)[2:]:
+        columns[column] = np.repeat(columns[column], repeats)
+    if channels:
+        columns["intensity_channel"] = np.tile(np.arange(channels), objects)
+        for statistic in ("mean_intensity", "sum_intensity", "max_intensity"):
+            columns[statistic] = stats[statistic].ravel()  # Object major, matching the repeats above
+    return columns
+
+
+def write_result_table(results: dict, output_path, file_format: str = "csv", file_name: str = "results") -> Path:
+    """
+        Writes the image rows of results, {name: result dictionary}, to <output_path>/<file_name>.<format>,
+        followed by the object rows of results holding object_columns under "objects".
+
+        Returns:
+            Path -> The written table.
+    """
+    if not output_path:
+        raise ValueError("Output path is not set. Please set the output path before outputting results.")
+    path = Path(output_path) / f"{file_name}.{file_format}"
+    with ResultTableSink(path, file_format) as sink:
+        sink.add_rows([image_row(name, result) for name, result in results.items()])
+        for result in results.values():
+            objects = result.get("objects")
+            if objects is not None:
+                sink.add_columns(objects, length=len(objects["object_id"]))
+    return path
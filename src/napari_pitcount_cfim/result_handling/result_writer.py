@@ -0,0 +1,22 @@
+from pathlib import Path
+
+from napari_pitcount_cfim.tracing import span
+
+
+def write_results(results: dict, output_path):
+    """
+        Take results in the form of a dictionary where each key is a name and the value is a result dictionary.
+        Outputs each result as plain text to a separate file named after the key.
+        Kept free of Qt, so it can be used outside the widget.
+    """
+    if not output_path:
+        raise ValueError("Output path is not set. Please set the output path before outputting results.")
+
+    output_dir = Path(output_path)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    for name, result in results.items():
+        file_path = output_dir / f"{name}.txt"
+        with span("write_results", name, format="txt"), open(file_path, "w", encoding="utf-8") as f:
+            # Per-object columns only go into result tables
+            f.write(str({key: value for key, value in result.items() if key != "objects"}))
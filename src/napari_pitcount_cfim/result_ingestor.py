@@ -0,0 +1,105 @@
+import contextlib
+import logging
+from collections import deque
+
+from qtpy.QtCore import QObject, QTimer, Signal
+
+from napari_pitcount_cfim.tracing import span
+
+
+class ResultIngestor(QObject):
+    """
+        Collects finished segmentation results and hands them on in throttled batches.
+
+        Results arriving while a batch is pending are queued, and at most max_batch of them are handed to ingest
+        per interval_ms, so the event loop gets to draw and handle input between batches however many images
+        finish at once. Each batch runs inside suspend(), which the viewer uses to hold back redraws until the
+        whole batch is in.
+    """
+    flushed = Signal()  # emitted after each batch, also when the queue was empty
+    drained = Signal()  # emitted when a batch leaves the queue empty
+
+    def __init__(self, ingest, interval_ms: int = 100, max_batch: int = 8, suspend=None, parent=None):
+        """
+        Parameters:
+            ingest: callable -> Called as ingest(mask, measurement, image_name) for every result.
+            interval_ms: int -> Minimum time between two batches.
+            max_batch: int -> Results handed on per batch at most.
+            suspend: callable -> Returns the context manager each batch runs in, None runs batches as they are.
+        """
+        super().__init__(parent)
+        self._ingest = ingest
+        self._suspend = suspend or contextlib.nullcontext
+        self._queue = deque()
+        self.max_batch = max_batch
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self._flush)
+        self.interval_ms = interval_ms
+
+    @property
+    def interval_ms(self) -> int:
+        return self._timer.interval()
+
+    @interval_ms.setter
+    def interval_ms(self, value: int):
+        if value < 0:
+            raise ValueError(f"interval_ms must be at least 0, got {value}")
+        self._timer.setInterval(value)
+
+    @property
+    def max_batch(self) -> int:
+        return self._max_batch
+
+    @max_batch.setter
+    def max_batch(self, value: int):
+        if value < 1:
+            raise ValueError(f"max_batch must be at least 1, got {value}")
+        self._max_batch = value
+
+    def add(self, mask, measurement, image_name: str):
+        """
+            Queue a result, it is handed on with the next batch.
+        """
+        self._queue.append((mask, measurement, image_name))
+        self.schedule()
+
+    def schedule(self):
+        """
+            Run a batch once the interval has passed, unless one is already due.
+        """
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def pending(self) -> int:
+        return len(self._queue)
+
+    def clear(self):
+        """
+            Drop the queued results.
+        """
+        self._queue.clear()
+
+    def flush(self):
+        """
+            Hand on every queued result now, in batches of max_batch.
+        """
+        self._timer.stop()
+        while self._queue:
+            self._flush()
+
+    def _flush(self):
+        batch = [self._queue.popleft() for _ in range(min(self._max_batch, len(self._queue)))]
+        if batch:
+            with span("ingest_batch", results=len(batch)), self._suspend():
+                for mask, measurement, image_name in batch:
+                    try:
+                        self._ingest(mask, measurement, image_name)
+                    except Exception:
+                        # A failing result must not take the rest of the batch, or the queue, with it
+                        logging.exception(f"ResultIngestor: could not ingest the result of {image_name}")
+        self.flushed.emit()
+        if self._queue:
+            self._timer.start()
+        elif batch:
+            self.drained.emit()
@@ -0,0 +1,145 @@
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from qtpy.QtCore import Signal
+
+from napari_pitcount_cfim.cellpose_analysis.process_worker import init_worker, segment_shared, \
+    default_threads_per_worker
+from napari_pitcount_cfim.image_handling.shared_arrays import SharedArrayRegistry
+from napari_pitcount_cfim.segmentation_scheduler import BaseSegmentationScheduler
+from napari_pitcount_cfim.segmentation_worker import measure_result
+from napari_pitcount_cfim.tracing import call_traced, get_tracer, span, traced_image, tracing_enabled
+
+
+class ProcessSegmentationScheduler(BaseSegmentationScheduler):
+    """
+        Drop-in alternative to SegmentationScheduler running the segmentation in worker processes.
+
+        Every process has its own interpreter, so pre- and post-processing does not compete for the GIL of the
+        napari process, and a fixed share of CPU threads, so the processes do not oversubscribe the cores. Each
+        process loads its model once and keeps it for the following jobs. A crashing process fails the jobs it
+        was running, the pool is then restarted for the remaining jobs.
+
+        Images are decoded straight into shared memory and masks come back the same way, so only small handles
+        are pickled. Every segment of a job is removed when the job ends, also when it was cancelled or its
+        process crashed. Masks are measured on the dispatch thread that waited for them, off the GUI thread.
+    """
+    # Internal, emitted from the dispatch threads and delivered on the thread owning the scheduler
+    _job_done = Signal(int, object, object)  # emits (job_id, (mask, measurement) pairs or None, exception or None)
+
+    def __init__(self, max_concurrency: int = 2, threads_per_worker: int = None, user_factory=None, parent=None):
+        """
+        Parameters:
+            max_concurrency: int -> Number of worker processes.
+            threads_per_worker: int -> CPU threads per process. None splits the cores evenly.
+            user_factory: callable -> Takes (cellpose_settings, cache, flow_store), called in the worker processes,
+                          so it must be picklable. None creates a CellposeUser.
+        """
+        super().__init__(max_concurrency, parent)
+        self.threads_per_worker = threads_per_worker
+        self.cache = None  # SegmentationCache handed to the workers with every job
+        self.flow_store = None  # SegmentationCache keeping flows, handed to the workers with every job
+        self._user_factory = user_factory
+        self._executor = None
+        self._executor_config = None
+        self._dispatcher = None
+        self._shared = SharedArrayRegistry()
+        self._cancelled = set()  # Running jobs whose results are dropped
+        self._job_done.connect(self._on_job_done)
+
+    def shutdown(self, wait: bool = False):
+        """
+            Stop the worker processes. Queued jobs are dropped, running ones are cancelled.
+        """
+        for job_id in list(self._pending):
+            self.cancel(job_id)
+        self._cancelled.update(self._running)
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+        if self._dispatcher is not None:
+            self._dispatcher.shutdown(wait=wait)
+            self._dispatcher = None
+        if wait:
+            self._shared.release_all()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        threads = self.threads_per_worker or default_threads_per_worker(self.max_concurrency)
+        config = (self.max_concurrency, threads)
+        if self._executor is not None and self._executor_config != config and not self._running:
+            # Settings changed between runs, start fresh processes with the new sizes
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        if self._executor is None:
+            # spawn, as forking a process with Qt and torch threads running is unsafe
+            self._executor = ProcessPoolExecutor(max_workers=self.max_concurrency,
+                                                 mp_context=multiprocessing.get_context("spawn"),
+                                                 initializer=init_worker, initargs=(threads, self._user_factory))
+            self._executor_config = config
+            if self._dispatcher is not None:
+                self._dispatcher.shutdown(wait=False)
+            self._dispatcher = ThreadPoolExecutor(max_workers=self.max_concurrency,
+                                                  thread_name_prefix="SegDispatch")
+        return self._executor
+
+    def _start_job(self, job_id: int, image_data, image_name, cellpose_settings: dict, measure):
+        images = image_data if isinstance(image_data, list) else [image_data]
+        image_names = image_name if isinstance(image_name, list) else [image_name]
+
+        executor = self._get_executor()
+        self._running[job_id] = (image_names, executor)  # The executor, so a crash only resets its own pool
+        future = self._dispatcher.submit(self._run_job, executor, job_id, images, image_names, cellpose_settings,
+                                         self.cache, self.flow_store, measure)
+        future.add_done_callback(lambda future, job_id=job_id: self._job_done.emit(
+            job_id, None if future.exception() else future.result(), future.exception()))
+
+    def _cancel_running(self, job_id: int):
+        # The job finishes in its process, but the result is dropped
+        self._cancelled.add(job_id)
+
+    def _run_job(self, executor, job_id, images, image_names, cellpose_settings, cache, flow_store, measure=None):
+        """
+            Runs on a dispatch thread, so lazy images are decoded and masks are measured off the GUI thread.
+
+            Returns:
+                list -> A (mask, measurement) pair per image, None if the job was cancelled.
+        """
+        if job_id in self._cancelled:
+            return None
+        image_name = "+".join(image_names)
+        try:
+            with traced_image(image_name), span("decode", images=len(images)):
+                handles = [self._shared.share(image, job_id) for image in images]
+            output_names = [self._shared.output_name(job_id) for _ in images]
+            # The process records its own spans, they come back with the masks
+            output_handles, events = executor.submit(call_traced, tracing_enabled(), image_name, segment_shared,
+                                                     handles, output_names, cellpose_settings, cache,
+                                                     flow_store).result()
+            get_tracer().extend(events)
+            masks_list = [None if handle is None else self._shared.collect(handle) for handle in output_handles]
+        finally:
+            self._shared.release(job_id)
+        if job_id in self._cancelled:
+            return None
+        return [(mask, measure_result(measure, mask, name)) for mask, name in zip(masks_list, image_names)]
+
+    def _on_job_done(self, job_id: int, results, error):
+        image_names, executor = self._running.pop(job_id, (None, None))
+        cancelled = job_id in self._cancelled
+        self._cancelled.discard(job_id)
+
+        if isinstance(error, BrokenProcessPool):
+            logging.error(f"Scheduler: a segmentation process died while running {image_names}")
+            if executor is self._executor:
+                # Every job in the broken pool fails, the next ones get a new pool
+                self._executor.shutdown(wait=False)
+                self._executor = None
+        elif error is not None:
+            logging.error(f"Scheduler: exception during segmentation of {image_names}", exc_info=error)
+        elif not cancelled and results is not None:
+            for (mask, measurement), image_name in zip(results, image_names):
+                self.result.emit(mask, measurement, image_name)
+
+        self._finish_job(job_id)
@@ -0,0 +1,173 @@
+import abc
+import heapq
+import itertools
+import logging
+
+from qtpy.QtCore import QObject, Signal
+
+from napari_pitcount_cfim.segmentation_worker import SegmentationWorker, BatchSegmentationWorker
+
+
+def _default_user_factory(cellpose_settings):
+    from napari_pitcount_cfim.cellpose_analysis.cellpose_user import CellposeUser
+
+    return CellposeUser(cellpose_settings=cellpose_settings)
+
+
+class _SchedulerMeta(type(QObject), abc.ABCMeta):
+    """
+        Lets the scheduler base be both a QObject and an abstract base class.
+    """
+
+
+class BaseSegmentationScheduler(QObject, metaclass=_SchedulerMeta):
+    """
+        Queue and cancel bookkeeping shared by the segmentation schedulers.
+
+        Jobs wait in a priority queue, lowest priority value first and first in, first out within a priority.
+        A new job is only started when a running one finishes, so at most max_concurrency inferences compete
+        for cores and memory however many images are submitted. Subclasses start jobs in _start_job, stop their
+        results in _cancel_running and call _finish_job once a started job has ended.
+    """
+    # Same contract as SegmentationWorker.result
+    result = Signal(object, object, str)  # emits (mask_array, measurement or None, image_name)
+    job_finished = Signal(int)  # emits job_id when a job ends, whether it succeeded, failed or was cancelled
+    idle = Signal()  # emitted when the queue is empty and no job is running
+
+    def __init__(self, max_concurrency: int = 2, parent=None):
+        super().__init__(parent)
+        self.max_concurrency = max_concurrency
+        self._queue = []  # heap of (priority, job_id), job ids increase so equal priorities stay FIFO
+        self._pending = {}  # job_id -> (image_data, image_name, cellpose_settings, measure)
+        self._running = {}  # job_id -> whatever the subclass needs to track the job
+        self._job_ids = itertools.count()
+
+    @property
+    def max_concurrency(self) -> int:
+        return self._max_concurrency
+
+    @max_concurrency.setter
+    def max_concurrency(self, value: int):
+        if value < 1:
+            raise ValueError(f"max_concurrency must be at least 1, got {value}")
+        self._max_concurrency = value
+
+    def submit(self, image_data, image_name: str, cellpose_settings: dict, priority: int = 0, measure=None) -> int:
+        """
+            Queue an image for segmentation and start it right away if a slot is free.
+            Lists of images and names are run as one batched job, emitting one result per image.
+
+            Parameters:
+                measure: callable -> Called as measure(mask, image_name) off the GUI thread for every mask, what it
+                         returns is emitted with the mask. It must not touch Qt objects.
+
+            Returns:
+                int -> The job id, used for cancel().
+        """
+        job_id = next(self._job_ids)
+        self._pending[job_id] = (image_data, image_name, cellpose_settings, measure)
+        heapq.heappush(self._queue, (priority, job_id))
+        self._start_next()
+        return job_id
+
+    def cancel(self, job_id: int) -> bool:
+        """
+            Cancel a queued or running job. A running inference can't be interrupted, so the job keeps its slot
+            until the current model call returns, but the result is dropped.
+
+            Returns:
+                bool -> False if the job is unknown or already finished.
+        """
+        if self._pending.pop(job_id, None) is not None:
+            # The heap entry is skipped when popped.
+            self.job_finished.emit(job_id)
+            self._emit_if_idle()
+            return True
+        if job_id in self._running:
+            self._cancel_running(job_id)
+            return True
+        return False
+
+    def cancel_all(self):
+        """
+            Cancel every queued and running job.
+        """
+        for job_id in list(self._pending) + list(self._running):
+            self.cancel(job_id)
+
+    def is_busy(self) -> bool:
+        return bool(self._pending or self._running)
+
+    def queued_count(self) -> int:
+        return len(self._pending)
+
+    def running_count(self) -> int:
+        return len(self._running)
+
+    def _start_next(self):
+        while self._queue and len(self._running) < self.max_concurrency:
+            _, job_id = heapq.heappop(self._queue)
+            job = self._pending.pop(job_id, None)
+            if job is None:
+                continue  # Cancelled while queued
+            self._start_job(job_id, *job)
+        self._emit_if_idle()
+
+    @abc.abstractmethod
+    def _start_job(self, job_id: int, image_data, image_name, cellpose_settings: dict, measure):
+        """
+            Start a job taken off the queue. Started jobs are tracked in _running, a job that can not be started
+            must still emit job_finished.
+        """
+
+    @abc.abstractmethod
+    def _cancel_running(self, job_id: int):
+        """
+            Make sure the result of a running job is dropped.
+        """
+
+    def _finish_job(self, job_id: int):
+        """
+            A started job has ended and was removed from _running, hand its slot to the next one.
+        """
+        self.job_finished.emit(job_id)
+        self._start_next()
+
+    def _emit_if_idle(self):
+        if not self._pending and not self._running:
+            self.idle.emit()
+
+
+class SegmentationScheduler(BaseSegmentationScheduler):
+    """
+        Runs segmentation jobs on a bounded number of SegmentationWorker threads.
+    """
+    def __init__(self, max_concurrency: int = 2, user_factory=None, parent=None):
+        super().__init__(max_concurrency, parent)
+        self._user_factory = user_factory or _default_user_factory
+
+    def _start_job(self, job_id: int, image_data, image_name, cellpose_settings: dict, measure):
+        try:
+            cellpose_user = self._user_factory(cellpose_settings)
+        except Exception:
+            logging.exception(f"Scheduler: could not create a Cellpose user for {image_name}")
+            self.job_finished.emit(job_id)
+            return
+
+        if isinstance(image_data, list):
+            worker = BatchSegmentationWorker(image_data, image_name, cellpose_user, measure)
+        else:
+            worker = SegmentationWorker(image_data, image_name, cellpose_user, measure)
+        worker.result.connect(self.result)
+        worker.finished.connect(lambda job_id=job_id: self._on_worker_finished(job_id))
+        self._running[job_id] = worker
+        worker.start()
+
+    def _cancel_running(self, job_id: int):
+        self._running[job_id].requestInterruption()
+
+    def _on_worker_finished(self, job_id: int):
+        worker = self._running.pop(job_id, None)
+        if worker is not None:
+            worker.deleteLater()
+        self._finish_job(job_id)
@@ -4,30 +4,98 @@ import numpy as np
 from qtpy.QtCore import QThread, Signal
 from qtpy.QtWidgets import QProgressBar
 
+from napari_pitcount_cfim.tracing import span, traced_image
+
+
+def measure_result(measure, mask, image_name: str):
+    """
+        Runs the measure callable of a job on one mask, on the thread that segmented it.
+
+        Returns:
+            object -> What measure returned, None without measure or mask, or when measuring failed, so the mask is
+                      still delivered.
+    """
+    if measure is None or mask is None:
+        return None
+    try:
+        with traced_image(image_name), span("measure"):
+            return measure(mask, image_name)
+    except Exception:
+        logging.exception(f"Could not measure the mask of {image_name}")
+        return None
+
 
 # Worker thread class for running Cellpose on a single image
 class SegmentationWorker(QThread):
-    # Signal to emit the result (mask and image name) back to the main thread
-    result = Signal(object, str)  # emits (mask_array, image_name)
+    # Signal to emit the result (mask, measurement and image name) back to the main thread
+    result = Signal(object, object, str)  # emits (mask_array, measurement or None, image_name)
 
-    def __init__(self, image_data, image_name, cellpose_user):
+    def __init__(self, image_data, image_name, cellpose_user, measure=None):
+        """
+        Parameters:
+            measure: callable -> Called as measure(mask, image_name) for every mask before it is emitted, so the
+                     cells are measured on this thread. None emits the masks without a measurement.
+        """
         super().__init__()
         self.image_data = image_data
         self.image_name = image_name
         self.cellpose_user = cellpose_user
+        self.measure = measure
         self.setObjectName(f"SegWorker-{image_name}")
 
     def run(self):
         """Run Cellpose segmentation on the image in a separate thread."""
         logging.debug(f"Thread {self.objectName()}: starting segmentation")
         try:
-            img = np.asarray(self.image_data)
-
-            masks_list, *_ = self.cellpose_user.process_image(img)
+            if self.isInterruptionRequested():
+                logging.debug(f"Thread {self.objectName()}: cancelled before start")
+                return
+            with traced_image(self.image_name):
+                with span("decode", images=1):
+                    img = np.asarray(self.image_data)
+                masks_list, *_ = self.cellpose_user.process_image(img)
             mask = masks_list[0] if isinstance(masks_list, list) else masks_list
+            # Inference can't be stopped midway, but a cancelled job must not deliver its result.
+            if self.isInterruptionRequested():
+                logging.debug(f"Thread {self.objectName()}: cancelled, dropping result")
+                return
+            measurement = measure_result(self.measure, mask, self.image_name)
             logging.debug(f"Thread {self.objectName()}: segmentation done, emitting result")
-            self.result.emit(mask, self.image_name)
+            self.result.emit(mask, measurement, self.image_name)
         except Exception:
             logging.exception(f"Thread {self.objectName()}: exception during segmentation")
         finally:
+            # Hand the model back to the pool, so it can be evicted once no worker needs it.
+            self.cellpose_user.release()
+            logging.debug(f"Thread {self.objectName()}: exiting run()")
+
+
+# Worker thread class for running Cellpose on a batch of images in one model call
+class BatchSegmentationWorker(SegmentationWorker):
+    def __init__(self, images, image_names, cellpose_user, measure=None):
+        super().__init__(images, image_names, cellpose_user, measure)
+        self.setObjectName(f"SegWorker-{image_names[0]}+{len(image_names) - 1}")
+
+    def run(self):
+        """Run batched Cellpose segmentation in a separate thread and emit one result per image."""
+        logging.debug(f"Thread {self.objectName()}: starting batched segmentation of {len(self.image_name)} images")
+        try:
+            if self.isInterruptionRequested():
+                logging.debug(f"Thread {self.objectName()}: cancelled before start")
+                return
+            with traced_image("+".join(self.image_name)):
+                with span("decode", images=len(self.image_data)):
+                    images = [np.asarray(image) for image in self.image_data]
+                masks_list, *_ = self.cellpose_user.process_images(images)
+            logging.debug(f"Thread {self.objectName()}: segmentation done, emitting results")
+            for mask, image_name in zip(masks_list, self.image_name):
+                if self.isInterruptionRequested():
+                    logging.debug(f"Thread {self.objectName()}: cancelled, dropping results")
+                    return
+                # Each result is emitted once measured, the viewer does not wait for the whole batch
+                self.result.emit(mask, measure_result(self.measure, mask, image_name), image_name)
+        except Exception:
+            logging.exception(f"Thread {self.objectName()}: exception during batched segmentation")
+        finally:
+            self.cellpose_user.release()
             logging.debug(f"Thread {self.objectName()}: exiting run()")
@@ -0,0 +1,251 @@
+"""
+Per-stage timing spans, exported as Chrome trace JSON.
+
+    with span("model.eval", images=4):
+        ...
+
+Spans are only recorded once tracing is on, with DebugSettings.verbosity_level at TRACE_VERBOSITY or above, or
+with the --trace option of the command line. Off, a span costs one attribute check. Each span records the
+process, thread and image it ran for, the image taken from the innermost traced_image() of the thread unless
+given. Open the exported file in chrome://tracing or https://ui.perfetto.dev.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+# verbosity_level from which spans are recorded
+TRACE_VERBOSITY = 2
+
+SpanEvent = namedtuple("SpanEvent", ["name", "start_ns", "duration_ns", "pid", "tid", "thread_name", "image",
+                                     "args"])
+
+_context = threading.local()
+
+
+class _Span:
+    __slots__ = ("_tracer", "_name", "_image", "_args", "_start")
+
+    def __init__(self, tracer, name: str, image: str, args: dict):
+        self._tracer = tracer
+        self._name = name
+        self._image = image
+        self._args = args
+
+    def __enter__(self):
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter_ns()
+        thread = threading.current_thread()
+        args = self._args if exc_type is None else {**self._args, "error": exc_type.__name__}
+        self._tracer.add(SpanEvent(self._name, self._start, end - self._start, os.getpid(), thread.ident,
+                                   thread.name, self._image, args))
+        return False
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Tracer:
+    """
+        Collects the spans of one process. Safe to use from several threads.
+    """
+    def __init__(self, enabled: bool = False, max_events: int = 1_000_000):
+        """
+        Parameters:
+            enabled: bool -> Record spans.
+            max_events: int -> Spans kept at most, the oldest are dropped first, so a run of hours can not fill the
+                               memory.
+        """
+        self.enabled = enabled
+        self.max_events = max_events
+        self._events = []
+        self._dropped = 0
+        self._lock = threading.Lock()
+
+    def span(self, name: str, image: str = None, **args):
+        """
+            Context manager timing its block as the span name, with args shown in the trace.
+        """
+        if not self.enabled:
+            return _NO_SPAN
+        return _Span(self, name, image if image is not None else current_image(), args)
+
+    def add(self, event: SpanEvent):
+        self.extend([event])
+
+    def extend(self, events: list):
+        """
+            Adds finished spans, such as the ones a worker process sent back.
+        """
+        with self._lock:
+            self._events.extend(SpanEvent(*event) for event in events)
+            overflow = len(self._events) - self.max_events
+            if overflow > 0:
+                del self._events[:overflow]
+                self._dropped += overflow
+
+    def events(self) -> list:
+        with self._lock:
+            return list(self._events)
+
+    def drain(self) -> list:
+        """
+            Returns and forgets the recorded spans.
+        """
+        with self._lock:
+            events, self._events = self._events, []
+        return events
+
+    def clear(self):
+        self.drain()
+
+    def summary(self) -> dict:
+        """
+            Returns:
+                dict -> {span name: {"count", "total_s", "mean_s", "max_s"}}, slowest total first.
+        """
+        totals = {}
+        for event in self.events():
+            count, total, longest = totals.get(event.name, (0, 0, 0))
+            totals[event.name] = (count + 1, total + event.duration_ns, max(longest, event.duration_ns))
+        return {name: {"count": count, "total_s": total / 1e9, "mean_s": total / count / 1e9, "max_s": longest / 1e9}
+                for name, (count, total, longest) in sorted(totals.items(), key=lambda item: -item[1][1])}
+
+    def chrome_trace(self) -> dict:
+        """
+            The spans in the Chrome trace event format, complete ("X") events in microseconds from the first span.
+        """
+        events = self.events()
+        origin = min((event.start_ns for event in events), default=0)
+        trace_events = []
+        threads = {}
+        for event in events:
+            args = dict(event.args)
+            if event.image is not None:
+                args["image"] = event.image
+            trace_events.append({"name": event.name, "cat": "pitcount", "ph": "X", "pid": event.pid,
+                                 "tid": event.tid, "ts": (event.start_ns - origin) / 1000,
+                                 "dur": event.duration_ns / 1000, "args": args})
+            threads[(event.pid, event.tid)] = event.thread_name
+        for (pid, tid), thread_name in threads.items():
+            trace_events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                                 "args": {"name": thread_name}})
+        trace = {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+        if self._dropped:
+            trace["otherData"] = {"dropped_spans": self._dropped}
+        return trace
+
+    def export_chrome_trace(self, path) -> str:
+        """
+            Writes chrome_trace() to path, atomically.
+
+            Returns:
+                str -> The path.
+        """
+        path = os.fspath(path)
+        folder = os.path.dirname(os.path.abspath(path))
+        os.makedirs(folder, exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "w", encoding="utf-8") as file:
+                json.dump(self.chrome_trace(), file, default=str)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return path
+
+
+_tracer = None
+
+
+def get_tracer() -> Tracer:
+    """
+        The process-wide tracer.
+    """
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer()
+    return _tracer
+
+
+def span(name: str, image: str = None, **args):
+    """
+        A span of the process-wide tracer, see Tracer.span.
+    """
+    tracer = _tracer
+    if tracer is None or not tracer.enabled:
+        return _NO_SPAN
+    return tracer.span(name, image, **args)
+
+
+def configure_tracing(debug_settings: dict) -> bool:
+    """
+        Turns the process-wide tracer on or off as set by debug_settings["verbosity_level"].
+
+        Returns:
+            bool -> Whether spans are recorded.
+    """
+    enabled = (debug_settings or {}).get("verbosity_level", 0) >= TRACE_VERBOSITY
+    get_tracer().enabled = enabled
+    return enabled
+
+
+def tracing_enabled() -> bool:
+    return _tracer is not None and _tracer.enabled
+
+
+class traced_image:
+    """
+        Context manager naming the image the spans of this thread are recorded for.
+    """
+    def __init__(self, image: str):
+        self._image = image
+
+    def __enter__(self):
+        self._previous = getattr(_context, "image", None)
+        _context.image = self._image
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _context.image = self._previous
+        return False
+
+
+def current_image() -> str:
+    return getattr(_context, "image", None)
+
+
+def call_traced(enabled: bool, image: str, function, *args, **kwargs):
+    """
+        Runs function in a worker process with its tracer on or off, for the image named image.
+
+        Returns:
+            tuple -> (result of function, spans recorded during the call), the spans to hand to Tracer.extend
+                     in the parent process.
+    """
+    tracer = get_tracer()
+    tracer.enabled = enabled
+    tracer.clear()
+    try:
+        with traced_image(image):
+            result = function(*args, **kwargs)
+    finally:
+        events = tracer.drain()
+    return result, [tuple(event) for event in events]
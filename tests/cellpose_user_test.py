@@ -0,0 +1,130 @@
+import numpy as np
+import pytest
+
+from napari_pitcount_cfim.cellpose_analysis.cellpose_user import group_into_batches
+
+
+def test_group_into_batches_splits_by_key_and_size():
+    keys = [(64, 64), (32, 32), (64, 64), (64, 64), (32, 32)]
+
+    batches = group_into_batches(keys, batch_size=2)
+
+    assert batches == [[0, 2], [3], [1, 4]]
+
+def test_group_into_batches_rejects_empty_batches():
+    with pytest.raises(ValueError):
+        group_into_batches([(64, 64)], batch_size=0)
+
+class _FlowModel:
+    """Returns the Cellpose flows of fixed labels instead of running a network, and counts the calls."""
+    diam_mean = 30.0
+
+    def __init__(self, labels):
+        from cellpose.dynamics import masks_to_flows
+
+        self.labels = labels
+        self.d_p = 5 * masks_to_flows(labels).astype(np.float32)  # The network predicts five times the flows
+        self.cell_probability = np.where(labels > 0, 4.0, -4.0).astype(np.float32)
+        self.calls = 0
+
+    def eval(self, images, **kwargs):
+        self.calls += 1
+        count = len(images)
+        flows = [np.zeros((count, *self.labels.shape, 3)), np.stack([self.d_p] * count, axis=1),
+                 np.stack([self.cell_probability] * count)]
+        return np.stack([self.labels] * count), flows, np.zeros((count, 256)), kwargs["diameter"]
+
+
+@pytest.fixture
+def flow_model(monkeypatch):
+    from napari_pitcount_cfim.cellpose_analysis import model_pool
+    from napari_pitcount_cfim.cellpose_analysis.model_pool import ModelPool
+
+    labels = np.zeros((96, 96), dtype=np.int32)
+    labels[10:30, 10:30] = 1
+    labels[40:70, 50:80] = 2
+    labels[75:79, 10:14] = 3  # 16 pixels, dropped by min_size 30
+    model = _FlowModel(labels)
+    monkeypatch.setattr(model_pool, "_model_pool", ModelPool(model_factory=lambda *_: model))
+    return model
+
+
+def test_masks_are_recomputed_from_kept_flows(tmp_path, flow_model):
+    from napari_pitcount_cfim.cellpose_analysis.cellpose_user import CellposeUser
+    from napari_pitcount_cfim.cellpose_analysis.segmentation_cache import SegmentationCache
+    from napari_pitcount_cfim.config.settings_structure import CellposeSettings
+
+    image = np.random.default_rng(0).integers(0, 4000, (96, 96), dtype=np.uint16)
+    flow_store = SegmentationCache(str(tmp_path), store_flows=True)
+    settings = CellposeSettings(diameter=30, border_filter=False).model_dump()
+
+    user = CellposeUser(settings, flow_store=flow_store)
+    user.process_image(image)
+    user.release()
+    assert flow_model.calls == 1
+
+    user = CellposeUser({**settings, "min_size": -1, "flows_only": True}, flow_store=flow_store)
+    masks, *_ = user.process_image(image)
+    user.release()
+
+    assert flow_model.calls == 1  # Rebuilt from the flows, the network did not run again
+    assert len(np.unique(masks)) == 4  # The small cell is kept without min_size
+    for label in (1, 2, 3):
+        assert len(np.unique(masks[flow_model.labels == label])) == 1
+
+
+def test_flows_only_skips_images_without_flows(tmp_path, flow_model):
+    from napari_pitcount_cfim.cellpose_analysis.cellpose_user import CellposeUser
+    from napari_pitcount_cfim.cellpose_analysis.segmentation_cache import SegmentationCache
+    from napari_pitcount_cfim.config.settings_structure import CellposeSettings
+
+    settings = {**CellposeSettings(diameter=30).model_dump(), "flows_only": True}
+    user = CellposeUser(settings, flow_store=SegmentationCache(str(tmp_path), store_flows=True))
+    masks, *_ = user.process_image(np.zeros((96, 96), dtype=np.uint16))
+    user.release()
+
+    assert masks is None
+    assert flow_model.calls == 0
+
+
+def test_masks_come_small_and_without_flows(tmp_path, flow_model):
+    from napari_pitcount_cfim.cellpose_analysis.cellpose_user import CellposeUser
+    from napari_pitcount_cfim.config.settings_structure import CellposeSettings
+
+    user = CellposeUser(CellposeSettings(diameter=30, border_filter=False).model_dump())
+    image = np.zeros((96, 96), dtype=np.uint16)
+    masks_list, flows_list, *_ = user.process_images([image, image])
+    masks, flows, *_ = user.process_image(image, return_flows=True)
+    user.release()
+
+    assert [masks.dtype for masks in masks_list] == [np.uint8, np.uint8]
+    assert flows_list == [None, None]
+    assert flows[1].shape == (2, 96, 96)
+
+
+def test_estimated_diameters_use_the_job_acquisitions_and_recompute(tmp_path, flow_model, monkeypatch):
+    from napari_pitcount_cfim.cellpose_analysis.cellpose_user import CellposeUser
+    from napari_pitcount_cfim.cellpose_analysis.segmentation_cache import SegmentationCache
+    from napari_pitcount_cfim.config.settings_structure import CellposeSettings
+
+    estimated = []
+
+    def estimate_sizes(self, images, acquisitions=None):
+        estimated.append(acquisitions)
+        return [30.0] * len(images)
+
+    monkeypatch.setattr(CellposeUser, "estimate_sizes", estimate_sizes)
+    acquisition = {"pixel_size": [0.1, 0.1], "objective": None, "emission": None}
+    settings = {**CellposeSettings(diameter=None, border_filter=False).model_dump(), "acquisitions": [acquisition]}
+    flow_store = SegmentationCache(str(tmp_path), store_flows=True)
+    image = np.random.default_rng(0).integers(0, 4000, (96, 96), dtype=np.uint16)
+
+    user = CellposeUser(settings, flow_store=flow_store)
+    user.process_image(image)
+    user.release()
+    user = CellposeUser({**settings, "flows_only": True}, flow_store=flow_store)
+    masks, *_ = user.process_image(image)
+    user.release()
+
+    assert estimated == [[acquisition]]  # Estimated once, on the worker, recomputing reuses the kept flows
+    assert masks is not None and flow_model.calls == 1
@@ -0,0 +1,140 @@
+import csv
+import json
+import subprocess
+import sys
+
+import numpy as np
+import tifffile
+
+from napari_pitcount_cfim import cli
+from napari_pitcount_cfim.config.settings_structure import CFIMSettings
+
+
+class _FakeCellposeUser:
+    """Thresholds the images instead of running a network."""
+    def __init__(self, cellpose_settings, cache=None, diameter_cache=None):
+        self.released = False
+
+    def process_images(self, images, acquisitions=None):
+        masks = [(np.asarray(img) > 0).astype(np.int32) for img in images]
+        return masks, [None] * len(images), [None] * len(images), [17.0] * len(images)
+
+    def release(self):
+        self.released = True
+
+
+def _fake_read_czi(path, backend=None, decode=None):
+    data = np.zeros((1, 8, 8), dtype=np.uint16)
+    data[0, 2:4, 2:4] = 1
+    layers = [(data, {"name": f"Channel {channel}", "scale": [1.0, 0.1, 0.1]}, "image") for channel in range(2)]
+    return lambda _path=None: layers
+
+
+def test_import_does_not_load_napari_or_qt():
+    code = ("import sys, napari_pitcount_cfim.cli; "
+            "loaded = [m for m in sys.modules if m == 'napari' or m.startswith(('napari.', 'qtpy', 'PyQt'))]; "
+            "print(loaded); sys.exit(1 if loaded else 0)")
+    completed = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+    assert completed.returncode == 0, completed.stdout + completed.stderr
+
+def test_batch_writes_masks_and_results(tmp_path, monkeypatch):
+    monkeypatch.setattr(cli, "read_czi", _fake_read_czi)
+    input_folder = tmp_path / "in"
+    input_folder.mkdir()
+    for name in ["a.czi", "b.czi", "notes.txt"]:
+        (input_folder / name).touch()
+    output_folder = tmp_path / "out"
+
+    failed = cli.run_batch(str(input_folder), str(output_folder), CFIMSettings(), workers=2,
+                           user_factory=_FakeCellposeUser, result_format="txt")
+
+    assert failed == 0
+    for stem in ["a", "b"]:
+        for channel in range(2):
+            mask = tifffile.imread(output_folder / f"{stem}_C{channel}_mask.tif")
+            assert mask.sum() == 4
+            result = (output_folder / f"{stem}_C{channel}.txt").read_text(encoding="utf-8")
+            assert "'cell_count': 1" in result
+    assert not (output_folder / "notes_C0_mask.tif").exists()
+
+def test_batch_streams_results_table(tmp_path, monkeypatch):
+    monkeypatch.setattr(cli, "read_czi", _fake_read_czi)
+    input_folder = tmp_path / "in"
+    input_folder.mkdir()
+    for name in ["a.czi", "b.czi"]:
+        (input_folder / name).touch()
+    output_folder = tmp_path / "out"
+
+    assert cli.run_batch(str(input_folder), str(output_folder), CFIMSettings(), workers=2,
+                         user_factory=_FakeCellposeUser) == 0
+
+    with open(output_folder / "results.csv", newline="", encoding="utf-8") as file:
+        rows = list(csv.DictReader(file))
+    images = sorted((row["name"], row["cell_count"], row["scale_x"]) for row in rows if row["level"] == "image")
+    assert images == [(f"{stem}_C{channel}", "1", "0.1") for stem in "ab" for channel in range(2)]
+    # One row per mask object and channel of the file
+    objects = [row for row in rows if row["level"] == "object"]
+    assert len(objects) == 8
+    assert all(row["area_px"] == "4" and float(row["centroid_y"]) == 2.5 for row in objects)
+    assert all(float(row["mean_intensity"]) == 1.0 for row in objects)
+    assert not list(output_folder.glob("*.txt"))
+
+def test_batch_reports_failures(tmp_path, monkeypatch):
+    def _broken_read_czi(path, backend=None, decode=None):
+        raise OSError("not a czi file")
+    monkeypatch.setattr(cli, "read_czi", _broken_read_czi)
+    (tmp_path / "broken.czi").touch()
+
+    assert cli.run_batch(str(tmp_path), str(tmp_path / "out"), CFIMSettings(), user_factory=_FakeCellposeUser) == 1
+
+def test_batch_writes_a_chrome_trace(tmp_path, monkeypatch):
+    from napari_pitcount_cfim import tracing
+
+    monkeypatch.setattr(cli, "read_czi", _fake_read_czi)
+    monkeypatch.setattr(tracing, "_tracer", tracing.Tracer())
+    input_folder = tmp_path / "in"
+    input_folder.mkdir()
+    (input_folder / "a.czi").touch()
+    trace_path = tmp_path / "trace.json"
+
+    cli.run_batch(str(input_folder), str(tmp_path / "out"), CFIMSettings(), user_factory=_FakeCellposeUser,
+                  result_format="csv", trace_path=str(trace_path))
+
+    events = [event for event in json.loads(trace_path.read_text(encoding="utf-8"))["traceEvents"]
+              if event["ph"] == "X"]
+    names = {event["name"] for event in events}
+    assert {"decode", "segment", "write_mask", "detect_pits", "region_stats", "write_results"} <= names
+    assert {event["args"].get("image") for event in events if event["name"] == "decode"} == {"a.czi"}
+
+def test_purge_cache_removes_the_pixel_cache(tmp_path, capsys):
+    from napari_pitcount_cfim.config.settings_io import cache_folder
+    from napari_pitcount_cfim.czi_reader_plugin.pixel_cache import PixelCache
+
+    cache = PixelCache(cache_folder(str(tmp_path), "pixels"), storage="memmap")
+    cache.put("a", np.zeros((1, 1, 16, 16), dtype=np.uint16))
+    segmentation_entry = tmp_path / "napari_pitcount_cfim_cache" / "segmentation" / "entry.npz"
+    segmentation_entry.parent.mkdir()
+    segmentation_entry.touch()
+    settings_file = tmp_path / "napari_pitcount_cfim_settings.yaml"
+    settings_file.touch()
+
+    assert cli.main(["purge-cache", "--settings-folder", str(tmp_path)]) == 0
+    assert cache.size_bytes() == 0
+    assert segmentation_entry.exists()
+    assert "MiB freed" in capsys.readouterr().out
+
+    assert cli.main(["purge-cache", "--settings-folder", str(tmp_path), "--all"]) == 0
+    assert not segmentation_entry.exists()
+    assert settings_file.exists()
+
+def test_purge_cache_defaults_to_the_settings_folder(tmp_path, monkeypatch, capsys):
+    from napari_pitcount_cfim.config.settings_io import cache_folder
+    from napari_pitcount_cfim.czi_reader_plugin.pixel_cache import PixelCache
+
+    monkeypatch.setenv("PITCOUNT_CFIM_SETTINGS_FOLDER", str(tmp_path))
+    cache = PixelCache(cache_folder(str(tmp_path), "pixels"), storage="memmap")
+    cache.put("a", np.zeros((1, 1, 16, 16), dtype=np.uint16))
+
+    assert cli.main(["purge-cache"]) == 0
+    assert cache.size_bytes() == 0
+    assert str(tmp_path) in capsys.readouterr().out
@@ -0,0 +1,172 @@
+import numpy as np
+import pytest
+
+from napari_pitcount_cfim.czi_reader_plugin import czi_reader_CFIM
+from napari_pitcount_cfim.czi_reader_plugin.czi_reader_CFIM import SharedStack, read_czi
+from napari_pitcount_cfim.czi_reader_plugin.libczi_reader import LibCziReader
+from napari_pitcount_cfim.czi_reader_plugin.metadata_index import set_metadata_index_folder
+from napari_pitcount_cfim.czi_reader_plugin.pixel_cache import PixelCache, set_pixel_cache
+
+
+@pytest.fixture
+def czi_file(tmp_path):
+    """A 3 channel, 2 plane CZI whose pixel values encode channel and plane."""
+    pyczi = pytest.importorskip("pylibCZIrw.czi", exc_type=ImportError)
+    set_metadata_index_folder(None)
+    stack = np.arange(3 * 2 * 16 * 16, dtype=np.uint16).reshape(3, 2, 16, 16)
+    path = str(tmp_path / "stack.czi")
+    with pyczi.create_czi(path, exist_ok=True) as writer:
+        for channel, planes in enumerate(stack):
+            for z, plane in enumerate(planes):
+                writer.write(data=np.ascontiguousarray(plane), plane={"C": channel, "Z": z, "T": 0})
+        writer.write_metadata(document_name="stack", channel_names={c: f"C{c}" for c in range(3)},
+                              scale_x=1e-7, scale_y=1e-7, scale_z=5e-7)
+    yield path, stack
+    set_metadata_index_folder(None)
+
+
+# Top left corner (y, x) of each mosaic tile, in M index order
+MOSAIC_TILES = [(0, 0), (0, 24), (16, 0), (16, 24)]
+
+
+@pytest.fixture
+def czi_mosaic(tmp_path):
+    """A 2 channel, 3 plane CZI of 2 x 2 tiles of 16 x 24 pixels, with the stitched planes."""
+    pyczi = pytest.importorskip("pylibCZIrw.czi", exc_type=ImportError)
+    set_metadata_index_folder(None)
+    stack = np.random.default_rng(0).integers(0, 60000, (2, 3, 32, 48), dtype=np.uint16)
+    path = str(tmp_path / "mosaic.czi")
+    with pyczi.create_czi(path, exist_ok=True) as writer:
+        for channel, planes in enumerate(stack):
+            for z, plane in enumerate(planes):
+                for y, x in MOSAIC_TILES:
+                    writer.write(data=np.ascontiguousarray(plane[y:y + 16, x:x + 24]), location=(x, y),
+                                 plane={"C": channel, "Z": z, "T": 0})
+        writer.write_metadata(document_name="mosaic", channel_names={0: "C0", 1: "C1"},
+                              scale_x=1e-7, scale_y=1e-7, scale_z=5e-7)
+    yield path, stack
+    set_metadata_index_folder(None)
+
+
+@pytest.mark.parametrize("backend", ["aicsimageio", "aicspylibczi"])
+def test_channels_are_views_of_one_decode(czi_file, backend, monkeypatch):
+    path, stack = czi_file
+    decodes = []
+    array = SharedStack.array
+
+    def counted_array(self):
+        if self._owner is None or self._owner() is None:
+            decodes.append(self.shape)
+        return array(self)
+
+    monkeypatch.setattr(SharedStack, "array", counted_array)
+    layers = read_czi(path, backend=backend, decode="file")()
+    assert decodes == []  # Nothing is decoded when the file is opened
+
+    channels = [np.asarray(data) for data, _, _ in layers]
+    assert decodes == [(3, 2, 16, 16)]
+    for channel, data in enumerate(channels):
+        np.testing.assert_array_equal(data, stack[channel])
+        assert data.base is channels[0].base
+    np.testing.assert_array_equal(layers[2][0][1], stack[2, 1])
+
+def test_opening_with_default_settings_decodes_nothing(czi_file, tmp_path, monkeypatch):
+    path, stack = czi_file
+    monkeypatch.setenv("PITCOUNT_CFIM_SETTINGS_FOLDER", str(tmp_path / "settings"))
+    set_pixel_cache(None)
+    decodes = []
+    monkeypatch.setattr(SharedStack, "array", lambda self: decodes.append(self.shape))
+
+    layers = read_czi(path)()
+    # napari scans the layer data for contrast limits on the GUI thread, which must not decode the whole file
+    for data, _, _ in layers:
+        np.asarray(data[0])
+    assert decodes == []
+    np.testing.assert_array_equal(np.asarray(layers[1][0]), stack[1])
+
+@pytest.mark.parametrize("backend", ["aicsimageio", "aicspylibczi"])
+def test_plane_decoding_reads_the_same_pixels(czi_file, backend):
+    path, stack = czi_file
+    layers = read_czi(path, backend=backend, decode="plane")()
+    for channel, (data, _, _) in enumerate(layers):
+        np.testing.assert_array_equal(np.asarray(data), stack[channel])
+
+def test_buffer_is_decoded_again_once_no_view_is_left():
+    decodes = []
+
+    def decode():
+        decodes.append(1)
+        return np.ones((2, 1, 4, 4))
+
+    stack = SharedStack(decode, (2, 1, 4, 4), np.float64)
+    first = np.asarray(stack.channel(0))
+    np.asarray(stack.channel(1))
+    assert len(decodes) == 1
+    del first
+    np.asarray(stack.channel(1))
+    assert len(decodes) == 2
+
+def test_views_of_readers_returning_reshaped_arrays_share_the_owner():
+    owner = np.zeros((1, 1, 2, 1, 4, 4))
+    assert czi_reader_CFIM._owning_array(owner.reshape(2, 1, 4, 4)) is owner
+    strided = np.zeros((2, 1, 4, 8))[..., ::2]
+    assert czi_reader_CFIM._owning_array(strided).flags.owndata
+
+@pytest.mark.parametrize("backend", ["aicsimageio", "aicspylibczi"])
+def test_reopened_files_are_mapped_from_the_pixel_cache(czi_file, backend, tmp_path, monkeypatch):
+    path, stack = czi_file
+    decodes = []
+    cache = PixelCache(str(tmp_path / "pixels"), storage="memmap")
+    set_pixel_cache(cache)
+    try:
+        first = read_czi(path, backend=backend, decode="file")()
+        assert cache.size_bytes() == 0  # Written once decoded, not on open
+        np.asarray(first[0][0])
+        assert cache.size_bytes() > 0
+
+        monkeypatch.setattr(SharedStack, "array", lambda self: decodes.append(1))
+        layers = read_czi(path, backend=backend, decode="file")()
+        for channel, (data, _, _) in enumerate(layers):
+            assert isinstance(data, np.memmap)
+            np.testing.assert_array_equal(data, stack[channel])
+        assert decodes == []
+    finally:
+        set_pixel_cache(None)
+
+def test_mosaic_scenes_are_stitched(czi_mosaic):
+    path, stack = czi_mosaic
+    reader = LibCziReader(path)
+
+    assert reader.is_mosaic
+    assert reader.plane_shape() == (32, 48)
+    np.testing.assert_array_equal(reader.read_plane(1, 2), stack[1, 2])
+    np.testing.assert_array_equal(reader.read_stack(), stack)
+
+def test_mosaic_tiles_are_read_alone(czi_mosaic):
+    path, stack = czi_mosaic
+    reader = LibCziReader(path)
+
+    assert reader.plane_shape(tile=1) == (16, 24)
+    for tile, (y, x) in enumerate(MOSAIC_TILES):
+        np.testing.assert_array_equal(reader.read_plane(1, 2, tile=tile), stack[1, 2, y:y + 16, x:x + 24])
+    np.testing.assert_array_equal(reader.read_plane(0, 1, tile=3, bbox=(2, 10, 4, 20)), stack[0, 1, 18:26, 28:44])
+
+def test_regions_and_z_ranges_match_the_full_plane(czi_mosaic):
+    path, stack = czi_mosaic
+    reader = LibCziReader(path)
+    bbox = (5, 27, 10, 40)  # Crosses all four tiles
+
+    np.testing.assert_array_equal(reader.read_plane(0, 1, bbox=bbox), stack[0, 1, 5:27, 10:40])
+    np.testing.assert_array_equal(reader.read(1, z_range=(1, 3)), stack[1, 1:3])
+    np.testing.assert_array_equal(reader.read_stack(z_range=(0, 2), bbox=bbox), stack[:, 0:2, 5:27, 10:40])
+    lazy = reader.get_dask_data(1, z_range=(1, 3), bbox=bbox)
+    assert lazy.shape == (2, 22, 30)
+    np.testing.assert_array_equal(lazy.compute(), stack[1, 1:3, 5:27, 10:40])
+
+def test_regions_of_single_tile_files_match_the_full_plane(czi_file):
+    path, stack = czi_file
+    reader = LibCziReader(path)
+
+    assert not reader.is_mosaic
+    np.testing.assert_array_equal(reader.read_plane(2, 1, bbox=(3, 11, 0, 16)), stack[2, 1, 3:11])
+    np.testing.assert_array_equal(reader.read(1, z_range=(1, 2), bbox=(0, 8, 8, 16)), stack[1, 1:2, 0:8, 8:16])
@@ -0,0 +1,91 @@
+import threading
+
+import numpy as np
+from scipy import ndimage
+
+from napari_pitcount_cfim.cellpose_analysis.diameter_estimator import DiameterCache, DiameterEstimator, \
+    acquisition_info, downscale, sample_crops
+
+
+def _disks(shape, diameter, spacing, region=None):
+    """Bright disks of the given diameter on a grid, only inside region (y0, y1, x0, x1) if given."""
+    image = np.zeros(shape, dtype=np.float32)
+    rows, cols = np.indices(shape)
+    y0, y1, x0, x1 = region or (0, shape[0], 0, shape[1])
+    for y in range(y0 + spacing // 2, y1 - spacing // 2, spacing):
+        for x in range(x0 + spacing // 2, x1 - spacing // 2, spacing):
+            image[(rows - y) ** 2 + (cols - x) ** 2 <= (diameter / 2) ** 2] = 1000
+    return image
+
+
+class _CountingSizeFn:
+    """Mean equivalent diameter of the thresholded blobs, in place of the SizeModel."""
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, crop):
+        self.calls += 1
+        labels, count = ndimage.label(crop > crop.max() / 2)
+        areas = np.bincount(labels.ravel())[1:]
+        return float(np.mean(2 * np.sqrt(areas / np.pi))) if count else 30.0
+
+
+def test_downscaled_estimates_are_scaled_back():
+    image = _disks((512, 512), diameter=24, spacing=64)
+    estimator = DiameterEstimator(_CountingSizeFn(), crop_size=256, crops_per_image=2, downscale_factor=2)
+    assert abs(estimator.estimate(image) - 24) < 2
+
+def test_crops_with_cells_are_preferred():
+    image = _disks((512, 512), diameter=20, spacing=50, region=(256, 512, 256, 512))
+    crops = sample_crops(image, 256, 1)
+    assert crops[0].max() > 0
+    assert downscale(np.ones((5, 5)), 2).shape == (2, 2)
+
+def test_cache_skips_repeat_and_similar_images(tmp_path):
+    size_fn = _CountingSizeFn()
+    cache = DiameterCache(str(tmp_path / "diameters.json"))
+    estimator = DiameterEstimator(size_fn, crop_size=128, crops_per_image=2, cache=cache, model_type="cyto3")
+    acquisition = acquisition_info([500.0, 100.0, 100.0], {"Objective": "Plan-Apochromat 20x/0.8"})
+
+    first = estimator.estimate(_disks((256, 256), 16, 40), acquisition)
+    calls = size_fn.calls
+    assert estimator.estimate(_disks((256, 256), 16, 40)) == first  # Same pixels
+    assert estimator.estimate(_disks((256, 256), 16, 48), acquisition) == first  # Same acquisition
+    assert size_fn.calls == calls
+
+    # A new cache on the same file remembers once the estimates are written, other acquisitions are estimated
+    cache.close()
+    estimator.cache = DiameterCache(str(tmp_path / "diameters.json"))
+    other = acquisition_info([500.0, 200.0, 200.0])
+    estimator.estimate(_disks((256, 256), 16, 48), other)
+    assert size_fn.calls > calls
+
+def test_cache_writes_estimates_on_flush(tmp_path):
+    path = tmp_path / "diameters.json"
+    cache = DiameterCache(str(path))
+    for index in range(3):
+        cache.put(f"image_{index}", 10.0 + index, "acquisition")
+    assert not path.exists()
+
+    cache.flush()
+    reopened = DiameterCache(str(path))
+    assert reopened.get_image("image_2") == 12.0
+    assert reopened.get_similar("acquisition") == 11.0
+
+def test_estimate_many_runs_crops_in_parallel():
+    size_fn = _CountingSizeFn()
+    # Each crop waits for a second one, so crops measured one after the other break the barrier
+    barrier = threading.Barrier(2, timeout=10)
+    threads = set()
+
+    def paired_size_fn(crop):
+        threads.add(threading.get_ident())
+        barrier.wait()
+        return size_fn(crop)
+
+    images = [_disks((256, 256), diameter, 64) for diameter in (12, 20)]
+    estimator = DiameterEstimator(paired_size_fn, crop_size=128, crops_per_image=3, downscale_factor=1,
+                                  max_workers=4)
+    small, large = estimator.estimate_many(images)
+    assert abs(small - 12) < 2 and abs(large - 20) < 2
+    assert size_fn.calls == 6 and len(threads) >= 2
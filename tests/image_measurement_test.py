@@ -0,0 +1,40 @@
+import dask.array as da
+import numpy as np
+
+from napari_pitcount_cfim.config.settings_structure import PitSettings
+from napari_pitcount_cfim.measurement.image_measurement import measure_image
+
+
+def _inputs(pit_image=None, intensities=()):
+    return {"file": "a.czi", "channel": 0, "scale": [1.0, 1.0], "intensities": list(intensities),
+            "pit_image": pit_image, "pit_scale": None}
+
+
+def test_lazy_channels_are_decoded_and_measured():
+    labels = np.zeros((32, 32), dtype=np.int32)
+    labels[4:12, 4:12] = 1
+    labels[20:30, 20:30] = 2
+    channels = [da.from_array(np.full((32, 32), value, dtype=np.uint16), chunks=16) for value in (10, 20)]
+    # Channels of another shape can not be measured within the mask
+    channels.append(np.zeros((16, 16)))
+
+    results, pits = measure_image(labels, "img", _inputs(intensities=channels), PitSettings().model_dump())
+
+    assert pits is None
+    assert results["cell_count"] == 2 and results["pit_count"] is None
+    assert results["file"] == "a.czi" and results["name"] == "img"
+    assert list(results["objects"]["mean_intensity"]) == [10, 20, 10, 20]
+
+def test_pits_are_detected_in_the_pit_image():
+    labels = np.zeros((64, 64), dtype=np.int32)
+    labels[10:40, 10:40] = 1
+    image = np.random.default_rng(0).normal(100, 3, (64, 64))
+    ys, xs = np.indices(image.shape)
+    image += 60 * np.exp(-((ys - 20) ** 2 + (xs - 30) ** 2) / (2 * 1.2 ** 2))
+
+    results, pits = measure_image(labels, "img", _inputs(pit_image=image.astype(np.float32)),
+                                  PitSettings(pit_diameter_px=3.4).model_dump())
+
+    assert [tuple(pit) for pit in pits] == [(20, 30)]
+    assert results["pit_count"] == 1
+    assert list(results["objects"]["pit_count"]) == [1]
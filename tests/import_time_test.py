@@ -0,0 +1,38 @@
+import subprocess
+import sys
+
+# Seconds the widget module may add on top of napari and Qt, which napari has loaded before any plugin.
+# Importing it takes a few tens of milliseconds, the budget leaves room for slow machines, loading cellpose
+# and torch at import time takes seconds.
+IMPORT_BUDGET = 1.0
+
+# Only needed once an analysis runs or a file is read
+DEFERRED_MODULES = ["cellpose", "torch", "tkinter", "aicsimageio", "aicspylibczi"]
+
+
+def _import_widget() -> subprocess.CompletedProcess:
+    code = ("import sys, napari.layers, qtpy.QtWidgets; import napari_pitcount_cfim._dock_widget; "
+            f"print([m for m in {DEFERRED_MODULES!r} if m in sys.modules])")
+    return subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True)
+
+
+def _cumulative_seconds(importtime_output: str, module: str) -> float:
+    # Lines read "import time: self [us] | cumulative | imported package"
+    for line in importtime_output.splitlines():
+        if line.startswith("import time:") and line.split("|")[-1].strip() == module:
+            return int(line.split("|")[1]) / 1e6
+    raise AssertionError(f"{module} not in the -X importtime output")
+
+
+def test_widget_import_within_budget():
+    completed = _import_widget()
+    assert completed.returncode == 0, completed.stderr
+
+    seconds = _cumulative_seconds(completed.stderr, "napari_pitcount_cfim._dock_widget")
+    assert seconds < IMPORT_BUDGET, f"Widget import took {seconds * 1000:.0f} ms, the budget is {IMPORT_BUDGET} s"
+
+
+def test_widget_import_defers_heavy_modules():
+    completed = _import_widget()
+    assert completed.returncode == 0, completed.stderr
+    assert completed.stdout.strip() == "[]", f"Loaded at import: {completed.stdout.strip()}"
@@ -0,0 +1,91 @@
+import os
+
+import numpy as np
+import pytest
+
+from napari_pitcount_cfim.image_handling.mask_store import MaskStore, downcast_labels, label_dtype
+
+
+def _masks(max_label, shape=(64, 64)):
+    masks = np.zeros(shape, dtype=np.int32)
+    masks.flat[:max_label] = np.arange(1, max_label + 1)
+    return masks
+
+def test_labels_get_the_smallest_unsigned_type():
+    assert label_dtype(0) == np.uint8
+    assert label_dtype(255) == np.uint8
+    assert label_dtype(256) == np.uint16
+    assert label_dtype(70000) == np.uint32
+    assert label_dtype(2 ** 40) == np.uint64
+
+    masks = _masks(300)
+    small = downcast_labels(masks)
+    assert small.dtype == np.uint16
+    assert np.array_equal(small, masks)
+    assert downcast_labels(small) is small
+
+def test_negative_labels_are_rejected():
+    with pytest.raises(ValueError):
+        downcast_labels(np.array([[-1, 0]]))
+
+def test_memmap_masks_are_backed_by_a_file(tmp_path):
+    store = MaskStore("memmap", str(tmp_path))
+    masks = _masks(40, shape=(3, 64, 64))
+
+    stored = store.put("image 1 / C0_mask", masks)
+
+    assert isinstance(stored, np.memmap)
+    assert stored.dtype == np.uint8
+    assert np.array_equal(stored, masks)
+    assert np.array_equal(store.get("image 1 / C0_mask"), masks)
+    assert store.size_bytes() < masks.nbytes
+
+def test_old_versions_are_kept_until_released(tmp_path):
+    store = MaskStore("memmap", str(tmp_path))
+    first = store.put("mask", _masks(3))
+    assert len(os.listdir(store.folder)) == 1
+
+    store.put("mask", _masks(5))
+
+    # A layer still showing the old version keeps its file until it shows the new one
+    assert len(os.listdir(store.folder)) == 2
+    assert store.get("mask").max() == 5
+    assert first.max() == 3
+
+    store.release_stale("mask")
+    assert len(os.listdir(store.folder)) == 1
+    assert len(store) == 1
+
+    store.put("mask", _masks(7))
+    store.remove("mask")
+    assert os.listdir(store.folder) == []
+    assert len(store) == 0
+
+def test_close_removes_the_folder(tmp_path):
+    store = MaskStore("memmap", str(tmp_path))
+    store.put("mask", _masks(3))
+    folder = store.folder
+
+    store.close()
+
+    assert not os.path.exists(folder)
+    assert store.get("mask") is None
+
+def test_memory_storage_keeps_nothing_on_disk():
+    store = MaskStore("memory")
+    stored = store.put("mask", _masks(3))
+
+    assert isinstance(stored, np.ndarray) and not isinstance(stored, np.memmap)
+    assert stored.dtype == np.uint8
+    assert store.folder is None
+
+def test_zarr_masks(tmp_path):
+    pytest.importorskip("zarr", exc_type=ImportError)  # Also skips a zarr broken by its codecs
+    store = MaskStore("zarr", str(tmp_path))
+    masks = _masks(1000, shape=(2, 64, 64))
+
+    stored = store.put("mask", masks)
+
+    assert stored.dtype == np.uint16
+    assert stored.chunks == (1, 64, 64)
+    assert np.array_equal(stored[...], masks)
@@ -0,0 +1,59 @@
+from xml.etree import ElementTree as ET
+
+import pytest
+import xmltodict
+
+from napari_pitcount_cfim.czi_reader_plugin.metadata_dump import ACQUISITION_MODE_SETUP_PATH, IMAGE_PATH, \
+    TRACK_SETUP_PATH, element_to_dict, extract_paths, metadata_dump
+
+_HEAD = """<ImageDocument><Metadata>
+  <Information><Image>
+    <SizeX>320</SizeX><SizeY>256</SizeY>
+    <Dimensions><Channels>
+      <Channel Id="Channel:0" Name="DAPI"><EmissionWavelength>465</EmissionWavelength></Channel>
+      <Channel Id="Channel:1" Name="mCherry"><EmissionWavelength>610</EmissionWavelength></Channel>
+    </Channels></Dimensions>
+  </Image></Information>
+  <Experiment><ExperimentBlocks><AcquisitionBlock>
+    <AcquisitionModeSetup><ScalingX>1e-07</ScalingX><ScalingY>1e-07</ScalingY></AcquisitionModeSetup>
+    <MultiTrackSetup>
+      <TrackSetup Id="Track:1"><Attenuators><Attenuator><Wavelength>4.05E-07</Wavelength></Attenuator></Attenuators></TrackSetup>
+      <TrackSetup Id="Track:2"><Attenuators><Attenuator><Wavelength/></Attenuator></Attenuators></TrackSetup>
+    </MultiTrackSetup>
+  </AcquisitionBlock></ExperimentBlocks></Experiment>
+"""
+_XML = _HEAD + "<Scaling><Items/></Scaling></Metadata></ImageDocument>"
+_PATHS = [IMAGE_PATH, ACQUISITION_MODE_SETUP_PATH, TRACK_SETUP_PATH]
+
+
+class _FakeReader:
+    metadata = ET.fromstring(_XML)
+
+
+def _xmltodict_value(path):
+    value = xmltodict.parse(_XML)["ImageDocument"]
+    for tag in path.split("/"):
+        value = value[tag]
+    return value
+
+
+def test_element_to_dict_matches_xmltodict():
+    xml = '<a x="1"> t <b>1</b><b/><c y="2"/><d y="3">v</d><e><f/></e> tail </a>'
+    assert element_to_dict(ET.fromstring(xml)) == xmltodict.parse(xml)["a"]
+
+def test_extracted_paths_match_xmltodict():
+    for source in [ET.fromstring(_XML), _XML, _XML.encode("utf-8")]:
+        extracted = extract_paths(source, _PATHS)
+        assert extracted == {path: _xmltodict_value(path) for path in _PATHS}
+
+def test_streaming_stops_after_the_last_path():
+    # Everything after the experiment block is broken, parsing it would raise
+    extracted = extract_paths(_HEAD + "<Scaling><Items", _PATHS)
+    assert len(extracted[TRACK_SETUP_PATH]) == 2
+
+def test_metadata_dump_per_channel():
+    first, second = metadata_dump(_FakeReader(), 2)
+    assert first["metadata"]["size"] == ["256", "320"]
+    assert first["scale"] == pytest.approx([0.1, 0.1])
+    assert first["metadata"]["wavelength"] == 465 and first["colormap"] == "Blue"
+    assert second["metadata"]["wavelength"] == 610 and second["colormap"] == "Orange"
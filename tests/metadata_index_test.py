@@ -0,0 +1,72 @@
+import os
+from xml.etree import ElementTree as ET
+
+from napari_pitcount_cfim.czi_reader_plugin.czi_metadata_processor import extract_key_metadata
+from napari_pitcount_cfim.czi_reader_plugin.metadata_index import MetadataIndex, get_unit_registry, index_metadata
+
+_XML = """
+<ImageDocument><Metadata>
+  <Experiment><Distance Id="X"><Value>5e-06</Value></Distance></Experiment>
+  <Information>
+    <Image><Dimensions><Channels>
+      <Channel Id="Channel:0"><EmissionWavelength>465</EmissionWavelength></Channel>
+      <Channel Id="Channel:1"><EmissionWavelength>610</EmissionWavelength></Channel>
+    </Channels></Dimensions></Image>
+    <Instrument><Objectives><Objective Id="Objective:1" Name="Plan-Apochromat 20x/0.8"/></Objectives></Instrument>
+  </Information>
+  <Scaling><Items>
+    <Distance Id="X"><Value>1e-07</Value><DefaultUnitFormat>µm</DefaultUnitFormat></Distance>
+    <Distance Id="Y"><Value>1e-07</Value></Distance>
+    <Distance Id="Z"><Value>5e-07</Value></Distance>
+  </Items></Scaling>
+  <DisplaySetting><DefaultScalingUnit>µm</DefaultScalingUnit></DisplaySetting>
+</Metadata></ImageDocument>
+"""
+
+
+class _FakeReader:
+    def __init__(self):
+        self.metadata_reads = 0
+
+    @property
+    def metadata(self):
+        self.metadata_reads += 1
+        return ET.fromstring(_XML)
+
+
+def test_index_reads_every_field_in_one_walk():
+    record = index_metadata(ET.fromstring(_XML))
+    assert record.emission_wavelengths == ("465", "610")
+    assert record.default_scaling_unit == "µm"
+    assert record.physical_pixel_sizes == (0.5, 0.1, 0.1)  # The Experiment distance is not a scaling
+    assert record.objective == "Plan-Apochromat 20x/0.8"
+
+def test_extract_key_metadata_per_channel():
+    first, second = extract_key_metadata(_FakeReader(), 2)
+    assert first["scale"] == [500.0, 100.0, 100.0]
+    assert str(first["units"][0].units) == "nanometer"
+    assert first["metadata"] == {"EmissionWavelength": "465", "DefaultScalingUnit": "µm",
+                                 "Objective": "Plan-Apochromat 20x/0.8"}
+    assert second["metadata"]["EmissionWavelength"] == "610"
+    assert first["colormap"] == "Blue" and second["colormap"] == "Orange"
+    assert get_unit_registry() is get_unit_registry()
+
+def test_index_memoizes_and_persists(tmp_path):
+    czi_path = tmp_path / "image.czi"
+    czi_path.write_bytes(b"pixels")
+    reader = _FakeReader()
+
+    index = MetadataIndex(str(tmp_path / "metadata"))
+    record = index.get(str(czi_path), lambda: reader.metadata)
+    assert index.get(str(czi_path), lambda: reader.metadata) == record
+    assert reader.metadata_reads == 1
+
+    # A new session reads the sidecar instead of the XML
+    assert MetadataIndex(str(tmp_path / "metadata")).get(str(czi_path), lambda: reader.metadata) == record
+    assert reader.metadata_reads == 1
+
+    # A modified file is indexed again
+    czi_path.write_bytes(b"other pixels")
+    os.utime(czi_path, ns=(0, 0))
+    index.get(str(czi_path), lambda: reader.metadata)
+    assert reader.metadata_reads == 2
@@ -0,0 +1,79 @@
+import threading
+
+import pytest
+
+from napari_pitcount_cfim.cellpose_analysis.model_pool import ModelPool
+
+
+class _CountingFactory:
+    """Stands in for the Cellpose loader and counts how often weights would be loaded."""
+    def __init__(self):
+        self.loads = []
+
+    def __call__(self, model_type, gpu, nchan):
+        self.loads.append((model_type, gpu, nchan))
+        return object()
+
+
+def test_same_configuration_shares_one_model():
+    factory = _CountingFactory()
+    pool = ModelPool(max_models=2, model_factory=factory)
+
+    first = pool.acquire("cyto3", False)
+    second = pool.acquire("cyto3", False)
+
+    assert first is second
+    assert factory.loads == [("cyto3", False, 2)]
+    assert pool.ref_count("cyto3", False) == 2
+
+def test_released_model_stays_warm():
+    factory = _CountingFactory()
+    pool = ModelPool(max_models=2, model_factory=factory)
+
+    model = pool.acquire("cyto3", False)
+    pool.release("cyto3", False)
+
+    assert pool.acquire("cyto3", False) is model
+    assert len(factory.loads) == 1
+
+def test_least_recently_used_idle_model_is_evicted():
+    pool = ModelPool(max_models=2, model_factory=_CountingFactory())
+    for model_type in ["cyto", "cyto2", "cyto3"]:
+        pool.acquire(model_type, False)
+        pool.release(model_type, False)
+
+    assert pool.loaded_keys() == [("cyto2", False, 2), ("cyto3", False, 2)]
+
+def test_borrowed_models_are_not_evicted():
+    pool = ModelPool(max_models=1, model_factory=_CountingFactory())
+    pool.acquire("cyto", False)
+    pool.acquire("cyto3", False)
+
+    # Both are borrowed, so the pool grows past its cap instead of pulling a model from under a user.
+    assert len(pool.loaded_keys()) == 2
+
+    pool.release("cyto", False)
+    assert pool.loaded_keys() == [("cyto3", False, 2)]
+
+def test_release_without_acquire_raises():
+    pool = ModelPool(model_factory=_CountingFactory())
+    with pytest.raises(KeyError):
+        pool.release("cyto3", False)
+
+def test_concurrent_acquire_loads_once():
+    factory = _CountingFactory()
+    pool = ModelPool(model_factory=factory)
+    models = []
+
+    def borrow():
+        models.append(pool.acquire("cyto3", False))
+
+    threads = [threading.Thread(target=borrow) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(factory.loads) == 1
+    assert all(model is models[0] for model in models)
+    assert pool.ref_count("cyto3", False) == 8
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from napari_pitcount_cfim.config.settings_structure import PitSettings
+from napari_pitcount_cfim.measurement.pit_detection import detect_pits, pit_sigma, assign_pits, count_pits, \
+    find_cell_pits
+from napari_pitcount_cfim.result_handling.result_table import object_columns
+
+
+def _spots(shape=(128, 160), centres=((20, 30), (24, 90), (70, 40), (100, 130), (110, 20)), seed=0):
+    image = np.random.default_rng(seed).normal(100, 3, shape)
+    ys, xs = np.indices(shape)
+    for y, x in centres:
+        image += 60 * np.exp(-((ys - y) ** 2 + (xs - x) ** 2) / (2 * 1.2 ** 2))
+    return image.astype(np.float32)
+
+
+def _cells(shape=(128, 160)):
+    labels = np.zeros(shape, dtype=np.int32)
+    labels[10:40, 10:60] = 1  # Holds the pit at (20, 30)
+    labels[10:40, 70:120] = 2  # Holds the pit at (24, 90)
+    labels[60:90, 30:60] = 5  # Holds the pit at (70, 40)
+    labels[60:90, 100:150] = 6  # No pits
+    return labels
+
+
+def test_detects_every_spot():
+    pits = detect_pits(_spots(), sigma=1.2)
+
+    assert sorted(map(tuple, pits)) == [(20, 30), (24, 90), (70, 40), (100, 130), (110, 20)]
+
+def test_flat_image_has_no_pits():
+    assert len(detect_pits(np.full((32, 32), 7.0), sigma=1.0)) == 0
+
+def test_zyx_stack_is_filtered_per_plane():
+    stack = np.stack([_spots(seed=0), _spots(centres=((50, 50),), seed=1)])
+
+    pits = detect_pits(stack, sigma=1.2)
+
+    assert (1, 50, 50) in set(map(tuple, pits))
+    assert sum(1 for z, _, _ in pits if z == 0) == 5
+
+def test_sigma_from_pixel_size():
+    settings = PitSettings(pit_diameter_nm=400, pit_diameter_px=3).model_dump()
+
+    assert pit_sigma(settings, [1000.0, 100.0, 100.0]) == pytest.approx(4 / (2 * np.sqrt(2)))
+    # napari gives images without a pixel size a scale of ones
+    assert pit_sigma(settings, [1.0, 1.0]) == pytest.approx(3 / (2 * np.sqrt(2)))
+    assert pit_sigma(settings, None) == pit_sigma(settings, [1.0, 1.0])
+
+def test_sigma_converts_pixel_size_units():
+    settings = PitSettings(pit_diameter_nm=400, pit_diameter_px=3).model_dump()
+    in_nm = pit_sigma(settings, [1000.0, 100.0, 100.0])
+
+    assert pit_sigma(settings, [1.0, 0.1, 0.1], ["micrometer"] * 3) == pytest.approx(in_nm)
+    assert pit_sigma(settings, [100.0, 100.0], ("nm", "nm")) == pytest.approx(in_nm)
+    # A pixel size of exactly one unit is a real size once the unit is known
+    assert pit_sigma(settings, [1.0, 1.0], ["micrometer"] * 2) == pytest.approx(in_nm / 10)
+    assert pit_sigma(settings, [1.0, 1.0], ["pixel", "pixel"]) == pit_sigma(settings, None)
+
+def test_pits_are_counted_per_cell():
+    labels = _cells()
+    pits, pit_labels = find_cell_pits(_spots(), labels, PitSettings(pit_diameter_px=3.4).model_dump())
+
+    assert len(pits) == 5
+    assert sorted(pit_labels) == [0, 0, 1, 2, 5]
+    assert list(count_pits(pit_labels, [1, 2, 5, 6])) == [1, 1, 1, 0]
+
+    columns = object_columns("img", labels, pit_labels=pit_labels)
+    assert dict(zip(columns["object_id"], columns["pit_count"])) == {1: 1, 2: 1, 5: 1, 6: 0}
+
+def test_assign_pits_checks_dimensions():
+    with pytest.raises(ValueError):
+        assign_pits(np.zeros((1, 3), dtype=int), np.zeros((4, 4), dtype=int))
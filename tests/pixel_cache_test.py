@@ -0,0 +1,90 @@
+import os
+
+import numpy as np
+import pytest
+
+from napari_pitcount_cfim.config.settings_structure import CacheSettings
+from napari_pitcount_cfim.czi_reader_plugin.pixel_cache import PixelCache, configure_pixel_cache, set_pixel_cache
+
+
+def _stack(seed=0, shape=(2, 3, 32, 32)):
+    return np.random.default_rng(seed).integers(0, 4096, shape, dtype=np.uint16)
+
+
+def test_entries_are_mapped_read_only(tmp_path):
+    cache = PixelCache(str(tmp_path / "pixels"), storage="memmap")
+    stack = _stack()
+    cache.put("key", stack)
+
+    cached = cache.get("key")
+    assert isinstance(cached, np.memmap)
+    np.testing.assert_array_equal(cached, stack)
+    with pytest.raises(ValueError):
+        cached[0, 0, 0, 0] = 1
+    assert cache.get("other") is None
+
+def test_zarr_entries_round_trip(tmp_path):
+    pytest.importorskip("zarr", exc_type=ImportError)
+    cache = PixelCache(str(tmp_path / "pixels"), storage="zarr")
+    stack = _stack()
+    cache.put("key", stack)
+
+    cached = cache.get("key")
+    assert cached.chunks == (1, 1, 32, 32)
+    np.testing.assert_array_equal(cached[...], stack)
+
+def test_key_changes_with_the_file(tmp_path):
+    path = tmp_path / "image.czi"
+    path.write_bytes(b"pixels")
+    key = PixelCache.make_key(str(path), "aicsimageio")
+    assert PixelCache.make_key(str(path), "aicsimageio") == key
+    assert PixelCache.make_key(str(path), "aicspylibczi") != key
+
+    path.write_bytes(b"other pixels")
+    assert PixelCache.make_key(str(path), "aicsimageio") != key
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    stack = _stack()
+    entry_bytes = stack.nbytes + 128  # .npy header
+    cache = PixelCache(str(tmp_path / "pixels"), max_bytes=2 * entry_bytes + 64, storage="memmap")
+    cache.put("a", stack)
+    cache.put("b", stack)
+    # Make a the most recently used
+    os.utime(cache._path("b"), ns=(1, 1))
+    assert cache.get("a") is not None
+
+    cache.put("c", stack)
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.size_bytes() <= cache.max_bytes
+
+def test_default_settings_cache_without_zarr_and_evict(tmp_path):
+    stack = _stack()
+    settings = CacheSettings(pixel_cache=True).model_dump()
+    try:
+        cache = configure_pixel_cache(settings, str(tmp_path))
+        assert cache is not None and cache.storage == "memmap"
+        cache.max_bytes = 2 * (stack.nbytes + 128) + 64
+        cache.put("a", stack)
+        cache.put("b", stack)
+        os.utime(cache._path("a"), ns=(1, 1))  # Make a the least recently used
+
+        cache.put("c", stack)
+        assert cache.get("a") is None
+        assert isinstance(cache.get("c"), np.memmap)
+        assert cache.size_bytes() <= cache.max_bytes
+    finally:
+        set_pixel_cache(None)
+
+def test_clear_removes_entries_and_leftovers(tmp_path):
+    cache = PixelCache(str(tmp_path / "pixels"), storage="memmap")
+    cache.put("a", _stack())
+    (tmp_path / "pixels" / "interrupted.npy.tmp").write_bytes(b"partial")
+
+    assert cache.clear() > 0
+    assert os.listdir(tmp_path / "pixels") == []
+    assert cache.get("a") is None
+
+def test_unknown_storage_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        PixelCache(str(tmp_path), storage="hdf5")
@@ -14,7 +14,7 @@ def qapp():
 
 def test_output_results_creates_files(tmp_path, qapp):
     # Instantiate the ResultHandler with prompt disabled and set output_path
-    handler = ResultHandler(output_path=str(tmp_path), prompt_for_folder=False)
+    handler = ResultHandler(output_path=str(tmp_path), prompt_for_folder=False, result_format="txt")
     dummy_results = {
         "test": {"value": 123},
         "another": {"value": "abc"}
@@ -46,4 +46,20 @@ def test_output_results_no_output_path(qapp):
     handler = ResultHandler(prompt_for_folder=False)
     dummy_results = {"test": {"value": 123}}
     with pytest.raises(ValueError):
-        handler.output_results(dummy_results)
\ No newline at end of file
+        handler.output_results(dummy_results)
+def test_output_results_as_csv_table(tmp_path, qapp):
+    handler = ResultHandler(output_path=str(tmp_path), prompt_for_folder=False)
+    handler.output_results({"test": {"cell_count": 123}, "another": {"cell_count": 4}})
+
+    content = (tmp_path / "results.csv").read_text(encoding="utf-8").splitlines()
+    assert content[0].startswith("level,name,")
+    assert len(content) == 3
+    assert not list(tmp_path.glob("*.txt"))
+
+def test_output_button_writes_the_collected_results(tmp_path, qapp):
+    handler = ResultHandler(output_path=str(tmp_path), prompt_for_folder=False)
+    handler.results = {"test": {"cell_count": 123}}
+    handler.init_output_button_ui().click()
+
+    content = (tmp_path / "results.csv").read_text(encoding="utf-8").splitlines()
+    assert len(content) == 2
@@ -0,0 +1,74 @@
+import contextlib
+
+import numpy as np
+import pytest
+
+from napari_pitcount_cfim.result_ingestor import ResultIngestor
+
+
+def test_results_are_coalesced_into_batches(qtbot):
+    batches = []
+    ingested = []
+
+    @contextlib.contextmanager
+    def suspend():
+        batches.append([])
+        yield
+
+    def ingest(mask, measurement, image_name):
+        batches[-1].append(image_name)
+        ingested.append(image_name)
+
+    ingestor = ResultIngestor(ingest, interval_ms=10, max_batch=3, suspend=suspend)
+    for index in range(7):
+        ingestor.add(np.zeros((4, 4)), None, f"image_{index}")
+    assert ingested == []  # Nothing is handed on before the event loop runs
+
+    with qtbot.waitSignal(ingestor.drained, timeout=5000):
+        pass
+    assert ingested == [f"image_{index}" for index in range(7)]
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+    assert ingestor.pending() == 0
+
+def test_failing_result_does_not_stall_the_queue(qtbot, caplog):
+    ingested = []
+
+    def ingest(mask, measurement, image_name):
+        if image_name == "bad":
+            raise ValueError("broken mask")
+        ingested.append(image_name)
+
+    ingestor = ResultIngestor(ingest, interval_ms=0, max_batch=1)
+    for name in ("bad", "good_a", "good_b"):
+        ingestor.add(None, None, name)
+    ingestor.flush()
+    assert ingested == ["good_a", "good_b"]
+    assert "bad" in caplog.text
+
+def test_failing_result_does_not_drop_the_rest_of_its_batch(qtbot, caplog):
+    ingested = []
+
+    def ingest(mask, measurement, image_name):
+        if image_name == "bad":
+            raise ValueError("broken mask")
+        ingested.append(image_name)
+
+    ingestor = ResultIngestor(ingest, interval_ms=0, max_batch=4)
+    for name in ("a", "bad", "b", "c"):
+        ingestor.add(None, None, name)
+    with qtbot.waitSignal(ingestor.drained, timeout=5000):
+        pass
+    assert ingested == ["a", "b", "c"]
+    assert "ValueError: broken mask" in caplog.text
+
+def test_schedule_without_results_still_flushes(qtbot):
+    ingestor = ResultIngestor(lambda mask, measurement, image_name: None, interval_ms=0)
+    with qtbot.waitSignal(ingestor.flushed, timeout=5000):
+        ingestor.schedule()
+
+def test_invalid_pacing_is_rejected():
+    ingestor = ResultIngestor(lambda mask, measurement, image_name: None)
+    with pytest.raises(ValueError):
+        ingestor.max_batch = 0
+    with pytest.raises(ValueError):
+        ingestor.interval_ms = -1
@@ -0,0 +1,99 @@
+import csv
+
+import numpy as np
+import pytest
+
+from napari_pitcount_cfim.result_handling.result_table import ResultTableSink, object_columns, image_row, \
+    write_result_table
+
+
+def _read_csv(path):
+    with open(path, newline="", encoding="utf-8") as file:
+        return list(csv.DictReader(file))
+
+
+def test_rows_are_appended_in_batches(tmp_path):
+    path = tmp_path / "results.csv"
+    sink = ResultTableSink(path, batch_rows=3)
+    for index in range(4):
+        sink.add_row({"level": "image", "name": f"img{index}", "cell_count": index})
+
+    assert sink.rows_written == 3  # One batch flushed, one row still buffered
+    assert not path.exists()  # Only moved into place on close
+    sink.close()
+
+    rows = _read_csv(path)
+    assert [row["name"] for row in rows] == ["img0", "img1", "img2", "img3"]
+    assert rows[1]["cell_count"] == "1"
+    assert rows[1]["diameter"] == ""
+    assert not list(tmp_path.glob("*.tmp"))
+
+def test_add_columns_repeats_scalars(tmp_path):
+    path = tmp_path / "results.csv"
+    with ResultTableSink(path) as sink:
+        sink.add_columns({"level": "object", "name": "img", "object_id": np.array([1, 2]),
+                          "centroid_x": np.array([1.5, 2.0])})
+
+    rows = _read_csv(path)
+    assert [(row["level"], row["name"], row["object_id"]) for row in rows] == [("object", "img", "1"),
+                                                                               ("object", "img", "2")]
+    assert float(rows[0]["centroid_x"]) == 1.5
+
+def test_unknown_columns_are_rejected(tmp_path):
+    sink = ResultTableSink(tmp_path / "results.csv")
+    with pytest.raises(ValueError):
+        sink.add_row({"not_a_column": 1})
+    sink.abort()
+
+def test_abort_keeps_previous_table(tmp_path):
+    path = tmp_path / "results.csv"
+    path.write_text("previous", encoding="utf-8")
+
+    with pytest.raises(RuntimeError):
+        with ResultTableSink(path, batch_rows=1) as sink:
+            sink.add_row({"name": "img"})
+            raise RuntimeError("run failed")
+
+    assert path.read_text(encoding="utf-8") == "previous"
+    assert not list(tmp_path.glob("*.tmp"))
+
+def test_object_columns_one_row_per_object_and_channel():
+    masks = np.zeros((20, 30), dtype=np.uint16)
+    masks[2:6, 3:5] = 1
+    masks[10:19, 20:29] = 4
+    channels = [np.full(masks.shape, 2.0), np.arange(600, dtype=np.float64).reshape(masks.shape)]
+
+    columns = object_columns("img", masks, channels)
+
+    assert list(columns["object_id"]) == [1, 1, 4, 4]
+    assert list(columns["intensity_channel"]) == [0, 1, 0, 1]
+    assert list(columns["area_px"]) == [8, 8, 81, 81]
+    assert columns["mean_intensity"][0] == 2.0
+    assert columns["max_intensity"][3] == channels[1][masks == 4].max()
+    assert len(columns["level"]) == 4
+
+def test_object_columns_without_intensities(tmp_path):
+    masks = np.zeros((10, 10), dtype=np.int32)
+    masks[1:3, 1:3] = 1
+
+    columns = object_columns("img", masks)
+
+    assert list(columns["object_id"]) == [1]
+    assert "mean_intensity" not in columns
+
+def test_image_row_flattens_result():
+    row = image_row("a_C0", {"file": "a.czi", "channel": 0, "name": "Channel 0", "scale": [1.0, 0.2, 0.1],
+                             "units": ["µm", "µm", "µm"], "cell_count": 3, "diameter": 17.0})
+
+    assert row["scale_y"] == 0.2 and row["scale_x"] == 0.1
+    assert row["unit"] == "µm"
+    assert row["channel_name"] == "Channel 0"
+
+def test_parquet_table(tmp_path):
+    pyarrow_parquet = pytest.importorskip("pyarrow.parquet")
+
+    path = write_result_table({"a": {"cell_count": 2}, "b": {"cell_count": 5}}, tmp_path, "parquet")
+
+    table = pyarrow_parquet.read_table(path)
+    assert table.column("cell_count").to_pylist() == [2, 5]
+    assert str(table.schema.field("diameter").type) == "double"
@@ -0,0 +1,60 @@
+import os
+import time
+
+import numpy as np
+
+from napari_pitcount_cfim.cellpose_analysis.segmentation_cache import SegmentationCache
+
+
+def _image(seed=0):
+    return np.random.default_rng(seed).integers(0, 4000, (64, 64), dtype=np.uint16)
+
+
+def test_round_trip(tmp_path):
+    cache = SegmentationCache(str(tmp_path))
+    masks = np.arange(64 * 64, dtype=np.int32).reshape(64, 64) % 7
+    key = cache.make_key(_image(), {"diameter": 30.0})
+
+    assert cache.get(key) is None
+    cache.put(key, masks)
+
+    cached = cache.get(key)
+    assert np.array_equal(cached["masks"], masks)
+    assert cached["flows"] is None
+
+def test_key_depends_on_pixels_and_parameters():
+    image = _image()
+    key = SegmentationCache.make_key(image, {"diameter": 30.0})
+
+    assert key == SegmentationCache.make_key(image.copy(), {"diameter": 30.0})
+    assert key != SegmentationCache.make_key(_image(seed=1), {"diameter": 30.0})
+    assert key != SegmentationCache.make_key(image, {"diameter": 31.0})
+
+def test_flows_are_only_stored_when_enabled(tmp_path):
+    flows = [np.ones((2, 8, 8)), np.zeros((8, 8))]
+    masks = np.zeros((8, 8), dtype=np.int32)
+
+    cache = SegmentationCache(str(tmp_path / "without"))
+    cache.put("key", masks, flows)
+    assert cache.get("key")["flows"] is None
+
+    cache = SegmentationCache(str(tmp_path / "with"), store_flows=True)
+    cache.put("key", masks, flows)
+    dP, cellprob = cache.get("key")["flows"]
+    assert dP.shape == (2, 8, 8) and cellprob.shape == (8, 8)
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = SegmentationCache(str(tmp_path))
+    noise = np.random.default_rng(0).integers(0, 2 ** 31, (64, 64), dtype=np.int32)  # Barely compressible
+    for name in ["a", "b", "c"]:
+        cache.put(name, noise)
+        time.sleep(0.01)
+    entry_size = os.path.getsize(tmp_path / "a.npz")
+
+    cache.get("a")  # a is now the most recently used
+    cache.max_bytes = int(entry_size * 3.5)
+    cache.put("d", noise)
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None and cache.get("d") is not None
@@ -0,0 +1,63 @@
+import os
+
+import numpy as np
+
+from napari_pitcount_cfim.segmentation_process_scheduler import ProcessSegmentationScheduler
+
+CRASH_VALUE = 7
+
+
+class _FakeCellposeUser:
+    """Thresholds the image instead of running a network, and kills its process on images filled with CRASH_VALUE."""
+    def __init__(self, cellpose_settings, cache=None):
+        pass
+
+    def process_image(self, img):
+        if np.all(img == CRASH_VALUE):
+            os._exit(1)
+        return (img > 0).astype(np.int32) * os.getpid(), None, None, None
+
+    def process_images(self, images):
+        masks = [self.process_image(img)[0] for img in images]
+        return masks, None, None, None
+
+    def release(self):
+        pass
+
+
+def _fake_user_factory(cellpose_settings, cache=None, flow_store=None):
+    return _FakeCellposeUser(cellpose_settings, cache)
+
+
+def test_results_come_from_worker_processes(qtbot):
+    scheduler = ProcessSegmentationScheduler(max_concurrency=2, threads_per_worker=1, user_factory=_fake_user_factory)
+    results = {}
+    scheduler.result.connect(lambda mask, measurement, name: results.__setitem__(name, mask))
+
+    try:
+        with qtbot.waitSignal(scheduler.idle, timeout=60000):
+            scheduler.submit(np.ones((8, 8)), "single", {})
+            scheduler.submit([np.ones((8, 8)), np.zeros((8, 8))], ["batch_a", "batch_b"], {})
+    finally:
+        scheduler.shutdown(wait=True)
+
+    assert sorted(results) == ["batch_a", "batch_b", "single"]
+    assert results["batch_b"].max() == 0
+    assert results["single"].max() not in (0, os.getpid())
+
+def test_crashed_worker_is_replaced(qtbot):
+    scheduler = ProcessSegmentationScheduler(max_concurrency=1, threads_per_worker=1, user_factory=_fake_user_factory)
+    results = []
+    finished = []
+    scheduler.result.connect(lambda mask, measurement, name: results.append(name))
+    scheduler.job_finished.connect(finished.append)
+
+    try:
+        with qtbot.waitSignal(scheduler.idle, timeout=60000):
+            crash = scheduler.submit(np.full((8, 8), CRASH_VALUE), "crash", {})
+            after = scheduler.submit(np.ones((8, 8)), "after", {})
+    finally:
+        scheduler.shutdown(wait=True)
+
+    assert results == ["after"]
+    assert sorted(finished) == sorted([crash, after])
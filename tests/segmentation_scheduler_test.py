@@ -0,0 +1,109 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from napari_pitcount_cfim.segmentation_scheduler import BaseSegmentationScheduler, SegmentationScheduler
+
+
+class _FakeCellposeUser:
+    """Thresholds the image instead of running a network, and tracks how many run at once."""
+    lock = threading.Lock()
+    running = 0
+    peak = 0
+
+    def __init__(self, cellpose_settings):
+        self.delay = cellpose_settings.get("delay", 0.05)
+
+    def process_image(self, img):
+        with _FakeCellposeUser.lock:
+            _FakeCellposeUser.running += 1
+            _FakeCellposeUser.peak = max(_FakeCellposeUser.peak, _FakeCellposeUser.running)
+        time.sleep(self.delay)
+        with _FakeCellposeUser.lock:
+            _FakeCellposeUser.running -= 1
+        return (img > 0).astype(np.int32), None, None, None
+
+    def process_images(self, images):
+        return [self.process_image(img)[0] for img in images], None, None, None
+
+    def release(self):
+        pass
+
+
+def _make_scheduler(max_concurrency):
+    _FakeCellposeUser.running = 0
+    _FakeCellposeUser.peak = 0
+    return SegmentationScheduler(max_concurrency=max_concurrency, user_factory=_FakeCellposeUser)
+
+
+def test_concurrency_is_bounded(qtbot):
+    scheduler = _make_scheduler(max_concurrency=2)
+    results = []
+    scheduler.result.connect(lambda mask, measurement, name: results.append(name))
+
+    with qtbot.waitSignal(scheduler.idle, timeout=10000):
+        for index in range(6):
+            scheduler.submit(np.ones((8, 8)), f"image_{index}", {})
+
+    assert sorted(results) == [f"image_{index}" for index in range(6)]
+    assert _FakeCellposeUser.peak == 2
+
+def test_priority_and_fifo_order(qtbot):
+    scheduler = _make_scheduler(max_concurrency=1)
+    results = []
+    scheduler.result.connect(lambda mask, measurement, name: results.append(name))
+
+    with qtbot.waitSignal(scheduler.idle, timeout=10000):
+        scheduler.submit(np.ones((8, 8)), "first", {})  # Starts right away
+        scheduler.submit(np.ones((8, 8)), "late_a", {}, priority=5)
+        scheduler.submit(np.ones((8, 8)), "late_b", {}, priority=5)
+        scheduler.submit(np.ones((8, 8)), "urgent", {}, priority=0)
+
+    assert results == ["first", "urgent", "late_a", "late_b"]
+
+def test_cancel_queued_and_running(qtbot):
+    scheduler = _make_scheduler(max_concurrency=1)
+    results = []
+    finished = []
+    scheduler.result.connect(lambda mask, measurement, name: results.append(name))
+    scheduler.job_finished.connect(finished.append)
+
+    with qtbot.waitSignal(scheduler.idle, timeout=10000):
+        running = scheduler.submit(np.ones((8, 8)), "running", {"delay": 0.2})
+        queued = scheduler.submit(np.ones((8, 8)), "queued", {})
+        assert scheduler.cancel(queued)
+        assert scheduler.cancel(running)
+
+    assert results == []
+    assert sorted(finished) == sorted([running, queued])
+    assert not scheduler.cancel(running)
+
+def test_masks_are_measured_on_the_worker_thread(qtbot):
+    scheduler = _make_scheduler(max_concurrency=2)
+    measured = {}
+    results = {}
+    scheduler.result.connect(lambda mask, measurement, name: results.__setitem__(name, measurement))
+
+    def measure(mask, image_name):
+        measured[image_name] = threading.get_ident()
+        return int(mask.sum())
+
+    with qtbot.waitSignal(scheduler.idle, timeout=10000):
+        scheduler.submit(np.ones((8, 8)), "single", {}, measure=measure)
+        scheduler.submit([np.ones((8, 8)), np.zeros((8, 8))], ["batch_a", "batch_b"], {}, measure=measure)
+
+    assert results == {"single": 64, "batch_a": 64, "batch_b": 0}
+    assert threading.get_ident() not in measured.values()
+
+def test_base_scheduler_is_abstract(qtbot):
+    with pytest.raises(TypeError):
+        BaseSegmentationScheduler()
+
+    class _Incomplete(BaseSegmentationScheduler):
+        def _start_job(self, job_id, image_data, image_name, cellpose_settings, measure):
+            pass
+
+    with pytest.raises(TypeError):
+        _Incomplete()
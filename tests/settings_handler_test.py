@@ -72,4 +72,23 @@ def test_migrate_outdated_settings(monkeypatch, tmp_path):
 
     # After instantiation, the settings should have been migrated
     updated_settings = handler.get_updated_settings()
-    assert updated_settings.get("version") == CFIMSettings.__version__
\ No newline at end of file
+    assert updated_settings.get("version") == CFIMSettings.__version__
+
+# Test 3: Verify that the dropped cache_flows setting carries over to keep_flows
+@pytest.mark.usefixtures("qapp")
+def test_cached_flows_are_migrated_to_kept_flows(monkeypatch, tmp_path):
+    test_dir = tmp_path / "mysettings"
+    test_dir.mkdir(exist_ok=True)
+
+    outdated_settings = CFIMSettings().model_dump()
+    outdated_settings["version"] = "0.8.13"
+    outdated_settings["cache_settings"]["cache_flows"] = True
+    with open(test_dir / "napari_pitcount_cfim_settings.yaml", "w") as file:
+        yaml.dump(outdated_settings, file, sort_keys=False)
+    monkeypatch.setenv("LOCALAPPDATA", str(tmp_path))
+
+    handler = SettingsHandler(path=str(test_dir), debug=True)
+
+    cache_settings = handler.get_updated_settings().get("cache_settings")
+    assert cache_settings.get("keep_flows") is True
+    assert "cache_flows" not in cache_settings
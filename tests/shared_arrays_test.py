@@ -0,0 +1,76 @@
+import dask.array as da
+import numpy as np
+import pytest
+
+from napari_pitcount_cfim.image_handling.shared_arrays import SharedArrayHandle, SharedArrayRegistry, \
+    attach_shared_array, create_shared_array
+
+
+def _handle(name):
+    return SharedArrayHandle(name, (1,), "|u1")
+
+def _exists(name):
+    try:
+        segment, _ = attach_shared_array(_handle(name))
+    except FileNotFoundError:
+        return False
+    segment.close()
+    return True
+
+
+def test_share_maps_the_same_pixels():
+    registry = SharedArrayRegistry(prefix="pcftest_a")
+    image = np.arange(24, dtype=np.uint16).reshape(2, 3, 4)
+    handle = registry.share(image, key=1)
+
+    segment, view = attach_shared_array(handle)
+    try:
+        np.testing.assert_array_equal(view, image)
+        view[0, 0, 0] = 99  # Writes are visible to every process mapping the segment
+        _, other = attach_shared_array(handle)
+        assert other[0, 0, 0] == 99
+        del other
+    finally:
+        del view
+        segment.close()
+        registry.release(1)
+    assert not _exists(handle.name)
+
+def test_dask_arrays_are_decoded_into_the_segment():
+    registry = SharedArrayRegistry(prefix="pcftest_b")
+    lazy = da.arange(64, dtype=np.float32, chunks=16).reshape(8, 8)
+    handle = registry.share(lazy, key="job")
+
+    segment, view = attach_shared_array(handle)
+    np.testing.assert_array_equal(view, lazy.compute())
+    del view
+    segment.close()
+    registry.release_all()
+    assert registry.keys() == []
+
+def test_collect_copies_and_unlinks_results():
+    registry = SharedArrayRegistry(prefix="pcftest_c")
+    name = registry.output_name(key=2)
+    # Stands in for a worker writing its mask
+    segment, view = create_shared_array(name, (4, 4), np.int32)
+    view[...] = 5
+    del view
+    segment.close()
+
+    mask = registry.collect(SharedArrayHandle(name, (4, 4), np.dtype(np.int32).str))
+    assert mask.sum() == 80
+    assert not _exists(name)
+    registry.release(2)  # Already gone, must not fail
+
+def test_release_removes_results_left_by_a_crashed_worker():
+    registry = SharedArrayRegistry(prefix="pcftest_d")
+    registry.share(np.ones((4, 4)), key=3)
+    name = registry.output_name(key=3)
+    segment, view = create_shared_array(name, (4, 4), np.int32)
+    del view
+    segment.close()
+
+    registry.release(3)
+    assert not _exists(name)
+    with pytest.raises(FileNotFoundError):
+        attach_shared_array(_handle(name))
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from napari_pitcount_cfim.cellpose_analysis.tiled_segmentation import iter_tiles, segment_tiled
+
+
+def _blob_image(shape=(300, 420), count=60, radius=6, seed=0):
+    rng = np.random.default_rng(seed)
+    rows, cols = np.indices(shape)
+    image = np.zeros(shape, dtype=np.float32)
+    for row, col in rng.integers(0, shape, size=(count, 2)):
+        image[(rows - row) ** 2 + (cols - col) ** 2 <= radius ** 2] = 1.0
+    return image
+
+
+def _label_tile(tile):
+    labels, _ = ndimage.label(tile > 0.5)
+    return labels
+
+
+def _same_partition(a, b):
+    """True if both label images segment the same pixels into the same objects, whatever the ids."""
+    if not np.array_equal(a > 0, b > 0):
+        return False
+    pairs = np.unique(np.stack([a[a > 0], b[a > 0]]), axis=1)
+    return len(np.unique(pairs[0])) == pairs.shape[1] == len(np.unique(pairs[1]))
+
+
+def test_tile_cores_cover_the_plane_once():
+    shape = (300, 420)
+    coverage = np.zeros(shape, dtype=int)
+    for tile_slices, core_slices in iter_tiles(shape, tile_size=128, overlap=32):
+        tile = coverage[tile_slices]
+        tile[core_slices] += 1
+
+    assert np.all(coverage == 1)
+
+@pytest.mark.parametrize("max_workers", [1, 3])
+def test_stitched_labels_match_whole_image(max_workers):
+    image = _blob_image()
+
+    stitched = segment_tiled(image, _label_tile, tile_size=128, overlap=32, max_workers=max_workers)
+
+    assert stitched.shape == image.shape
+    assert _same_partition(stitched, _label_tile(image))
+
+def test_small_plane_is_a_single_tile():
+    image = _blob_image(shape=(64, 64), count=4)
+    calls = []
+
+    def _segment(tile):
+        calls.append(tile.shape)
+        return _label_tile(tile)
+
+    segment_tiled(image, _segment, tile_size=128, overlap=32)
+
+    assert calls == [(64, 64)]
+
+def test_invalid_overlap_raises():
+    with pytest.raises(ValueError):
+        list(iter_tiles((256, 256), tile_size=64, overlap=64))
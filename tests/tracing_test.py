@@ -0,0 +1,95 @@
+import json
+import threading
+
+import pytest
+
+from napari_pitcount_cfim import tracing
+from napari_pitcount_cfim.tracing import Tracer, call_traced, configure_tracing, span, traced_image
+
+
+@pytest.fixture
+def tracer(monkeypatch):
+    tracer = Tracer()
+    monkeypatch.setattr(tracing, "_tracer", tracer)
+    return tracer
+
+def test_spans_are_only_recorded_when_enabled(tracer):
+    with span("decode"):
+        pass
+    assert tracer.events() == []
+
+    assert configure_tracing({"verbosity_level": tracing.TRACE_VERBOSITY})
+    with span("decode", images=2):
+        pass
+    assert [event.name for event in tracer.events()] == ["decode"]
+    assert tracer.events()[0].args == {"images": 2}
+
+    assert not configure_tracing({"verbosity_level": 1})
+    assert not tracer.enabled
+
+def test_spans_take_the_image_of_their_thread(tracer):
+    tracer.enabled = True
+
+    def work(image):
+        with traced_image(image):
+            with span("model.eval"):
+                pass
+            with span("write_mask", "explicit"):
+                pass
+
+    threads = [threading.Thread(target=work, args=(f"image_{index}",)) for index in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    images = sorted(event.image for event in tracer.events() if event.name == "model.eval")
+    assert images == ["image_0", "image_1", "image_2"]
+    assert {event.image for event in tracer.events() if event.name == "write_mask"} == {"explicit"}
+
+def test_failing_spans_are_recorded_with_the_error(tracer):
+    tracer.enabled = True
+    with pytest.raises(ValueError):
+        with span("metadata"):
+            raise ValueError("broken file")
+    assert tracer.events()[0].args == {"error": "ValueError"}
+
+def test_chrome_trace_export(tracer, tmp_path):
+    tracer.enabled = True
+    with traced_image("a.czi"), span("decode", images=1):
+        with span("model.eval"):
+            pass
+
+    path = tracer.export_chrome_trace(tmp_path / "trace.json")
+    trace = json.loads(open(path, encoding="utf-8").read())
+
+    complete = [event for event in trace["traceEvents"] if event["ph"] == "X"]
+    assert sorted(event["name"] for event in complete) == ["decode", "model.eval"]
+    decode = next(event for event in complete if event["name"] == "decode")
+    evaluation = next(event for event in complete if event["name"] == "model.eval")
+    assert decode["args"] == {"images": 1, "image": "a.czi"}
+    assert decode["ts"] <= evaluation["ts"] and evaluation["dur"] <= decode["dur"]
+    assert [event["args"]["name"] for event in trace["traceEvents"] if event["ph"] == "M"] == \
+           [threading.current_thread().name]
+
+def test_oldest_spans_are_dropped_past_the_limit(tracer):
+    tracer.enabled = True
+    tracer.max_events = 3
+    for index in range(5):
+        with span(f"span_{index}"):
+            pass
+    assert [event.name for event in tracer.events()] == ["span_2", "span_3", "span_4"]
+    assert tracer.chrome_trace()["otherData"] == {"dropped_spans": 2}
+
+def test_call_traced_returns_the_spans_of_the_call(tracer):
+    def segment(value):
+        with span("model.eval"):
+            return value * 2
+
+    result, events = call_traced(True, "a.czi", segment, 21)
+
+    assert result == 42
+    assert [(event[0], event[6]) for event in events] == [("model.eval", "a.czi")]
+    assert tracer.events() == []  # Handed back, not kept in the worker
+    tracer.extend(events)
+    assert tracer.events()[0].name == "model.eval"